@@ -1,27 +1,51 @@
 # app.py
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import datetime
 import re
 from streamlit.components.v1 import html as st_html_component
 import html as html_escaper
-import copy
 import json
-import os
-import tempfile
-import cv2
 
 # Local imports
-from config import VISION_MODEL, TEXT_MODEL
-from constants import INITIAL_BASE_CAPTIONS, TONE_OPTIONS, PREDEFINED_PRICES
-from utils import (
-    get_current_day_for_teds, get_holiday_context, format_dates_for_caption_context,
-    get_final_price_string, find_store_key_by_name, try_parse_date_from_image_text
+from config import get_models, get_model_names, MISSING_KEY_MESSAGE
+from constants import TONE_OPTIONS, PREDEFINED_PRICES
+from gemini_services import IMAGE_ANALYSIS_PROMPT_TEMPLATE, CircuitOpenError, get_call_stats
+from pipeline import (
+    combine_captions, extract_video_thumbnail,
+    generate_caption_for_item, serializable_item,
+    items_to_columns, apply_column_edits, set_store_date_range,
+    failed_items, ANALYSIS_OUTPUT_FIELDS, CONFIDENCE_FIELDS, low_confidence_fields, mark_reviewed
 )
-from gemini_services import analyze_image_with_gemini, generate_caption_with_gemini, extract_field, IMAGE_ANALYSIS_PROMPT_TEMPLATE
+from checkpoints import CheckpointStore, make_run_id
+from background_jobs import (
+    JobExecutor, analysis_task, caption_task, result_items,
+    JOB_RUNNING, JOB_CANCELLED, JOB_TIMED_OUT, ITEM_DONE, ITEM_FAILED, ITEM_CANCELLED
+)
+from blob_store import BlobStore
+from run_control import DEFAULT_RETRY_ATTEMPTS, DEFAULT_RETRY_BACKOFF_S
+from utils import content_hash
+import metrics
+import token_usage
+from token_usage import UsageLedger, format_usage
+from prompt_builder import DEFAULT_TOKEN_BUDGET, strip_debug_prefix
 
 CUSTOM_STORES_FILE = "custom_stores.json"
 CAPTION_BRAIN_FILE = "caption_brain.json"
+TOKEN_USAGE_FILE = "token_usage.json"  # Token ledger (per store / per batch), kept next to the caption brain
+CHECKPOINT_DIR = ".checkpoints"  # Per-run progress for analysis and batch caption runs
+BLOB_DIR = ".blobs"  # Upload bytes and thumbnails; session state only keeps blob ids
 MAX_BRAIN_ENTRIES_PER_STORE = 20  # Keep the 20 most recent captions per store
+BACKGROUND_JOB_WORKERS = 2  # Analysis/caption jobs running at once across all sessions
+JOB_POLL_INTERVAL_S = 1.0
+DEFAULT_ITEM_DEADLINE_S = 180  # A stuck video or call is given up on after this long
+ITEM_PAGE_SIZES = [10, 25, 50]  # Item editors rendered per page
+PREVIEWS_PER_PAGE = 24
+ALL_FILTER = "All"
+ITEM_FIELD_WIDGET_SUFFIXES = ("_batch_select", "_prod_ind", "_cat_ind", "_brands_ind", "_store_ind", "_pfmt_ind",
+                              "_pcustom_ind", "_pxfory_ind", "_pval_ind", "_sdate_ind", "_edate_ind")
+TRI_STATE_FILTER = [ALL_FILTER, "Yes", "No"]
+CONFIDENCE_BADGES = {'high': "🟢", 'medium': "🟡", 'low': "🔴", 'reviewed': "✅"}
 
 # --- Caption Brain Functions ---
 def load_caption_brain():
@@ -40,7 +64,7 @@ def load_caption_brain():
 def save_caption_brain(brain_data):
     """Save caption brain data to file"""
     try:
-        with open(CAPTION_BRAIN_FILE, 'w') as f:
+        with metrics.span('brain_save'), open(CAPTION_BRAIN_FILE, 'w') as f:
             json.dump(brain_data, f, indent=2)
     except IOError as e:
         st.warning(f"Failed to save caption brain: {e}")
@@ -104,7 +128,7 @@ def render_caption_brain_section(data_item, item_key_prefix, current_combined_ca
         for idx, entry in enumerate(brain_captions):
             caption_text = entry.get('caption', 'No caption stored.')
             # Remove timestamp prefix if present
-            caption_text = re.sub(r'\[Generated at \d{2}:\d{2}:\d{2}\] ', '', caption_text)
+            caption_text = strip_debug_prefix(caption_text)
             
             # Truncate for display
             caption_display = caption_text if len(caption_text) <= 400 else f"{caption_text[:397]}..."
@@ -570,100 +594,62 @@ def load_custom_ui():
     """, unsafe_allow_html=True)
 
 
+# --- Gemini Models ---
+def get_configured_models():
+    """config.get_models, stopping the script with an explanation if the API can't be configured."""
+    try:
+        return get_models()
+    except RuntimeError as e:
+        st.error(f"🔴 {e}")
+        if str(e) == MISSING_KEY_MESSAGE:
+            st.info("For local development, create a `.env` file in the project root with `GEMINI_API_KEY='your_key_here'`.")
+            st.info("For Streamlit Cloud deployment, add it to your app's secrets in the Streamlit dashboard.")
+        st.stop()
+
+def get_vision_model():
+    return get_configured_models()[0]
+
+def get_text_model():
+    return get_configured_models()[1]
+
+
+# --- Blob Store ---
+@st.cache_resource
+def get_blob_store():
+    """Process-wide blob store shared by all sessions; stale blobs are pruned on first use."""
+    blob_store = BlobStore(BLOB_DIR)
+    blob_store.prune()
+    return blob_store
+
+def read_blob(blob_id):
+    """Reads blob bytes on demand; returns None if the id is empty or the blob is gone."""
+    if not blob_id:
+        return None
+    try:
+        return get_blob_store().get(blob_id)
+    except KeyError:
+        return None
+
+def analysis_item_id(file_info):
+    """Stable item id (and widget key prefix) for a file, independent of its position in the list."""
+    return f"file-{file_info['name']}-{file_info['content_hash'][:12]}"
+
 # --- Video Helper Functions ---
 def get_video_thumbnail(video_bytes):
     """Extracts the first frame of a video and returns it as JPG bytes."""
     try:
-        # OpenCV needs a file path to read from, so we use a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_video_file:
-            temp_video_file.write(video_bytes)
-            video_filename = temp_video_file.name
-
-        cap = cv2.VideoCapture(video_filename)
-        success, frame = cap.read()
-        cap.release()
-        os.unlink(video_filename)  # Clean up the temporary file
-
-        if success:
-            is_success, buffer = cv2.imencode(".jpg", frame)
-            if is_success:
-                return buffer.tobytes()
+        return extract_video_thumbnail(video_bytes)
     except Exception as e:
         st.warning(f"Could not generate video thumbnail: {e}")
     return None # Return None if thumbnail generation fails
 
-def analyze_video_frames(vision_model, video_bytes, prompt):
-    """
-    Analyzes frames from a video using Gemini, scores each analysis,
-    and returns the analysis text from the frame with the best score.
-    """
-    # Use a temporary file for OpenCV
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_video_file:
-        temp_video_file.write(video_bytes)
-        video_filename = temp_video_file.name
-
-    cap = cv2.VideoCapture(video_filename)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    if not fps or fps <= 0:
-        fps = 30  # Assume a default FPS if it's not available
-
-    # Sample one frame per second
-    frame_interval = int(fps)
-
-    best_analysis_text = ""
-    max_score = -1
-    # analyzed_frames = 0 # Not used currently
-
-    frame_count = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Process frame if it's at the desired interval
-        if frame_count % frame_interval == 0:
-            is_success, buffer = cv2.imencode(".jpg", frame)
-            if is_success:
-                frame_bytes = buffer.tobytes()
-                try:
-                    analysis_text = analyze_image_with_gemini(vision_model, frame_bytes, prompt)
-                    # analyzed_frames += 1
-
-                    # Score the analysis based on how many key fields are filled
-                    score = 0
-                    if extract_field(r"^Product Name: (.*)$", analysis_text, default="Not found") != "Not found": score += 2 # Prioritize product name
-                    if extract_field(r"^Price: (.*)$", analysis_text, default="Not found") != "Not found": score += 2 # and price
-                    if extract_field(r"^Sale Dates: (.*)$", analysis_text, default="Not found") != "Not found": score += 1
-                    if extract_field(r"^Store Name: (.*)$", analysis_text, default="Not found") != "Not found": score += 1
-
-                    if score > max_score:
-                        max_score = score
-                        best_analysis_text = analysis_text
-                        # Early exit if we get a "perfect" score (all fields found)
-                        if max_score >= 6: # Max possible score with current weighting
-                            break
-                except Exception as e:
-                    # Silently ignore frames that fail analysis to not interrupt the batch
-                    print(f"Frame analysis failed: {e}")
-
-        frame_count += 1
-
-    cap.release()
-    os.unlink(video_filename)
-
-    if not best_analysis_text:
-        # Provide a more generic error if no frame yielded good results
-        raise Exception("Video analysis failed. No valid information could be extracted from the video frames.")
-
-    return best_analysis_text
-
-# --- Callback function for removing an uploaded file ---
+# --- Removing a single uploaded file (from the preview grid) ---
 def remove_file_at_index(index_to_remove):
     if 'uploaded_files_info' in st.session_state and \
        0 <= index_to_remove < len(st.session_state.uploaded_files_info):
 
-        removed_file_name = st.session_state.uploaded_files_info[index_to_remove]['name']
-        st.session_state.uploaded_files_info.pop(index_to_remove)
+        removed_file_info = st.session_state.uploaded_files_info.pop(index_to_remove)
+        removed_file_name = removed_file_info['name']
 
         if not st.session_state.uploaded_files_info:
             st.session_state.analyzed_image_data_set = []
@@ -673,15 +659,28 @@ def remove_file_at_index(index_to_remove):
             st.session_state.info_message_after_action = "All files and associated data have been cleared."
             st.session_state.uploader_key_suffix = st.session_state.get('uploader_key_suffix', 0) + 1
         elif 'analyzed_image_data_set' in st.session_state and st.session_state.analyzed_image_data_set:
-            # If there were previous analyses, clear them as they are now out of sync
-            st.session_state.analyzed_image_data_set = []
-            if 'analyzed_image_data_set_source_length' in st.session_state:
-                del st.session_state.analyzed_image_data_set_source_length
-            st.session_state.last_caption_by_store = {} # Also clear continuity
-            st.session_state.info_message_after_action = f"File '{removed_file_name}' removed. Previous analysis and continuity references cleared. Please re-analyze remaining files."
+            # Items are keyed by content hash: drop only this file's item, everything else keeps its edits
+            removed_items = [item for item in st.session_state.analyzed_image_data_set if item.get('content_hash') == removed_file_info['content_hash']]
+            st.session_state.analyzed_image_data_set = [item for item in st.session_state.analyzed_image_data_set if item.get('content_hash') != removed_file_info['content_hash']]
+            st.session_state.analyzed_image_data_set_source_length = len(st.session_state.uploaded_files_info)
+            for removed_item in removed_items:
+                drop_continuity_reference(removed_item)
+            st.session_state.info_message_after_action = f"File '{removed_file_name}' removed. Other items were kept."
         else:
             st.session_state.info_message_after_action = f"File '{removed_file_name}' removed."
 
+def drop_continuity_reference(removed_item):
+    """If a removed item's caption was its store's continuity reference, fall back to the latest remaining one."""
+    store_key = removed_item.get('selectedStoreKey')
+    if not removed_item.get('generatedCaption') or st.session_state.last_caption_by_store.get(store_key) != removed_item['generatedCaption']:
+        return
+    remaining = [item['generatedCaption'] for item in st.session_state.analyzed_image_data_set
+                 if item.get('selectedStoreKey') == store_key and item.get('generatedCaption')]
+    if remaining:
+        st.session_state.last_caption_by_store[store_key] = remaining[-1]
+    else:
+        del st.session_state.last_caption_by_store[store_key]
+
 
 # --- Callback function for removing all uploaded files and data ---
 def handle_remove_all_images():
@@ -690,8 +689,12 @@ def handle_remove_all_images():
     st.session_state.last_caption_by_store = {}
     if 'analyzed_image_data_set_source_length' in st.session_state:
         del st.session_state.analyzed_image_data_set_source_length
+    st.session_state.analysis_submitted_hashes = set()
     st.session_state.is_analyzing_images = False
     st.session_state.is_batch_generating_captions = False
+    if st.session_state.active_job_id:
+        get_job_executor().cancel(st.session_state.active_job_id)  # Nothing is left to merge its results into
+    set_active_job(None)
     st.session_state.error_message = "" # Clear any previous errors
     st.session_state.info_message_after_action = "All uploaded files and their associated data have been cleared."
     st.session_state.uploader_key_suffix = st.session_state.get('uploader_key_suffix', 0) + 1 # Reset uploader
@@ -766,14 +769,17 @@ def create_social_media_mockup(image_bytes, caption, post_index, total_posts):
     """
     return mockup_html
 
-def render_mockup_carousel():
-    """Renders the mockup carousel for all posts with captions"""
-    if not st.session_state.analyzed_image_data_set:
+@st.fragment
+def render_mockup_carousel(items=None):
+    """Renders the mockup carousel for the given items (default: all) that have captions"""
+    if items is None:
+        items = st.session_state.analyzed_image_data_set
+    if not items:
         return
     
     # Filter items that have captions
     items_with_captions = [
-        item for item in st.session_state.analyzed_image_data_set 
+        item for item in items
         if item.get('generatedCaption', '').strip()
     ]
     
@@ -802,9 +808,10 @@ def render_mockup_carousel():
     """
     
     for i, item in enumerate(items_with_captions):
-        if item.get('image_bytes_for_preview'):
+        preview_bytes = read_blob(item.get('preview_blob_id'))
+        if preview_bytes:
             # Convert image bytes to base64
-            image_base64 = base64.b64encode(item['image_bytes_for_preview']).decode()
+            image_base64 = base64.b64encode(preview_bytes).decode()
             caption_text = item.get('generatedCaption', '').strip()
             mockup_html += create_social_media_mockup(
                 image_base64, 
@@ -850,6 +857,294 @@ def render_mockup_carousel():
     st_html_component(mockup_html, height=600)
 
 
+# --- Pagination & Filters ---
+def paginate(entries, page_size, page_key):
+    """
+    Returns (page_entries, page, page_count) for the page stored under page_key in session
+    state, clamping it first so a shrinking list never leaves the user on an empty page.
+    """
+    page_count = max(1, -(-len(entries) // page_size))
+    page = min(max(int(st.session_state.get(page_key, 1)), 1), page_count)
+    st.session_state[page_key] = page
+    start = (page - 1) * page_size
+    return entries[start:start + page_size], page, page_count
+
+def filter_items(items, store_filter=ALL_FILTER, error_filter=ALL_FILTER, caption_filter=ALL_FILTER, selected_filter=ALL_FILTER,
+                 confidence_filter=ALL_FILTER):
+    """Items matching the store and Yes/No filters; ALL_FILTER disables a filter."""
+    def matches(tri_state, value):
+        return tri_state == ALL_FILTER or (tri_state == "Yes") == bool(value)
+
+    return [
+        item for item in items
+        if (store_filter == ALL_FILTER or item.get('selectedStoreKey') == store_filter)
+        and matches(error_filter, item.get('analysisError', '').strip())
+        and matches(caption_filter, item.get('generatedCaption', '').strip())
+        and matches(selected_filter, item.get('batch_selected', False))
+        and matches(confidence_filter, low_confidence_fields(item.get('fieldConfidence') or {}))
+    ]
+
+def set_batch_selection(items, selected):
+    """Sets the batch flag on items; checkboxes already on screen are reset to pick it up."""
+    for item in items:
+        item['batch_selected'] = selected
+        st.session_state.pop(f"item_{item['id']}_batch_select", None)
+
+# --- Bulk Editing ---
+def reset_item_widgets(item_ids):
+    """Drops the editor widget state of the given items so their cards show values changed elsewhere."""
+    for item_id in item_ids:
+        for suffix in ITEM_FIELD_WIDGET_SUFFIXES:
+            st.session_state.pop(f"item_{item_id}{suffix}", None)
+
+def render_bulk_edit_table(items, current_combined_captions):
+    """Editable table over the filtered items, plus a one-step date change for a whole store."""
+    store_keys = list(current_combined_captions.keys())
+    table_columns = items_to_columns(items)
+    # Edits are stored per row position, so a different set of rows gets a fresh editor
+    table_key = f"bulk_edit_table_{content_hash('|'.join(table_columns['id']))[:12]}_{st.session_state.bulk_edit_version}"
+
+    with st.form("bulk_edit_form"):
+        edited_columns = st.data_editor(
+            table_columns, key=table_key, hide_index=True, use_container_width=True, disabled=['File'],
+            column_config={
+                'id': None,
+                'Store': st.column_config.SelectboxColumn("Store", options=store_keys, required=True),
+                'Price Format': st.column_config.SelectboxColumn("Price Format", options=[p['value'] for p in PREDEFINED_PRICES], required=True),
+                'Start': st.column_config.DateColumn("Start", format="YYYY-MM-DD"),
+                'End': st.column_config.DateColumn("End", format="YYYY-MM-DD"),
+                'Selected': st.column_config.CheckboxColumn("Selected"),
+            },
+        )
+        if st.form_submit_button("💾 Apply Table Edits", type="primary", use_container_width=True):
+            changed_ids, rejected_date_ids = apply_column_edits(st.session_state.analyzed_image_data_set, edited_columns)
+            reset_item_widgets(changed_ids)
+            st.session_state.bulk_edit_version += 1
+            st.session_state.info_message_after_action = f"Applied table edits to {len(changed_ids)} item(s)."
+            if rejected_date_ids:
+                st.session_state.info_message_after_action += f" Date changes on {len(rejected_date_ids)} item(s) were skipped because the end date was before the start date."
+            st.rerun()
+
+    if not store_keys:
+        return
+    with st.form("bulk_dates_form"):
+        st.markdown("**📅 Set sale dates for every item of a store**")
+        date_cols = st.columns(3)
+        bulk_store_key = date_cols[0].selectbox("Store", store_keys, format_func=lambda k: k.replace('_', ' ').title())
+        bulk_start = date_cols[1].date_input("Start Date", value=datetime.date.today())
+        bulk_end = date_cols[2].date_input("End Date", value=datetime.date.today() + datetime.timedelta(days=6))
+        if st.form_submit_button("Apply Dates to Store", use_container_width=True):
+            if bulk_end < bulk_start:
+                st.error("End date must be on or after the start date.")
+            else:
+                changed_count = set_store_date_range(st.session_state.analyzed_image_data_set, bulk_store_key, bulk_start, bulk_end)
+                reset_item_widgets([item['id'] for item in st.session_state.analyzed_image_data_set if item.get('selectedStoreKey') == bulk_store_key])
+                st.session_state.bulk_edit_version += 1
+                st.session_state.info_message_after_action = f"Updated sale dates on {changed_count} item(s) for {bulk_store_key.replace('_', ' ').title()}."
+                st.rerun()
+
+# --- Upload Preview Grid ---
+@st.fragment
+def render_upload_previews():
+    """Preview grid of uploaded files, rendered as its own fragment."""
+    with st.expander("👁️ Show Uploaded File Previews", expanded=True):
+        previews_per_row = 4
+        page_files, page, page_count = paginate(st.session_state.uploaded_files_info, PREVIEWS_PER_PAGE, "preview_page")
+        page_offset = (page - 1) * PREVIEWS_PER_PAGE
+        for i in range(0, len(page_files), previews_per_row):
+            cols = st.columns(previews_per_row)
+            row_files_batch = page_files[i : i + previews_per_row]
+            for j, file_info in enumerate(row_files_batch):
+                actual_file_index = page_offset + i + j
+                with cols[j]:
+                    if 'video' in file_info['type']:
+                        st.video(get_blob_store().path(file_info['blob_id']))
+                        st.caption(file_info['name'])
+                    elif get_blob_store().exists(file_info['thumbnail_blob_id']):
+                        st.image(get_blob_store().path(file_info['thumbnail_blob_id']), caption=file_info['name'], use_container_width=True)
+                    else:
+                        st.caption(f"{file_info['name']} (Preview not available)")
+
+                    if st.button("❌ Remove", key=f"remove_btn_{actual_file_index}_{file_info['name']}", use_container_width=True, type="secondary"):
+                        # Removal changes the item list, so it reruns the whole app rather than this fragment
+                        remove_file_at_index(actual_file_index)
+                        st.rerun()
+            for k_empty in range(len(row_files_batch), previews_per_row): cols[k_empty].container(height=50)
+        if page_count > 1:
+            st.number_input(f"Preview page (of {page_count})", min_value=1, max_value=page_count, step=1, key="preview_page")
+
+
+# --- Fragment Helpers ---
+def rerun_fragment():
+    """Reruns only the calling fragment; falls back to an app rerun when this is a full run."""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+# --- Per-Item Editor ---
+@st.fragment
+def render_item_editor(item_id, current_combined_captions):
+    """
+    One item's editor as a fragment: field edits rerun only this block, not the whole page.
+    Changes that other parts of the page depend on (batch selection, captions shown in the
+    carousel) still trigger an app rerun.
+    """
+    index = next((i for i, item in enumerate(st.session_state.analyzed_image_data_set) if item['id'] == item_id), None)
+    if index is None:
+        return  # Removed since the last full run
+    data_item = st.session_state.analyzed_image_data_set[index]
+    item_key_prefix = f"item_{item_id}"
+
+    with st.container(border=True):
+        new_batch_selected = st.checkbox("Select for Batch Generation", value=data_item.get('batch_selected', False), key=f"{item_key_prefix}_batch_select")
+        if new_batch_selected != data_item.get('batch_selected', False):
+            # The batch button above depends on the selection, so this one reruns the whole app
+            data_item['batch_selected'] = new_batch_selected; st.rerun()
+        st.markdown(f"##### File: **{data_item.get('original_filename', data_item['id'])}**")
+        if data_item.get('analysisError'):
+            st.warning(f"Notes/Errors: {data_item['analysisError']}")
+        if data_item.get('fieldConfidence'):
+            st.caption("Confidence: " + " · ".join(f"{CONFIDENCE_BADGES.get(data_item['fieldConfidence'].get(field), '⚪')} {field}"
+                                                   for field in CONFIDENCE_FIELDS))
+        if data_item.get('tokenUsage', {}).get('calls'):
+            st.caption(f"🔢 {format_usage(data_item['tokenUsage'])}")
+
+        col1, col2 = st.columns([1, 2])
+
+        with col1:
+            if get_blob_store().exists(data_item.get('preview_blob_id')):
+                st.image(get_blob_store().path(data_item['preview_blob_id']), use_container_width=True)
+            else:
+                st.caption("Preview N/A")
+
+
+        with col2:
+            # This section remains largely the same, letting users edit data
+            new_prod = st.text_input("Product Name", value=data_item.get('itemProduct', ''), key=f"{item_key_prefix}_prod_ind")
+            if new_prod != data_item.get('itemProduct', ''): data_item['itemProduct'] = new_prod; mark_reviewed(data_item, 'itemProduct'); rerun_fragment()
+
+            new_cat = st.text_input("Product Category", value=data_item.get('itemCategory', 'N/A'), key=f"{item_key_prefix}_cat_ind")
+            if new_cat != data_item.get('itemCategory', 'N/A'): data_item['itemCategory'] = new_cat; rerun_fragment()
+
+            new_brands = st.text_input("Detected Brands", value=data_item.get('detectedBrands', 'N/A'), key=f"{item_key_prefix}_brands_ind", help="Comma-separated")
+            if new_brands != data_item.get('detectedBrands', 'N/A'): data_item['detectedBrands'] = new_brands; rerun_fragment()
+
+            store_options_map = { k: (v[list(v.keys())[0]]['name'].split('(')[0].strip() if v and list(v.keys()) else k.replace('_', ' ')) or k.replace('_', ' ') for k, v in current_combined_captions.items()}
+            current_store_key = data_item.get('selectedStoreKey', st.session_state.global_selected_store_key)
+            if not current_combined_captions: st.warning("No stores defined!")
+            elif current_store_key not in store_options_map:
+                current_store_key = list(store_options_map.keys())[0] if store_options_map else None
+                data_item['selectedStoreKey'] = current_store_key
+            if current_combined_captions:
+                try:
+                    valid_keys = list(store_options_map.keys())
+                    store_idx = valid_keys.index(current_store_key) if current_store_key in valid_keys else 0
+                except ValueError: store_idx = 0
+                selected_store_display_name = st.selectbox("Store", options=list(store_options_map.values()), index=store_idx, key=f"{item_key_prefix}_store_ind")
+                new_selected_store_key = next((k for k, v_disp in store_options_map.items() if v_disp == selected_store_display_name), current_store_key)
+                if new_selected_store_key != data_item.get('selectedStoreKey'):
+                    data_item['selectedStoreKey'] = new_selected_store_key; mark_reviewed(data_item, 'selectedStoreKey'); rerun_fragment()
+            else: st.text("No stores available to select.")
+
+            # Get the caption structure to conditionally show price/date fields
+            temp_store_key = data_item.get('selectedStoreKey')
+            temp_store_info = current_combined_captions.get(temp_store_key, {})
+            temp_sub_key = list(temp_store_info.keys())[0] if temp_store_info else None
+            temp_caption_structure = temp_store_info.get(temp_sub_key, {})
+            is_sale_based_ui = temp_caption_structure.get('dateFormat') != ""
+
+            if is_sale_based_ui:
+                price_fmt_map = {p['value']: p['label'] for p in PREDEFINED_PRICES}
+                current_price_format = data_item.get('selectedPriceFormat', PREDEFINED_PRICES[1]['value'] if PREDEFINED_PRICES and len(PREDEFINED_PRICES) > 1 else (PREDEFINED_PRICES[0]['value'] if PREDEFINED_PRICES else "CUSTOM"))
+                if PREDEFINED_PRICES:
+                    try: p_fmt_idx = list(price_fmt_map.keys()).index(current_price_format)
+                    except ValueError: p_fmt_idx = 1 if len(PREDEFINED_PRICES) > 1 else 0
+                    selected_price_format_val = st.selectbox("Price Format", options=list(price_fmt_map.keys()), format_func=lambda x: price_fmt_map[x], index=p_fmt_idx, key=f"{item_key_prefix}_pfmt_ind")
+                    if selected_price_format_val != data_item.get('selectedPriceFormat'):
+                        data_item['selectedPriceFormat'] = selected_price_format_val; mark_reviewed(data_item, 'selectedPriceFormat'); rerun_fragment()
+                    if selected_price_format_val == "CUSTOM":
+                        new_custom_p = st.text_input("Custom Price Text", value=data_item.get('customItemPrice', ''), key=f"{item_key_prefix}_pcustom_ind")
+                        if new_custom_p != data_item.get('customItemPrice', ''): data_item['customItemPrice'] = new_custom_p; mark_reviewed(data_item, 'customItemPrice'); rerun_fragment()
+                    elif selected_price_format_val == "X for $Y":
+                        new_xfory_p = st.text_input("Price (e.g., 2 for $5.00)", value=data_item.get('itemPriceValue', ''), key=f"{item_key_prefix}_pxfory_ind")
+                        if new_xfory_p != data_item.get('itemPriceValue', ''): data_item['itemPriceValue'] = new_xfory_p; mark_reviewed(data_item, 'itemPriceValue'); rerun_fragment()
+                    else:
+                        new_pval = st.text_input("Price Value (e.g., 1.99 or 79)", value=data_item.get('itemPriceValue', ''), key=f"{item_key_prefix}_pval_ind")
+                        if new_pval != data_item.get('itemPriceValue', ''): data_item['itemPriceValue'] = new_pval; mark_reviewed(data_item, 'itemPriceValue'); rerun_fragment()
+                else: st.text("No price formats defined.")
+
+                date_c1, date_c2 = st.columns(2)
+                with date_c1:
+                    try: s_dt_val = datetime.datetime.strptime(data_item['dateRange']['start'], "%Y-%m-%d").date()
+                    except: s_dt_val = datetime.date.today()
+                    new_s_dt = st.date_input("Start Date", value=s_dt_val, key=f"{item_key_prefix}_sdate_ind", max_value=datetime.date.today() + datetime.timedelta(days=365*5))
+                    if new_s_dt.strftime("%Y-%m-%d") != data_item['dateRange']['start']:
+                        data_item['dateRange']['start'] = new_s_dt.strftime("%Y-%m-%d"); mark_reviewed(data_item, 'dateRange'); rerun_fragment()
+                with date_c2:
+                    try: e_dt_val = datetime.datetime.strptime(data_item['dateRange']['end'], "%Y-%m-%d").date()
+                    except: e_dt_val = datetime.date.today() + datetime.timedelta(days=6)
+                    current_start_date_for_end_picker = datetime.datetime.strptime(data_item['dateRange']['start'], "%Y-%m-%d").date()
+                    new_e_dt = st.date_input("End Date", value=e_dt_val, key=f"{item_key_prefix}_edate_ind", min_value=current_start_date_for_end_picker, max_value=datetime.date.today() + datetime.timedelta(days=365*5))
+                    if new_e_dt.strftime("%Y-%m-%d") != data_item['dateRange']['end']:
+                        data_item['dateRange']['end'] = new_e_dt.strftime("%Y-%m-%d"); mark_reviewed(data_item, 'dateRange'); rerun_fragment()
+
+        # Caption Brain Section - show past captions
+        render_caption_brain_section(data_item, item_key_prefix, current_combined_captions)
+
+        st.markdown("---")
+
+        caption_loading_key = f"{item_key_prefix}_caption_loading_ind"
+        if caption_loading_key not in st.session_state: st.session_state[caption_loading_key] = False
+
+        # Use a counter-based approach for unique button keys
+        caption_counter_key = f"{item_key_prefix}_caption_counter"
+        if caption_counter_key not in st.session_state:
+            st.session_state[caption_counter_key] = 0
+
+        caption_button_key = f"{item_key_prefix}_gen_btn_ind_{st.session_state[caption_counter_key]}"
+
+        if st.button(f"✨ Generate Caption for this Item", key=caption_button_key,
+                      disabled=st.session_state[caption_loading_key] or st.session_state.is_batch_generating_captions,
+                      type="secondary", use_container_width=True):
+
+            st.session_state[caption_loading_key] = True
+            # Increment counter for next button press
+            st.session_state[caption_counter_key] += 1
+
+            # Debug info
+            st.write(f"🔄 Generating new caption for item {index} with tone: {st.session_state.global_selected_tone}")
+
+            # Force clear everything related to this item
+            data_item['generatedCaption'] = ""
+            data_item['analysisError'] = ""
+
+            # Also clear from last_caption_by_store to force fresh generation
+            store_details_key = data_item['selectedStoreKey']
+            if store_details_key in st.session_state.last_caption_by_store:
+                del st.session_state.last_caption_by_store[store_details_key]
+
+            # Re-use the batch generation logic for a single item
+            exec_single_item_generation(index) # Use a helper to avoid code duplication
+            st.session_state[caption_loading_key] = False
+            st.rerun()  # Full rerun so the mockup carousel shows the new caption
+
+        if st.session_state[caption_loading_key]:
+            st.caption("Generating caption for this item...")
+
+        if data_item.get('generatedCaption'):
+            caption_text_to_display = data_item['generatedCaption']
+            # Use dynamic key that includes the caption counter to force refresh
+            caption_display_key = f"{item_key_prefix}_capt_out_display_ind_{st.session_state.get(f'{item_key_prefix}_caption_counter', 0)}"
+            st.text_area("Generated Caption:", value=caption_text_to_display, height=200, key=caption_display_key, help="Review and copy below.")
+            text_area_id = f"copytext_{item_key_prefix}_ind"; feedback_span_id = f"copyfeedback_{item_key_prefix}_ind"
+            escaped_caption_for_html = html_escaper.escape(caption_text_to_display)
+            copy_button_html_content = f"""<textarea id="{text_area_id}" style="opacity:0.01; height:1px; width:1px; position:absolute; z-index: -1; pointer-events:none;" readonly>{escaped_caption_for_html}</textarea><button onclick="copyToClipboard('{text_area_id}', '{feedback_span_id}')" style="padding: 0.5rem 1.25rem; margin-top: 8px; border-radius: 10px; border: 2px solid rgba(102, 126, 234, 0.4); background: linear-gradient(135deg, rgba(102, 126, 234, 0.15) 0%, rgba(118, 75, 162, 0.15) 100%); color: #667eea; font-weight: 600; cursor: pointer; transition: all 0.3s ease; font-size: 0.95rem;">📋 Copy Caption</button><span id="{feedback_span_id}" style="margin-left: 12px; font-size: 0.9em; color: rgba(102, 126, 234, 0.9); font-weight: 500;"></span><script>if(typeof window.copyToClipboard !== 'function'){{window.copyToClipboard=function(elementId,feedbackId){{var copyText=document.getElementById(elementId);var feedbackSpan=document.getElementById(feedbackId);var button=event.target;if(!copyText||!feedbackSpan){{if(feedbackSpan)feedbackSpan.innerText="Error: Elements missing.";return;}}copyText.style.display='block';copyText.select();copyText.setSelectionRange(0,99999);copyText.style.display='none';var msg="";try{{var successful=document.execCommand('copy');msg=successful?'✓ Copied!':'Copy failed.';if(successful){{button.style.background='linear-gradient(135deg, rgba(102, 126, 234, 0.3) 0%, rgba(118, 75, 162, 0.3) 100%)';button.style.borderColor='#667eea';setTimeout(function(){{button.style.background='linear-gradient(135deg, rgba(102, 126, 234, 0.15) 0%, rgba(118, 75, 162, 0.15) 100%)';button.style.borderColor='rgba(102, 126, 234, 0.4)';}},500);}}}}catch(err){{msg='Oops, unable to copy.';}}feedbackSpan.innerText=msg;setTimeout(function(){{feedbackSpan.innerText='';}},2500);}}}}</script>"""
+            st_html_component(copy_button_html_content, height=45)
+    st.markdown("---")
+
+
 # --- Streamlit App State Initialization ---
 def initialize_session_state():
     # Initialize custom_base_captions first as other defaults might depend on it indirectly
@@ -885,10 +1180,16 @@ def initialize_session_state():
         'uploaded_files_info': [],
         'error_message': "",
         'is_analyzing_images': False,
+        'active_job_id': None,  # Background analysis/caption job this session is following
+        'last_analysis_metrics': {},  # Item count, duration and time to first editable item of the last run
         'is_batch_generating_captions': False,
         'info_message_after_action': "",
         'last_caption_by_store': {},
         'uploader_key_suffix': 0,
+        'bulk_edit_version': 0,  # Bumped after bulk edits so the table starts from the applied values
+        'seen_upload_ids': set(),  # Uploader file ids already processed (added, rejected as duplicate, or removed)
+        'flyer_mode': False,  # Analyze images as full-page flyers, one item per deal
+        'analysis_submitted_hashes': set(),  # Content hashes of files an analysis job was started for
         'caption_brain': {},  # Store past successful captions for reuse
         # 'custom_base_captions' is already initialized above
     }
@@ -899,17 +1200,7 @@ def initialize_session_state():
 # --- Function to get combined captions (initial + custom) ---
 def get_combined_captions():
     """Combine built-in stores with custom stores from memory"""
-    combined = copy.deepcopy(INITIAL_BASE_CAPTIONS)
-    custom_captions = st.session_state.get('custom_base_captions', {})
-    
-    if isinstance(custom_captions, dict):
-        for store_key, store_sale_types in custom_captions.items():
-            if store_key not in combined:
-                combined[store_key] = {}
-            if isinstance(store_sale_types, dict):
-                combined[store_key].update(store_sale_types)
-    
-    return combined
+    return combine_captions(st.session_state.get('custom_base_captions', {}))
 
 def save_custom_stores_to_file():
     """Save custom stores to persistent storage"""
@@ -934,12 +1225,11 @@ def main():
     st.title("📱 Social Media Caption Generator")
 
     initialize_session_state() # Initialize session state variables
+    reattach_job_from_url()
     current_combined_captions = get_combined_captions() # Get current combined captions data
 
-    # Check for API model availability
-    if not VISION_MODEL or not TEXT_MODEL:
-        st.error("Gemini Models not available. Please check configuration.")
-        st.stop()
+    # Gemini models are configured lazily on first use (see config.get_models),
+    # so nothing API-related runs before the first paint.
 
     # Display any error or info messages from previous actions
     if st.session_state.error_message:
@@ -1085,6 +1375,36 @@ def main():
                             
                             st.rerun()
 
+        # API call health (hedging & circuit breaker counters)
+        st.markdown("<div style='margin-top: 2rem;'></div>", unsafe_allow_html=True)
+        with st.expander("📡 API Call Health", expanded=False):
+            call_stats = get_call_stats()
+            if call_stats['circuit_state'] != "closed":
+                st.warning(f"Circuit breaker is {call_stats['circuit_state'].replace('_', '-')}: Gemini calls are failing fast.")
+            st.caption(f"Calls: {call_stats['calls']} | Failures: {call_stats['failures']} | Fast-failed: {call_stats['circuit_rejections']} | "
+                       f"Shared in flight: {call_stats['coalesced']}")
+            st.caption(f"Tokens: {call_stats['input_tokens']:,} in / {call_stats['output_tokens']:,} out")
+            st.caption(f"Hedges fired: {call_stats['hedges_fired']} | Hedges won: {call_stats['hedges_won']} | Hedge delay: {call_stats['hedge_delay_s']}s")
+
+        with st.expander("💰 Token Usage", expanded=False):
+            render_token_usage()
+            st.number_input("Caption prompt budget (estimated tokens)", min_value=150, max_value=2000, value=DEFAULT_TOKEN_BUDGET, step=50,
+                            key="caption_prompt_budget",
+                            help="Item details and requirements are always sent; the style references are shortened or left out to stay under this.")
+
+        with st.expander("🩺 Diagnostics", expanded=False):
+            render_diagnostics()
+
+        with st.expander("⏱️ Run Limits", expanded=False):
+            st.number_input("Per-item deadline (seconds, 0 = none)", min_value=0, value=DEFAULT_ITEM_DEADLINE_S, step=30, key="item_deadline_s",
+                            help="An item still running after this long is marked as timed out and the run moves on.")
+            st.number_input("Per-run deadline (seconds, 0 = none)", min_value=0, value=0, step=60, key="job_deadline_s",
+                            help="When a run takes longer than this, remaining items are skipped and partial results are kept.")
+            st.number_input("Retry attempts per failed item", min_value=1, max_value=10, value=DEFAULT_RETRY_ATTEMPTS, step=1, key="retry_attempts",
+                            help="Used by the Retry Failed buttons: each failed item is tried up to this many times.")
+            st.number_input("Retry backoff (seconds)", min_value=0.0, value=DEFAULT_RETRY_BACKOFF_S, step=1.0, key="retry_backoff_s",
+                            help="Wait before the second attempt; doubles for each further attempt (capped at 30s).")
+
         st.markdown("<div style='margin-top: 2rem;'></div>", unsafe_allow_html=True)
         st.markdown(f"<div style='text-align: center; padding: 1.5rem 1rem; color: rgba(255, 255, 255, 0.6); font-size: 0.85rem; border-top: 1px solid rgba(102, 126, 234, 0.2); margin-top: 2rem;'>✨ Caption Gen v5.0<br/><span style='opacity: 0.8;'>{datetime.date.today().strftime('%B %d, %Y')}</span></div>", unsafe_allow_html=True)
 
@@ -1102,217 +1422,110 @@ def main():
 
     if uploaded_file_objects:
         new_files_info = []
-        existing_file_signatures = {(f_info['name'], len(f_info['bytes'])) for f_info in st.session_state.uploaded_files_info}
+        # Uploads are fingerprinted by content, so the same flyer under another name is caught
+        # and two different files that merely share a name and size are both kept.
+        existing_by_hash = {f_info['content_hash']: f_info['name'] for f_info in st.session_state.uploaded_files_info}
+        seen_upload_ids = st.session_state.seen_upload_ids
+        duplicate_notes = []
+        blob_store = get_blob_store()
 
         with st.spinner("Processing new uploads..."):
             for uploaded_file in uploaded_file_objects:
+                if uploaded_file.file_id in seen_upload_ids:
+                    continue  # Already handled on an earlier rerun (added, rejected or removed)
+                seen_upload_ids.add(uploaded_file.file_id)
+
                 file_bytes = uploaded_file.getvalue()
-                if (uploaded_file.name, len(file_bytes)) not in existing_file_signatures:
-                    file_info_dict = {
-                        "name": uploaded_file.name,
-                        "type": uploaded_file.type,
-                        "bytes": file_bytes,
-                        "display_thumbnail_bytes": None
-                    }
-
-                    if 'video' in uploaded_file.type:
-                        file_info_dict['display_thumbnail_bytes'] = get_video_thumbnail(file_bytes)
-                    else:
-                        file_info_dict['display_thumbnail_bytes'] = file_bytes
+                file_hash = content_hash(file_bytes)
+                if file_hash in existing_by_hash:
+                    duplicate_notes.append(f"'{uploaded_file.name}' is identical to '{existing_by_hash[file_hash]}'")
+                    continue
+
+                # Bytes go to the blob store once; session state only keeps the handles
+                blob_id = blob_store.put(file_bytes)
+                file_info_dict = {
+                    "name": uploaded_file.name,
+                    "type": uploaded_file.type,
+                    "content_hash": file_hash,
+                    "size": len(file_bytes),
+                    "blob_id": blob_id,
+                    "thumbnail_blob_id": None
+                }
 
-                    if file_info_dict['display_thumbnail_bytes'] is None and 'video' in uploaded_file.type:
-                        st.warning(f"Could not generate thumbnail for video '{uploaded_file.name}'.")
-                        new_files_info.append(file_info_dict)
-                    elif file_info_dict['display_thumbnail_bytes'] is not None :
-                         new_files_info.append(file_info_dict)
-                    else:
-                        st.warning(f"Could not process and display '{uploaded_file.name}'. File skipped.")
+                if 'video' in uploaded_file.type:
+                    thumbnail_bytes = get_video_thumbnail(file_bytes)
+                    file_info_dict['thumbnail_blob_id'] = blob_store.put(thumbnail_bytes) if thumbnail_bytes else None
+                elif file_bytes:
+                    file_info_dict['thumbnail_blob_id'] = blob_id  # An image is its own thumbnail
+                del file_bytes
+
+                if file_info_dict['thumbnail_blob_id'] is None and 'video' in uploaded_file.type:
+                    st.warning(f"Could not generate thumbnail for video '{uploaded_file.name}'.")
+                    new_files_info.append(file_info_dict)
+                elif file_info_dict['thumbnail_blob_id'] is not None :
+                     new_files_info.append(file_info_dict)
+                else:
+                    st.warning(f"Could not process and display '{uploaded_file.name}'. File skipped.")
+                    continue
+                existing_by_hash[file_hash] = uploaded_file.name
 
+        if duplicate_notes:
+            st.session_state.info_message_after_action = f"Skipped {len(duplicate_notes)} duplicate upload(s): " + "; ".join(duplicate_notes) + ". The existing items are reused."
+            if not new_files_info:
+                st.rerun()
 
         if new_files_info:
             st.session_state.uploaded_files_info.extend(new_files_info)
-            st.session_state.analyzed_image_data_set = []
-            if 'analyzed_image_data_set_source_length' in st.session_state:
-                del st.session_state.analyzed_image_data_set_source_length
-            st.session_state.last_caption_by_store = {}
-            st.session_state.info_message_after_action = f"{len(new_files_info)} new file(s) added. Analysis cleared."
+            # A file uploaded again (after being removed) is analyzed again too
+            st.session_state.analysis_submitted_hashes -= {f['content_hash'] for f in new_files_info}
+            added_note = f"{len(new_files_info)} new file(s) added."
+            if st.session_state.active_job_id:
+                added_note += " They will be analyzed when the current run finishes."
+            elif st.session_state.analyzed_image_data_set:
+                # Existing items keep their analysis and edits; only the new files are analyzed
+                start_analysis(clear_existing=False)
+                added_note += " Analyzing only the new file(s)."
+            st.session_state.info_message_after_action = (st.session_state.info_message_after_action + " " if duplicate_notes else "") + added_note
             st.rerun()
 
     # --- Action Buttons & File Previews ---
     if st.session_state.uploaded_files_info:
+        st.checkbox("🗞️ Flyer mode: split each image into its deals", key="flyer_mode",
+                    disabled=st.session_state.is_analyzing_images,
+                    help="For full-page weekly flyers. One analysis call lists every deal on the page; each deal "
+                         "becomes its own item with a crop of the flyer as preview. Videos are analyzed as usual.")
         action_cols = st.columns(2)
         analyze_button_disabled = st.session_state.is_analyzing_images or not st.session_state.uploaded_files_info
 
         if action_cols[0].button("🔍 Analyze Uploaded File(s)", disabled=analyze_button_disabled, type="primary", use_container_width=True):
-            st.session_state.is_analyzing_images = True
-            st.session_state.analyzed_image_data_set = []
+            start_analysis(clear_existing=True)
             st.session_state.error_message = ""
-            st.session_state.last_caption_by_store = {}
-            if 'analyzed_image_data_set_source_length' in st.session_state:
-                del st.session_state.analyzed_image_data_set_source_length
             st.rerun()
 
         action_cols[1].button("🗑️ Remove All & Clear Data", key="remove_all_images_button", on_click=handle_remove_all_images, use_container_width=True, type="secondary")
 
-        with st.expander("👁️ Show Uploaded File Previews", expanded=True):
-            previews_per_row = 4
-            for i in range(0, len(st.session_state.uploaded_files_info), previews_per_row):
-                cols = st.columns(previews_per_row)
-                row_files_batch = st.session_state.uploaded_files_info[i : i + previews_per_row]
-                for j, file_info in enumerate(row_files_batch):
-                    actual_file_index = i + j
-                    with cols[j]:
-                        if 'video' in file_info['type']:
-                            st.video(file_info['bytes'])
-                            st.caption(file_info['name'])
-                        elif file_info['display_thumbnail_bytes']:
-                            st.image(file_info['display_thumbnail_bytes'], caption=file_info['name'], use_container_width=True)
-                        else:
-                            st.caption(f"{file_info['name']} (Preview not available)")
+        # Files without an item (e.g. left over from a failed run) can be analyzed without
+        # re-analyzing the others, which keep their edits and captions
+        new_file_count = len(unanalyzed_files())
+        if st.session_state.analyzed_image_data_set and new_file_count and not st.session_state.active_job_id:
+            if st.button(f"➕ Analyze {new_file_count} New File(s)", key="analyze_new_files_btn", use_container_width=True,
+                         help="Analyzes only the files that have no item yet. Existing items keep their edits and captions."):
+                start_analysis(clear_existing=False)
+                st.session_state.error_message = ""
+                st.rerun()
 
-                        st.button("❌ Remove", key=f"remove_btn_{actual_file_index}_{file_info['name']}", on_click=remove_file_at_index, args=(actual_file_index,), use_container_width=True, type="secondary")
-                for k_empty in range(len(row_files_batch), previews_per_row): cols[k_empty].container(height=50)
+        render_upload_previews()
         st.markdown("---")
 
 
-    # --- File Analysis Logic ---
-    if st.session_state.is_analyzing_images and st.session_state.uploaded_files_info:
-        with st.spinner("Analyzing files... This may take a few moments. Videos can take longer."):
-            progress_bar = st.progress(0)
-            total_files = len(st.session_state.uploaded_files_info)
-            temp_analysis_results = []
-            current_image_analysis_prompt = IMAGE_ANALYSIS_PROMPT_TEMPLATE
-
-            for idx, file_info in enumerate(st.session_state.uploaded_files_info):
-                progress_text = f"Analyzing {file_info['name']} ({idx+1}/{total_files})..."
-                progress_bar.text(progress_text)
-                progress_bar.progress((idx + 1) / total_files)
-
-                analysis_data_item = {
-                    "id": f"file-{file_info['name']}-{idx}",
-                    "original_filename": file_info['name'],
-                    "image_bytes_for_preview": file_info['display_thumbnail_bytes'],
-                    "itemProduct": "", "itemCategory": "N/A",
-                    "detectedBrands": "N/A", "selectedStoreKey": st.session_state.global_selected_store_key,
-                    "selectedPriceFormat": PREDEFINED_PRICES[1]['value'] if PREDEFINED_PRICES and len(PREDEFINED_PRICES) > 1 else (PREDEFINED_PRICES[0]['value'] if PREDEFINED_PRICES else "CUSTOM"),
-                    "itemPriceValue": "", "customItemPrice": "",
-                    "dateRange": {"start": datetime.date.today().strftime("%Y-%m-%d"), "end": (datetime.date.today() + datetime.timedelta(days=6)).strftime("%Y-%m-%d")},
-                    "generatedCaption": "", "analysisError": "", "batch_selected": False
-                }
-
-                try:
-                    analysis_text = ""
-                    file_type = file_info.get('type', '')
-
-                    if 'video' in file_type:
-                        analysis_text = analyze_video_frames(VISION_MODEL, file_info['bytes'], current_image_analysis_prompt)
-                    else:
-                        analysis_text = analyze_image_with_gemini(VISION_MODEL, file_info['bytes'], current_image_analysis_prompt)
-
-                    analysis_data_item['itemProduct'] = extract_field(r"^Product Name: (.*)$", analysis_text, default="Unknown Product").title()
-                    analysis_data_item['itemCategory'] = extract_field(r"^Product Category: (.*)$", analysis_text, default="General Grocery")
-                    analysis_data_item['detectedBrands'] = extract_field(r"^Detected Brands/Logos: (.*)$", analysis_text, default="N/A")
-
-                    extracted_price_str = extract_field(r"^Price: (.*)$", analysis_text)
-                    if extracted_price_str and extracted_price_str.lower() not in ["not found", "n/a"]:
-                        found_format = False
-                        for p_format in PREDEFINED_PRICES:
-                            if p_format['value'] == "CUSTOM": continue
-                            unit_part_match_condition = False
-                            if p_format['value'] == "X for $Y":
-                                if "for" in extracted_price_str.lower() and ("$" in extracted_price_str or "¢" in extracted_price_str):
-                                    unit_part_match_condition = True
-                            elif " " in p_format['value']:
-                                if p_format['value'].split(" ", 1)[1].lower() in extracted_price_str.lower():
-                                    unit_part_match_condition = True
-                            else:
-                                if p_format['value'].lower() in extracted_price_str.lower():
-                                    unit_part_match_condition = True
-                            if unit_part_match_condition:
-                                analysis_data_item['selectedPriceFormat'] = p_format['value']
-                                if p_format['value'] == "X for $Y":
-                                    analysis_data_item['itemPriceValue'] = extracted_price_str
-                                else:
-                                    price_val_match = re.search(r"([\d\.]+)", extracted_price_str)
-                                    if price_val_match:
-                                        analysis_data_item['itemPriceValue'] = price_val_match.group(1)
-                                    else:
-                                        analysis_data_item['selectedPriceFormat'] = "CUSTOM"
-                                        analysis_data_item['customItemPrice'] = extracted_price_str
-                                found_format = True; break
-                        if not found_format:
-                            analysis_data_item['selectedPriceFormat'] = "CUSTOM"
-                            analysis_data_item['customItemPrice'] = extracted_price_str
-                    else:
-                        analysis_data_item['selectedPriceFormat'] = "CUSTOM"
-                        analysis_data_item['customItemPrice'] = "N/A"
-
-                    detected_store_name = extract_field(r"^Store Name: (.*)$", analysis_text)
-                    if detected_store_name and detected_store_name.lower() not in ["n/a", "not found"]:
-                        matched_key = find_store_key_by_name(detected_store_name, current_combined_captions)
-                        if matched_key:
-                            analysis_data_item['selectedStoreKey'] = matched_key
-                        else:
-                            analysis_data_item['analysisError'] += f"Store '{detected_store_name}' not in predefined list. Defaulting. "
-
-                    dates_str = extract_field(r"^Sale Dates: (.*)$", analysis_text)
-                    if dates_str and dates_str.lower() not in ["n/a", "not found"]:
-                        date_parts = re.split(r'\s+to\s+|\s*-\s*|\s*–\s*', dates_str)
-                        parsed_start, parsed_end = None, None
-                        if len(date_parts) >= 1:
-                            parsed_start = try_parse_date_from_image_text(date_parts[0])
-                        if len(date_parts) >= 2:
-                            end_part_text = date_parts[1]
-                            if re.fullmatch(r"\d{1,2}", end_part_text.strip()) and parsed_start:
-                                try:
-                                    start_dt_obj = datetime.datetime.strptime(parsed_start, "%Y-%m-%d").date()
-                                    end_day_num = int(end_part_text.strip())
-                                    month_to_use, year_to_use = start_dt_obj.month, start_dt_obj.year
-                                    if start_dt_obj.day > end_day_num:
-                                        month_to_use = (start_dt_obj.month % 12) + 1
-                                        if month_to_use == 1 and start_dt_obj.month == 12:
-                                            year_to_use += 1
-                                    end_part_text_for_parse = f"{month_to_use}/{end_day_num}"
-                                    if year_to_use != datetime.date.today().year:
-                                         end_part_text_for_parse += f"/{year_to_use % 100}"
-                                    parsed_end = try_parse_date_from_image_text(end_part_text_for_parse)
-                                except ValueError:
-                                    parsed_end = try_parse_date_from_image_text(end_part_text)
-                            else:
-                                parsed_end = try_parse_date_from_image_text(end_part_text)
-                        if parsed_start:
-                            analysis_data_item['dateRange']['start'] = parsed_start
-                        if parsed_end:
-                            analysis_data_item['dateRange']['end'] = parsed_end
-                        s_dt_str = analysis_data_item['dateRange']['start']
-                        e_dt_str = analysis_data_item['dateRange']['end']
-                        try:
-                            s_dt = datetime.datetime.strptime(s_dt_str, "%Y-%m-%d").date()
-                            e_dt = datetime.datetime.strptime(e_dt_str, "%Y-%m-%d").date()
-                            if s_dt > e_dt:
-                                analysis_data_item['dateRange']['start'], analysis_data_item['dateRange']['end'] = e_dt_str, s_dt_str
-                                analysis_data_item['analysisError'] += "Start/End dates reordered. "
-                            if parsed_start and not parsed_end:
-                                analysis_data_item['dateRange']['end'] = (s_dt + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
-                                analysis_data_item['analysisError'] += "End date inferred (1 day after start). Review. "
-                            elif not parsed_start and parsed_end:
-                                analysis_data_item['analysisError'] += "Start date not found. Using today. Review. "
-                        except ValueError:
-                            analysis_data_item['analysisError'] += "Date parsing error. Defaults used. "
-                            analysis_data_item['dateRange']['start'] = datetime.date.today().strftime("%Y-%m-%d")
-                            analysis_data_item['dateRange']['end'] = (datetime.date.today() + datetime.timedelta(days=6)).strftime("%Y-%m-%d")
-                    else:
-                        analysis_data_item['analysisError'] += "Sale dates not found. Defaults used. "
-                except Exception as e:
-                    analysis_data_item['analysisError'] += f"Analysis exception: {str(e)}. Review manually. "
-                temp_analysis_results.append(analysis_data_item)
-
-            st.session_state.analyzed_image_data_set = temp_analysis_results
-            st.session_state.analyzed_image_data_set_source_length = len(st.session_state.uploaded_files_info)
-            progress_bar.empty()
-            st.session_state.is_analyzing_images = False
-            st.success(f"File analysis complete for {len(temp_analysis_results)} file(s). Review below.")
-            st.rerun()
+    # --- Background Job Progress ---
+    # Analysis and batch captions run on the process-level executor; this polls the active
+    # job, merges finished items into session state and survives page refreshes.
+    if st.session_state.active_job_id:
+        render_job_progress()
+    elif st.session_state.last_analysis_metrics:
+        run_metrics = st.session_state.last_analysis_metrics
+        st.caption(f"Last analysis: {run_metrics['items']} file(s) in {run_metrics['total_s']:.1f}s, first item editable after {run_metrics['time_to_first_item_s']:.1f}s.")
 
 
     # --- Batch Caption Generation ---
@@ -1320,36 +1533,25 @@ def main():
         items_selected_for_batch = any(item.get('batch_selected', False) for item in st.session_state.analyzed_image_data_set)
         if st.button("✨ Generate Captions for Selected Items", type="primary", use_container_width=True,
                       disabled=st.session_state.is_batch_generating_captions or not items_selected_for_batch):
-            st.session_state.is_batch_generating_captions = True
-            generated_count = 0
-            items_to_process_by_store = {}
-            for index, data_item_loop_var in enumerate(st.session_state.analyzed_image_data_set):
-                if data_item_loop_var.get('batch_selected', False):
-                    store_key = data_item_loop_var['selectedStoreKey']
-                    if store_key not in items_to_process_by_store:
-                        items_to_process_by_store[store_key] = []
-                    items_to_process_by_store[store_key].append(index)
-
-            with st.spinner("Generating captions for selected items... This can take a while for many items."):
-                for store_key_for_batch, item_indices in items_to_process_by_store.items():
-                    reference_caption_for_current_store_batch = st.session_state.last_caption_by_store.get(store_key_for_batch)
-                    for index_in_session_state in item_indices:
-                        current_data_item_ref = st.session_state.analyzed_image_data_set[index_in_session_state]
-                        exec_single_item_generation(index_in_session_state)
-                        if current_data_item_ref.get('generatedCaption'):
-                            generated_count +=1
-                            if not reference_caption_for_current_store_batch:
-                                reference_caption_for_current_store_batch = current_data_item_ref['generatedCaption']
-                            st.session_state.last_caption_by_store[store_key_for_batch] = current_data_item_ref['generatedCaption']
-
-
-            st.session_state.is_batch_generating_captions = False
-            if generated_count > 0:
-                st.success(f"Successfully generated captions for {generated_count} selected item(s).")
-            else:
-                st.info("No captions were generated in this batch (check errors or selection).")
+            start_caption_job(current_combined_captions)
             st.rerun()
 
+        # --- Retry Failed ---
+        # Re-runs only the items whose last analysis or caption attempt failed; everything
+        # that succeeded (including edits) is left as it is.
+        failed_analysis_count = len(failed_items(st.session_state.analyzed_image_data_set, 'analysis'))
+        failed_caption_count = len(failed_items(st.session_state.analyzed_image_data_set, 'caption'))
+        if failed_analysis_count or failed_caption_count:
+            retry_cols = st.columns(2)
+            if failed_analysis_count and retry_cols[0].button(f"🔁 Retry Failed Analysis ({failed_analysis_count})", key="retry_failed_analysis_btn",
+                                                              use_container_width=True, disabled=bool(st.session_state.active_job_id)):
+                start_analysis(clear_existing=False, retry_failed=True)
+                st.rerun()
+            if failed_caption_count and retry_cols[1].button(f"🔁 Retry Failed Captions ({failed_caption_count})", key="retry_failed_captions_btn",
+                                                             use_container_width=True, disabled=bool(st.session_state.active_job_id)):
+                start_caption_job(current_combined_captions, retry_failed=True)
+                st.rerun()
+
 
     # --- Individual Item Details & Caption Generation ---
     if st.session_state.analyzed_image_data_set:
@@ -1361,162 +1563,50 @@ def main():
             # --- Select/Deselect All Buttons ---
             action_cols = st.columns(8)
             if action_cols[0].button("☑️ Select All", use_container_width=True, key="select_all_btn"):
-                for item in st.session_state.analyzed_image_data_set:
-                    item['batch_selected'] = True
+                set_batch_selection(st.session_state.analyzed_image_data_set, True)
                 st.rerun()
 
             if action_cols[1].button("⬜ Deselect All", use_container_width=True, key="deselect_all_btn"):
-                for item in st.session_state.analyzed_image_data_set:
-                    item['batch_selected'] = False
+                set_batch_selection(st.session_state.analyzed_image_data_set, False)
                 st.rerun()
             st.markdown("<br>", unsafe_allow_html=True)
             # --- End Select/Deselect All ---
 
-        for index, data_item_proxy in enumerate(st.session_state.analyzed_image_data_set):
-            item_key_prefix = f"item_{data_item_proxy['id']}"
-            data_item = st.session_state.analyzed_image_data_set[index]
-
-            with st.container(border=True):
-                data_item['batch_selected'] = st.checkbox("Select for Batch Generation", value=data_item.get('batch_selected', False), key=f"{item_key_prefix}_batch_select")
-                st.markdown(f"##### File: **{data_item.get('original_filename', data_item['id'])}**")
-                if data_item.get('analysisError'):
-                    st.warning(f"Notes/Errors: {data_item['analysisError']}")
-
-                col1, col2 = st.columns([1, 2])
-
-                with col1:
-                    if data_item['image_bytes_for_preview']:
-                        st.image(data_item['image_bytes_for_preview'], use_container_width=True)
-                    else:
-                        st.caption("Preview N/A")
-
-
-                with col2:
-                    # This section remains largely the same, letting users edit data
-                    new_prod = st.text_input("Product Name", value=data_item.get('itemProduct', ''), key=f"{item_key_prefix}_prod_ind")
-                    if new_prod != data_item.get('itemProduct', ''): data_item['itemProduct'] = new_prod; st.rerun()
-
-                    new_cat = st.text_input("Product Category", value=data_item.get('itemCategory', 'N/A'), key=f"{item_key_prefix}_cat_ind")
-                    if new_cat != data_item.get('itemCategory', 'N/A'): data_item['itemCategory'] = new_cat; st.rerun()
-
-                    new_brands = st.text_input("Detected Brands", value=data_item.get('detectedBrands', 'N/A'), key=f"{item_key_prefix}_brands_ind", help="Comma-separated")
-                    if new_brands != data_item.get('detectedBrands', 'N/A'): data_item['detectedBrands'] = new_brands; st.rerun()
-
-                    store_options_map = { k: (v[list(v.keys())[0]]['name'].split('(')[0].strip() if v and list(v.keys()) else k.replace('_', ' ')) or k.replace('_', ' ') for k, v in current_combined_captions.items()}
-                    current_store_key = data_item.get('selectedStoreKey', st.session_state.global_selected_store_key)
-                    if not current_combined_captions: st.warning("No stores defined!")
-                    elif current_store_key not in store_options_map:
-                        current_store_key = list(store_options_map.keys())[0] if store_options_map else None
-                        data_item['selectedStoreKey'] = current_store_key
-                    if current_combined_captions:
-                        try:
-                            valid_keys = list(store_options_map.keys())
-                            store_idx = valid_keys.index(current_store_key) if current_store_key in valid_keys else 0
-                        except ValueError: store_idx = 0
-                        selected_store_display_name = st.selectbox("Store", options=list(store_options_map.values()), index=store_idx, key=f"{item_key_prefix}_store_ind")
-                        new_selected_store_key = next((k for k, v_disp in store_options_map.items() if v_disp == selected_store_display_name), current_store_key)
-                        if new_selected_store_key != data_item.get('selectedStoreKey'):
-                            data_item['selectedStoreKey'] = new_selected_store_key; st.rerun()
-                    else: st.text("No stores available to select.")
-
-                    # Get the caption structure to conditionally show price/date fields
-                    temp_store_key = data_item.get('selectedStoreKey')
-                    temp_store_info = current_combined_captions.get(temp_store_key, {})
-                    temp_sub_key = list(temp_store_info.keys())[0] if temp_store_info else None
-                    temp_caption_structure = temp_store_info.get(temp_sub_key, {})
-                    is_sale_based_ui = temp_caption_structure.get('dateFormat') != ""
-
-                    if is_sale_based_ui:
-                        price_fmt_map = {p['value']: p['label'] for p in PREDEFINED_PRICES}
-                        current_price_format = data_item.get('selectedPriceFormat', PREDEFINED_PRICES[1]['value'] if PREDEFINED_PRICES and len(PREDEFINED_PRICES) > 1 else (PREDEFINED_PRICES[0]['value'] if PREDEFINED_PRICES else "CUSTOM"))
-                        if PREDEFINED_PRICES:
-                            try: p_fmt_idx = list(price_fmt_map.keys()).index(current_price_format)
-                            except ValueError: p_fmt_idx = 1 if len(PREDEFINED_PRICES) > 1 else 0
-                            selected_price_format_val = st.selectbox("Price Format", options=list(price_fmt_map.keys()), format_func=lambda x: price_fmt_map[x], index=p_fmt_idx, key=f"{item_key_prefix}_pfmt_ind")
-                            if selected_price_format_val != data_item.get('selectedPriceFormat'):
-                                data_item['selectedPriceFormat'] = selected_price_format_val; st.rerun()
-                            if selected_price_format_val == "CUSTOM":
-                                new_custom_p = st.text_input("Custom Price Text", value=data_item.get('customItemPrice', ''), key=f"{item_key_prefix}_pcustom_ind")
-                                if new_custom_p != data_item.get('customItemPrice', ''): data_item['customItemPrice'] = new_custom_p; st.rerun()
-                            elif selected_price_format_val == "X for $Y":
-                                new_xfory_p = st.text_input("Price (e.g., 2 for $5.00)", value=data_item.get('itemPriceValue', ''), key=f"{item_key_prefix}_pxfory_ind")
-                                if new_xfory_p != data_item.get('itemPriceValue', ''): data_item['itemPriceValue'] = new_xfory_p; st.rerun()
-                            else:
-                                new_pval = st.text_input("Price Value (e.g., 1.99 or 79)", value=data_item.get('itemPriceValue', ''), key=f"{item_key_prefix}_pval_ind")
-                                if new_pval != data_item.get('itemPriceValue', ''): data_item['itemPriceValue'] = new_pval; st.rerun()
-                        else: st.text("No price formats defined.")
-
-                        date_c1, date_c2 = st.columns(2)
-                        with date_c1:
-                            try: s_dt_val = datetime.datetime.strptime(data_item['dateRange']['start'], "%Y-%m-%d").date()
-                            except: s_dt_val = datetime.date.today()
-                            new_s_dt = st.date_input("Start Date", value=s_dt_val, key=f"{item_key_prefix}_sdate_ind", max_value=datetime.date.today() + datetime.timedelta(days=365*5))
-                            if new_s_dt.strftime("%Y-%m-%d") != data_item['dateRange']['start']:
-                                data_item['dateRange']['start'] = new_s_dt.strftime("%Y-%m-%d"); st.rerun()
-                        with date_c2:
-                            try: e_dt_val = datetime.datetime.strptime(data_item['dateRange']['end'], "%Y-%m-%d").date()
-                            except: e_dt_val = datetime.date.today() + datetime.timedelta(days=6)
-                            current_start_date_for_end_picker = datetime.datetime.strptime(data_item['dateRange']['start'], "%Y-%m-%d").date()
-                            new_e_dt = st.date_input("End Date", value=e_dt_val, key=f"{item_key_prefix}_edate_ind", min_value=current_start_date_for_end_picker, max_value=datetime.date.today() + datetime.timedelta(days=365*5))
-                            if new_e_dt.strftime("%Y-%m-%d") != data_item['dateRange']['end']:
-                                data_item['dateRange']['end'] = new_e_dt.strftime("%Y-%m-%d"); st.rerun()
-
-                # Caption Brain Section - show past captions
-                render_caption_brain_section(data_item, item_key_prefix, current_combined_captions)
-
-                st.markdown("---")
-
-                caption_loading_key = f"{item_key_prefix}_caption_loading_ind"
-                if caption_loading_key not in st.session_state: st.session_state[caption_loading_key] = False
-                
-                # Use a counter-based approach for unique button keys
-                caption_counter_key = f"{item_key_prefix}_caption_counter"
-                if caption_counter_key not in st.session_state:
-                    st.session_state[caption_counter_key] = 0
-                
-                caption_button_key = f"{item_key_prefix}_gen_btn_ind_{st.session_state[caption_counter_key]}"
-                
-                if st.button(f"✨ Generate Caption for this Item", key=caption_button_key,
-                              disabled=st.session_state[caption_loading_key] or st.session_state.is_batch_generating_captions,
-                              type="secondary", use_container_width=True):
-
-                    st.session_state[caption_loading_key] = True
-                    # Increment counter for next button press
-                    st.session_state[caption_counter_key] += 1
-                    
-                    # Debug info
-                    st.write(f"🔄 Generating new caption for item {index} with tone: {st.session_state.global_selected_tone}")
-                    
-                    # Force clear everything related to this item
-                    data_item['generatedCaption'] = ""
-                    data_item['analysisError'] = ""
-                    
-                    # Also clear from last_caption_by_store to force fresh generation
-                    store_details_key = data_item['selectedStoreKey']
-                    if store_details_key in st.session_state.last_caption_by_store:
-                        del st.session_state.last_caption_by_store[store_details_key]
-                    
-                    # Re-use the batch generation logic for a single item
-                    exec_single_item_generation(index) # Use a helper to avoid code duplication
-                    st.session_state[caption_loading_key] = False
-                    st.rerun()
-
-                if st.session_state[caption_loading_key]:
-                    st.caption("Generating caption for this item...")
+        # --- Filters & Pagination ---
+        # Only the current page's editors (and their images) are built on each run, so the
+        # cost of a rerun stays bounded however many files were uploaded.
+        filter_cols = st.columns(6)
+        store_filter_options = [ALL_FILTER] + list(current_combined_captions.keys())
+        store_filter = filter_cols[0].selectbox("Store", store_filter_options, key="item_filter_store",
+                                                format_func=lambda k: k if k == ALL_FILTER else k.replace('_', ' ').title())
+        error_filter = filter_cols[1].selectbox("Has Error", TRI_STATE_FILTER, key="item_filter_error")
+        caption_filter = filter_cols[2].selectbox("Has Caption", TRI_STATE_FILTER, key="item_filter_caption")
+        selected_filter = filter_cols[3].selectbox("Selected", TRI_STATE_FILTER, key="item_filter_selected")
+        confidence_filter = filter_cols[4].selectbox("Low Confidence", TRI_STATE_FILTER, key="item_filter_confidence",
+                                                     help="Items with a product, price, dates or store reading that failed validation.")
+        page_size = filter_cols[5].selectbox("Per Page", ITEM_PAGE_SIZES, key="item_page_size")
+
+        visible_items = filter_items(st.session_state.analyzed_image_data_set, store_filter, error_filter, caption_filter, selected_filter,
+                                     confidence_filter)
+        page_items, page, page_count = paginate(visible_items, page_size, "item_page")
+        if len(visible_items) != len(st.session_state.analyzed_image_data_set):
+            st.caption(f"Showing {len(visible_items)} of {len(st.session_state.analyzed_image_data_set)} item(s) matching the filters.")
+        if not visible_items:
+            st.info("No items match the current filters.")
+
+        view_mode = st.radio("Edit View", ["🗂️ Cards", "📊 Table"], horizontal=True, key="item_view_mode",
+                             help="Table view edits all filtered items at once and applies the changes together.")
+        if view_mode == "📊 Table":
+            render_bulk_edit_table(visible_items, current_combined_captions)
+        else:
+            for data_item_proxy in page_items:
+                render_item_editor(data_item_proxy['id'], current_combined_captions)
 
-                if data_item.get('generatedCaption'):
-                    caption_text_to_display = data_item['generatedCaption']
-                    # Use dynamic key that includes the caption counter to force refresh
-                    caption_display_key = f"{item_key_prefix}_capt_out_display_ind_{st.session_state.get(f'{item_key_prefix}_caption_counter', 0)}"
-                    st.text_area("Generated Caption:", value=caption_text_to_display, height=200, key=caption_display_key, help="Review and copy below.")
-                    text_area_id = f"copytext_{item_key_prefix}_ind"; feedback_span_id = f"copyfeedback_{item_key_prefix}_ind"
-                    escaped_caption_for_html = html_escaper.escape(caption_text_to_display)
-                    copy_button_html_content = f"""<textarea id="{text_area_id}" style="opacity:0.01; height:1px; width:1px; position:absolute; z-index: -1; pointer-events:none;" readonly>{escaped_caption_for_html}</textarea><button onclick="copyToClipboard('{text_area_id}', '{feedback_span_id}')" style="padding: 0.5rem 1.25rem; margin-top: 8px; border-radius: 10px; border: 2px solid rgba(102, 126, 234, 0.4); background: linear-gradient(135deg, rgba(102, 126, 234, 0.15) 0%, rgba(118, 75, 162, 0.15) 100%); color: #667eea; font-weight: 600; cursor: pointer; transition: all 0.3s ease; font-size: 0.95rem;">📋 Copy Caption</button><span id="{feedback_span_id}" style="margin-left: 12px; font-size: 0.9em; color: rgba(102, 126, 234, 0.9); font-weight: 500;"></span><script>if(typeof window.copyToClipboard !== 'function'){{window.copyToClipboard=function(elementId,feedbackId){{var copyText=document.getElementById(elementId);var feedbackSpan=document.getElementById(feedbackId);var button=event.target;if(!copyText||!feedbackSpan){{if(feedbackSpan)feedbackSpan.innerText="Error: Elements missing.";return;}}copyText.style.display='block';copyText.select();copyText.setSelectionRange(0,99999);copyText.style.display='none';var msg="";try{{var successful=document.execCommand('copy');msg=successful?'✓ Copied!':'Copy failed.';if(successful){{button.style.background='linear-gradient(135deg, rgba(102, 126, 234, 0.3) 0%, rgba(118, 75, 162, 0.3) 100%)';button.style.borderColor='#667eea';setTimeout(function(){{button.style.background='linear-gradient(135deg, rgba(102, 126, 234, 0.15) 0%, rgba(118, 75, 162, 0.15) 100%)';button.style.borderColor='rgba(102, 126, 234, 0.4)';}},500);}}}}catch(err){{msg='Oops, unable to copy.';}}feedbackSpan.innerText=msg;setTimeout(function(){{feedbackSpan.innerText='';}},2500);}}}}</script>"""
-                    st_html_component(copy_button_html_content, height=45)
-            st.markdown("---")
+            if page_count > 1:
+                st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, step=1, key="item_page")
 
-        # Render mockup carousel
-        render_mockup_carousel()
+        # Render mockup carousel for the items on this page
+        render_mockup_carousel(page_items)
 
     else:
         if not st.session_state.is_analyzing_images and not st.session_state.uploaded_files_info:
@@ -1554,133 +1644,396 @@ def main():
                 </div>
             """, unsafe_allow_html=True)
 
-def exec_single_item_generation(index):
-    """Helper function to run caption generation logic for a single item to reduce code duplication."""
-    current_combined_captions = get_combined_captions()
-    data_item = st.session_state.analyzed_image_data_set[index]
-    # Clear the existing caption to ensure fresh generation
-    data_item['generatedCaption'] = ""
-    store_details_key = data_item['selectedStoreKey']
-    store_info_set = current_combined_captions.get(store_details_key)
-    current_error = data_item.get('analysisError', "")
-
-    if not store_info_set:
-        current_error += f" Store details for '{store_details_key}' not found."
+# --- Token Usage ---
+@st.cache_resource
+def get_usage_ledger():
+    return UsageLedger(TOKEN_USAGE_FILE)
+
+def record_usage_batch(batch_id, kind, item_usages):
+    """Adds a finished batch's (store_key, usage) pairs to the ledger and remembers it for the panel."""
+    entry = get_usage_ledger().record_batch(batch_id, kind, item_usages)
+    if entry:
+        st.session_state.last_batch_usage = entry
+    return entry
+
+def render_token_usage():
+    """Last batch, per-store and overall token totals from the ledger, with cost estimates."""
+    last_batch = st.session_state.get('last_batch_usage')
+    if last_batch:
+        st.caption(f"Last {last_batch['kind']} batch ({last_batch['items']} item(s)): {format_usage(last_batch['usage'])}")
+    ledger = get_usage_ledger().load()
+    stores = ledger.get('stores', {})
+    if not stores:
+        st.caption("No token usage recorded yet.")
+        return
+    store_keys = sorted(stores, key=lambda key: token_usage.total_tokens(stores[key]), reverse=True)
+    st.dataframe({
+        'Store': [key.replace('_', ' ').title() for key in store_keys],
+        'Calls': [stores[key]['calls'] for key in store_keys],
+        'Input': [stores[key]['input_tokens'] for key in store_keys],
+        'Image': [stores[key]['image_tokens'] for key in store_keys],
+        'Output': [stores[key]['output_tokens'] for key in store_keys],
+        'Per call': [round(token_usage.total_tokens(stores[key]) / max(1, stores[key]['calls'])) for key in store_keys],
+        'Est. $': [round(token_usage.estimate_cost_usd(stores[key]), 4) for key in store_keys],
+    }, hide_index=True, use_container_width=True)
+    st.caption(f"All time: {format_usage(ledger.get('totals', {}))}")
+    recent_batches = ledger.get('batches', [])[-10:][::-1]
+    if recent_batches:
+        st.dataframe({
+            'When': [batch['at'] for batch in recent_batches],
+            'Kind': [batch['kind'] for batch in recent_batches],
+            'Items': [batch['items'] for batch in recent_batches],
+            'Tokens': [token_usage.total_tokens(batch['usage']) for batch in recent_batches],
+            'Per item': [round(token_usage.total_tokens(batch['usage']) / max(1, batch['items'])) for batch in recent_batches],
+        }, hide_index=True, use_container_width=True)
+
+# --- Diagnostics ---
+def render_diagnostics():
+    """Per-stage timings (process-wide, since startup or the last reset) with JSON / Prometheus export."""
+    model_names = get_model_names()
+    st.caption(f"Models: images `{model_names['image_analysis']}` · video frames `{model_names['frame_scoring']}` · "
+               f"captions `{model_names['caption']}` · escalation `{model_names['escalation'] or 'off'}`")
+    metrics_snapshot = metrics.snapshot()
+    stages = metrics_snapshot['stages']
+    if not stages:
+        st.caption("No pipeline stages timed yet. Analyze or caption something first.")
     else:
-        sale_detail_sub_key = list(store_info_set.keys())[0]
-        if store_details_key == 'TEDS_FRESH_MARKET':
-            day_for_teds = get_current_day_for_teds()
-            if day_for_teds == 2 and 'THREE_DAY' in store_info_set: sale_detail_sub_key = 'THREE_DAY'
-            elif day_for_teds == 5 and 'FOUR_DAY' in store_info_set: sale_detail_sub_key = 'FOUR_DAY'
-            elif sale_detail_sub_key not in store_info_set: sale_detail_sub_key = list(store_info_set.keys())[0]
-
-        caption_structure = store_info_set.get(sale_detail_sub_key)
-        if not caption_structure:
-            current_error += f" Caption structure for '{sale_detail_sub_key}' under '{store_details_key}' not found."
-        else:
-            is_sale_based_post = caption_structure.get('dateFormat') != ""
-
-            product_display_text = data_item.get('itemProduct', 'Unknown Product')
-            if not product_display_text.strip() or product_display_text == "Unknown Product":
-                current_error += " Product name missing/unknown."
-
-            final_price = get_final_price_string(data_item['selectedPriceFormat'], data_item['itemPriceValue'], data_item['customItemPrice'])
-            if is_sale_based_post and (not final_price or "[Price Value]" in final_price or "[Custom Price]" in final_price or "[X for $Y Price]" in final_price or "N/A" in final_price):
-                current_error += " Invalid/missing price."
-
-
-            display_dates = ""
-            if is_sale_based_post:
-                display_dates = format_dates_for_caption_context(data_item['dateRange']['start'], data_item['dateRange']['end'], caption_structure['dateFormat'], caption_structure['language'])
-                if "MISSING" in display_dates or "INVALID" in display_dates:
-                    if "Invalid date range for caption." not in current_error:
-                        current_error += " Invalid date range for caption."
-
-
-            holiday_ctx = get_holiday_context(data_item['dateRange']['start'], data_item['dateRange']['end']) if is_sale_based_post else ""
-            prompt_list = [f"Generate a social media caption for a grocery store promotion.", f"Store & Sale Type: {caption_structure['name']}"]
-
-            detected_brands = data_item.get('detectedBrands', 'N/A')
-            temp_product_display_text = product_display_text
-            if detected_brands.lower() not in ['n/a', 'not found', '']: temp_product_display_text += f" (featuring {detected_brands})"
-
-            prompt_list.append(f"Product to feature: {temp_product_display_text}")
-
-            if is_sale_based_post:
-                prompt_list.append(f"Price: {final_price}")
-                if "MISSING" not in display_dates and "INVALID" not in display_dates:
-                    prompt_list.append(f"Sale Dates (for display in caption): {display_dates}. (Actual period: {data_item['dateRange']['start']} to {data_item['dateRange']['end']}).")
-
-            if holiday_ctx: prompt_list.append(f"Relevant Holiday Context: {holiday_ctx}.")
-
-            prompt_list.extend([
-                f"Store Location: {caption_structure['location']}.",
-                f"Language for caption: {caption_structure['language']}.",
-                f"Desired Tone: {st.session_state.global_selected_tone}."
-            ])
-
-            if holiday_ctx and st.session_state.global_selected_tone == "Seasonal / Festive":
-                prompt_list.append(f"Strongly emphasize the {holiday_ctx} theme and use relevant emojis.")
-
-            reference_caption_for_store = st.session_state.last_caption_by_store.get(store_details_key)
-            if reference_caption_for_store:
-                prompt_list.extend([f"\nIMPORTANT STYLISTIC NOTE: For consistency with other posts for this store, please try to follow a similar structure, tone, and overall style to the following reference caption. Adapt product details, price, and specific emojis for the current item, but keep the general formatting and sentence flow consistent with the reference.", f"REFERENCE CAPTION START:\n{reference_caption_for_store}\nREFERENCE CAPTION END\nWhen generating the new caption, please provide a creative and different alternative to the reference caption."])
-
-            prompt_list.extend([f"\nReference Style (from original example - adapt, don't copy verbatim, especially if a continuity reference above is provided):\n\"{caption_structure['original_example']}\"", "\nCaption Requirements:", "- Unique, engaging, ready for social media."])
-
-            if is_sale_based_post:
-                prompt_list.append(f"- Feature the product on sale by stating its name (and brand like '{detected_brands}' if relevant and not 'N/A') immediately followed by or closely linked to its price. For example: '{temp_product_display_text} is now {final_price}!'. Also, clearly include the store location.")
-                if "MISSING" not in display_dates and "INVALID" not in display_dates:
-                    prompt_list.append(f"- Clearly include the sale dates (as per 'display_dates').")
-            else:
-                prompt_list.append(f"- Feature the product by describing it in an appealing way, for example: 'Come try our delicious {temp_product_display_text} today!'. Do not mention price or sale dates.")
-
-            prompt_list.append(f"- Incorporate relevant emojis for product, tone, and holiday ({holiday_ctx if is_sale_based_post else 'general appeal'}).")
+        stage_names = sorted(stages, key=lambda stage: stages[stage]['sum_s'], reverse=True)
+        st.dataframe({
+            'Stage': stage_names,
+            'Count': [stages[stage]['count'] for stage in stage_names],
+            'p50 ms': [round(stages[stage]['p50_s'] * 1000, 1) for stage in stage_names],
+            'p95 ms': [round(stages[stage]['p95_s'] * 1000, 1) for stage in stage_names],
+            'Max ms': [round(stages[stage]['max_s'] * 1000, 1) for stage in stage_names],
+            'Total s': [round(stages[stage]['sum_s'], 2) for stage in stage_names],
+            'Errors': [stages[stage]['errors'] for stage in stage_names],
+            'What': [metrics.STAGE_DESCRIPTIONS.get(stage, "") for stage in stage_names],
+        }, hide_index=True, use_container_width=True)
+    if metrics_snapshot['counters']:
+        st.caption(" | ".join(f"{event}: {count}" for event, count in sorted(metrics_snapshot['counters'].items())))
+    export_cols = st.columns(2)
+    export_cols[0].download_button("⬇️ JSON", metrics.to_json(), file_name="caption_gen_metrics.json",
+                                   mime="application/json", use_container_width=True)
+    export_cols[1].download_button("⬇️ Prometheus", metrics.to_prometheus(), file_name="caption_gen_metrics.prom",
+                                   mime="text/plain", use_container_width=True)
+    if st.button("Reset Timings", key="reset_metrics_btn", use_container_width=True):
+        metrics.reset()
+        st.rerun()
+
+# --- Background Jobs ---
+@st.cache_resource
+def get_job_executor():
+    """Process-wide executor shared by all sessions, so jobs outlive reruns and page refreshes."""
+    return JobExecutor(max_workers=BACKGROUND_JOB_WORKERS)
+
+def set_active_job(job_id):
+    """Tracks the job this session follows; the id is mirrored in the URL for reattaching after a refresh."""
+    st.session_state.active_job_id = job_id
+    if job_id:
+        st.query_params["job"] = job_id
+    else:
+        st.query_params.pop("job", None)
 
-            item_category_for_prompt = data_item.get('itemCategory', 'N/A'); base_hashtags = caption_structure['baseHashtags']; hashtag_details = [f"product-specific for '{product_display_text}'"]
-            if item_category_for_prompt.lower() not in ['n/a', 'not found', '', 'general grocery']:
-                hashtag_details.append(f"category '{item_category_for_prompt}'")
-            prompt_list.append(f"- Include these base hashtags: {base_hashtags}. Add 2-3 creative hashtags. Also, 1-2 hashtags for each: {', '.join(hashtag_details)}.")
+def reattach_job_from_url():
+    """After a refresh, follows the job named in the URL again and restores the files and items it started from."""
+    job_id = st.query_params.get("job")
+    if st.session_state.active_job_id or not job_id:
+        return
+    job = get_job_executor().get(job_id)
+    if job is None:
+        st.query_params.pop("job", None)
+        return
+    # A job that finished while the page was gone is still reattached so its results get merged
+    if not st.session_state.uploaded_files_info:
+        st.session_state.uploaded_files_info = job['session_files']
+        st.session_state.analyzed_image_data_set = job['session_items']
+        st.session_state.seen_upload_ids = set()
+    st.session_state.is_analyzing_images = job['kind'] == 'analysis'
+    st.session_state.is_batch_generating_captions = job['kind'] == 'captions'
+    st.session_state.active_job_id = job_id
+    st.session_state.info_message_after_action = "Reattached to a background job started before the page was reloaded."
+
+def run_deadlines():
+    """Deadlines from the sidebar's Run Limits, as JobExecutor.submit keyword arguments."""
+    return {'item_deadline_s': st.session_state.get('item_deadline_s', DEFAULT_ITEM_DEADLINE_S) or None,
+            'job_deadline_s': st.session_state.get('job_deadline_s', 0) or None}
+
+def retry_settings():
+    """Attempts and backoff from the sidebar's Run Limits, as analysis_task/caption_task keyword arguments."""
+    return {'retry_attempts': int(st.session_state.get('retry_attempts', DEFAULT_RETRY_ATTEMPTS)),
+            'retry_backoff_s': float(st.session_state.get('retry_backoff_s', DEFAULT_RETRY_BACKOFF_S))}
+
+def caption_prompt_budget():
+    return int(st.session_state.get('caption_prompt_budget', DEFAULT_TOKEN_BUDGET))
+
+def unanalyzed_files():
+    """Uploaded files that have no item yet."""
+    analyzed_hashes = {item.get('content_hash') for item in st.session_state.analyzed_image_data_set}
+    return [f for f in st.session_state.uploaded_files_info if f['content_hash'] not in analyzed_hashes]
+
+def start_analysis(clear_existing, retry_failed=False):
+    """
+    Submits an analysis job; with clear_existing=False only files without an item are analyzed.
+    With retry_failed=True only the files whose item failed analysis are, with retries.
+    """
+    if clear_existing:
+        st.session_state.analyzed_image_data_set = []
+        st.session_state.last_caption_by_store = {}
+        if 'analyzed_image_data_set_source_length' in st.session_state:
+            del st.session_state.analyzed_image_data_set_source_length
+    current_combined_captions = get_combined_captions()
+    current_image_analysis_prompt = IMAGE_ANALYSIS_PROMPT_TEMPLATE
+    # Items are keyed by content hash: files that already have an item keep it (with any
+    # edits and captions) and only the files without one are analyzed.
+    if retry_failed:
+        failed_ids = {item.get('content_hash'): item['id'] for item in failed_items(st.session_state.analyzed_image_data_set, 'analysis')}
+        pending_files = [dict(f, item_id=failed_ids[f['content_hash']]) for f in st.session_state.uploaded_files_info
+                         if f['content_hash'] in failed_ids]
+    else:
+        pending_files = [dict(f, item_id=analysis_item_id(f)) for f in unanalyzed_files()]
+    if not pending_files:
+        return
 
-            prompt_list.extend([f"- Store's main name ({caption_structure['name'].split('(')[0].strip()}) should be prominent if location \"{caption_structure['location']}\" is just a city/area.", "- Good formatting with line breaks."])
+    # Every finished item is checkpointed right away, so a run restarted after a lost
+    # session (same files, same settings) only analyzes what is left.
+    checkpoints = CheckpointStore(CHECKPOINT_DIR, make_run_id(
+        'analysis', [f['content_hash'] for f in pending_files],
+        {'prompt': current_image_analysis_prompt, 'default_store': st.session_state.global_selected_store_key,
+         'stores': sorted(current_combined_captions.keys()), 'flyer_mode': st.session_state.flyer_mode}
+    ))
+    task = analysis_task(get_vision_model(), get_blob_store(), pending_files, current_combined_captions,
+                         st.session_state.global_selected_store_key, current_image_analysis_prompt, checkpoints,
+                         flyer_mode=st.session_state.flyer_mode, **(retry_settings() if retry_failed else {}))
+    job_id = get_job_executor().submit(
+        'analysis', [f['name'] for f in pending_files], task,
+        **run_deadlines(),
+        retry=retry_failed,
+        session_files=list(st.session_state.uploaded_files_info),
+        session_items=[serializable_item(item) for item in st.session_state.analyzed_image_data_set],
+    )
+    st.session_state.analysis_submitted_hashes |= {f['content_hash'] for f in pending_files}
+    st.session_state.is_analyzing_images = True
+    set_active_job(job_id)
 
-            # Include website if specified
-            if caption_structure.get('website'):
-                website_text = caption_structure['website']
-                if caption_structure['language'] == 'spanish':
-                    prompt_list.append(f"- IMPORTANT: Always include the website link. Add a line like 'Descubre todas las ofertas en 👉 {website_text}' or similar phrasing in Spanish that naturally directs readers to visit {website_text}.")
-                else:
-                    prompt_list.append(f"- IMPORTANT: Always include the website link. Add a line like 'Discover all offers at 👉 {website_text}' or similar phrasing that naturally directs readers to visit {website_text}.")
+def start_caption_job(current_combined_captions, retry_failed=False):
+    """
+    Submits a caption job for the selected items, grouped by store for caption continuity.
+    With retry_failed=True the items whose caption failed are captioned instead, with retries.
+    """
+    if retry_failed:
+        selected_items = failed_items(st.session_state.analyzed_image_data_set, 'caption')
+    else:
+        selected_items = [item for item in st.session_state.analyzed_image_data_set if item.get('batch_selected', False)]
+    if not selected_items:
+        return
+    store_order = list(dict.fromkeys(item['selectedStoreKey'] for item in selected_items))
+    selected_items.sort(key=lambda item: store_order.index(item['selectedStoreKey']))
+
+    checkpoints = CheckpointStore(CHECKPOINT_DIR, make_run_id(
+        'captions', [item.get('content_hash', '') for item in selected_items],
+        {'tone': st.session_state.global_selected_tone, 'prompt_budget': caption_prompt_budget()}
+    ))
+    task = caption_task(get_text_model(), [serializable_item(item) for item in selected_items], current_combined_captions,
+                        st.session_state.global_selected_tone, st.session_state.last_caption_by_store, checkpoints,
+                        prompt_token_budget=caption_prompt_budget(),
+                        **(retry_settings() if retry_failed else {}))
+    job_id = get_job_executor().submit(
+        'captions', [item.get('original_filename', item['id']) for item in selected_items], task,
+        **run_deadlines(),
+        retry=retry_failed,
+        session_files=list(st.session_state.uploaded_files_info),
+        session_items=[serializable_item(item) for item in st.session_state.analyzed_image_data_set],
+    )
+    st.session_state.is_batch_generating_captions = True
+    set_active_job(job_id)
+
+def merge_job_results(job):
+    """Applies finished job items to session state (idempotent). Returns True if anything new was applied."""
+    executor = get_job_executor()
+    applied = False
+    if job['kind'] == 'analysis':
+        order = {f['content_hash']: i for i, f in enumerate(st.session_state.uploaded_files_info)}
+        present = {item.get('content_hash') for item in st.session_state.analyzed_image_data_set}
+        # Files removed while the job ran are ignored; results are committed in upload order
+        # (a flyer's deal items share its content hash, so they stay together and in order)
+        new_items = [item for entry in job['items'] for item in result_items(entry['result'])
+                     if item['content_hash'] in order and item['content_hash'] not in present]
+        if new_items:
+            st.session_state.analyzed_image_data_set = sorted(
+                st.session_state.analyzed_image_data_set + new_items,
+                key=lambda item: order.get(item.get('content_hash'), len(order))
+            )
+            applied = True
+        if job.get('retry'):
+            # Retried items already exist: a recovered analysis replaces only the analysis
+            # fields (id, selection and caption stay); another failure only updates the notes
+            items_by_id = {item['id']: item for item in st.session_state.analyzed_image_data_set}
+            for index, entry in enumerate(job['items']):
+                result = entry['result']
+                if isinstance(result, list) and not entry['merged']:
+                    # A flyer split on retry: its deal items take the failed item's place (and its spent tokens)
+                    data_set = st.session_state.analyzed_image_data_set
+                    position = next((i for i, item in enumerate(data_set) if item.get('content_hash') == result[0]['content_hash']
+                                     and item.get('failedStage') == 'analysis'), None)
+                    if position is not None:
+                        # Copies: the job snapshot's usage still goes to the ledger, which should only see this retry's spend
+                        merged = [dict(deal_item, tokenUsage=dict(deal_item['tokenUsage'])) for deal_item in result]
+                        token_usage.add_usage(merged[0]['tokenUsage'], data_set[position].get('tokenUsage'))
+                        data_set[position:position + 1] = merged
+                        applied = True
+                    executor.mark_merged(job['job_id'], index)
+                    continue
+                data_item = items_by_id.get(result['id']) if result and not entry['merged'] else None
+                if data_item is None or data_item.get('failedStage') != 'analysis':
+                    continue
+                fields = ANALYSIS_OUTPUT_FIELDS if entry['status'] == ITEM_DONE else ['analysisError', 'failedStage']
+                data_item.update({field: result[field] for field in fields})
+                token_usage.add_usage(data_item.setdefault('tokenUsage', token_usage.empty_usage()), result.get('tokenUsage'))
+                reset_item_widgets([data_item['id']])
+                executor.mark_merged(job['job_id'], index)
+                applied = True
+    else:
+        items_by_id = {item['id']: item for item in st.session_state.analyzed_image_data_set}
+        for index, entry in enumerate(job['items']):
+            result = entry['result']
+            if not result or entry['merged']:
+                continue
+            data_item = items_by_id.get(result['id'])
+            if data_item is not None:
+                data_item['generatedCaption'] = result['generatedCaption']
+                data_item['analysisError'] = result['analysisError']
+                data_item['failedStage'] = result['failedStage']
+                token_usage.add_usage(data_item.setdefault('tokenUsage', token_usage.empty_usage()), result['usage'])
+                if result['generatedCaption']:
+                    st.session_state.last_caption_by_store[data_item['selectedStoreKey']] = result['generatedCaption']
+                if result['brain_entry']:
+                    save_caption_to_brain(data_item['selectedStoreKey'], result['brain_entry'])
+                # The caption counter is part of the caption widget key; bump it so the new text shows
+                counter_key = f"item_{data_item['id']}_caption_counter"
+                st.session_state[counter_key] = st.session_state.get(counter_key, 0) + 1
+            executor.mark_merged(job['job_id'], index)
+            applied = True
+    return applied
+
+def finish_job(job):
+    """Clears the running flags and reports the outcome of a finished job."""
+    finished_ok = sum(1 for entry in job['items'] if entry['status'] == ITEM_DONE)
+    if job['kind'] == 'analysis':
+        st.session_state.is_analyzing_images = False
+        st.session_state.analyzed_image_data_set_source_length = len(st.session_state.uploaded_files_info)
+        if job['items']:
+            st.session_state.last_analysis_metrics = {
+                'items': len(job['items']),
+                'total_s': job['finished_at'] - job['created_at'],
+                'time_to_first_item_s': job['first_item_s'] or 0.0,
+            }
+        message = f"File analysis complete for {len(job['items'])} file(s). Review below."
+        flyer_results = [entry['result'] for entry in job['items'] if isinstance(entry['result'], list)]
+        if flyer_results:
+            message += f" {len(flyer_results)} flyer(s) were split into {sum(len(deals) for deals in flyer_results)} deal item(s)."
+        if job.get('retry'):
+            message = f"Retried {len(job['items'])} failed analysis item(s): {finished_ok} recovered."
+    elif job.get('retry'):
+        st.session_state.is_batch_generating_captions = False
+        message = f"Retried {len(job['items'])} failed caption(s): {finished_ok} recovered."
+    else:
+        st.session_state.is_batch_generating_captions = False
+        message = (f"Successfully generated captions for {finished_ok} selected item(s)." if finished_ok
+                   else "No captions were generated in this batch (check errors or selection).")
+    if job['status'] in (JOB_CANCELLED, JOB_TIMED_OUT):
+        stopped_count = sum(1 for entry in job['items'] if entry['status'] == ITEM_CANCELLED)
+        reason = "Run cancelled" if job['status'] == JOB_CANCELLED else "Run deadline reached"
+        message = f"{reason}: {finished_ok} of {len(job['items'])} item(s) finished; {stopped_count} skipped item(s) are marked in their notes."
+    if job['resumed']:
+        message += f" Resumed {job['resumed']} item(s) from a previous interrupted run."
+    batch_usage = record_usage_batch(job['job_id'], job['kind'], job_item_usages(job))
+    if batch_usage:
+        message += f" Used {format_usage(batch_usage['usage'])}."
+    st.session_state.info_message_after_action = message
+    if job['error']:
+        st.session_state.error_message = job['error']
+    elif job['notice']:
+        st.session_state.error_message = f"🔴 {job['notice']}"
+    set_active_job(None)
+    # Files uploaded while any job ran are analyzed next, whatever its outcome. Only files no
+    # analysis was started for count, so files a failed run left without an item aren't
+    # resubmitted after every job (the "Analyze New File(s)" button still covers them).
+    if any(f['content_hash'] not in st.session_state.analysis_submitted_hashes for f in unanalyzed_files()):
+        start_analysis(clear_existing=False)
+
+def job_item_usages(job):
+    """(store_key, usage) of every item a job spent tokens on; checkpoint-resumed items cost nothing."""
+    items_by_id = {item['id']: item for item in st.session_state.analyzed_image_data_set}
+    item_usages = []
+    for entry in job['items']:
+        result = entry['result']
+        if not result or entry.get('resumed'):
+            continue
+        if job['kind'] == 'analysis':
+            item_usages.extend((item.get('selectedStoreKey'), item.get('tokenUsage')) for item in result_items(result))
+        else:
+            data_item = items_by_id.get(result['id'], {})
+            item_usages.append((data_item.get('selectedStoreKey'), result.get('usage')))
+    return item_usages
+
+@st.fragment(run_every=JOB_POLL_INTERVAL_S)
+def render_job_progress():
+    """Polls the active job: progress, per-item status, and merging results as they finish."""
+    job = get_job_executor().get(st.session_state.active_job_id) if st.session_state.active_job_id else None
+    if job is None:
+        if st.session_state.active_job_id:
+            # The job is gone (e.g. the server restarted): stop waiting for it
+            st.session_state.is_analyzing_images = st.session_state.is_batch_generating_captions = False
+            set_active_job(None)
+            st.rerun()
+        return
 
-            if is_sale_based_post and caption_structure.get('durationTextPattern') and "MISSING" not in display_dates and "INVALID" not in display_dates:
-                prompt_list.append(f"- Naturally integrate promotional phrase \"{caption_structure['durationTextPattern']}\" with sale dates {display_dates} if it makes sense.")
+    applied = merge_job_results(job)
+    if job['status'] != JOB_RUNNING:
+        finish_job(job)
+        st.rerun()
+    if applied:
+        st.rerun()  # New items or captions: rerun the page so they are listed and editable
+
+    finished = sum(1 for entry in job['items'] if entry['status'] in (ITEM_DONE, ITEM_FAILED, ITEM_CANCELLED))
+    verb = "Analyzed" if job['kind'] == 'analysis' else "Captioned"
+    progress_cols = st.columns([4, 1])
+    progress_cols[0].progress(finished / max(1, len(job['items'])),
+                              text=f"{verb} {finished} of {len(job['items'])} item(s) in the background. Finished items can be edited below.")
+    if job['cancel_requested']:
+        progress_cols[1].caption("Cancelling... the current item stops at its next checkpoint.")
+    elif progress_cols[1].button("⏹️ Cancel Run", key="cancel_job_btn", use_container_width=True):
+        get_job_executor().cancel(job['job_id'])
+        rerun_fragment()  # The next poll picks up the final state
+    with st.expander("Per-item status", expanded=False):
+        st.dataframe({'Item': [entry['label'] for entry in job['items']],
+                      'Status': [entry['status'] for entry in job['items']]},
+                     hide_index=True, use_container_width=True)
 
-            final_prompt_for_caption = "\n".join(prompt_list)
-            try:
-                generated_text = generate_caption_with_gemini(TEXT_MODEL, final_prompt_for_caption)
-                cleaned_text = generated_text.replace('*', '')
-                
-                # Add timestamp for debugging
-                timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-                cleaned_text = f"[Generated at {timestamp}] {cleaned_text}"
-                
-                data_item['generatedCaption'] = cleaned_text
-                
-                # Save to caption brain for future reference
-                save_caption_to_brain(store_details_key, {
-                    'product': product_display_text,
-                    'price': final_price if is_sale_based_post else 'N/A',
-                    'dateRange': data_item['dateRange'] if is_sale_based_post else {},
-                    'tone': st.session_state.global_selected_tone,
-                    'caption': cleaned_text,
-                    'timestamp': timestamp,
-                    'category': data_item.get('itemCategory', 'N/A')
-                })
-                st.session_state.last_caption_by_store[store_details_key] = cleaned_text
-            except Exception as e:
-                current_error += f" Caption API error: {str(e)}"
-
-    data_item['analysisError'] = current_error.strip()
+def exec_single_item_generation(index):
+    """Helper function to run caption generation logic for a single item to reduce code duplication."""
+    current_combined_captions = get_combined_captions()
+    data_item = st.session_state.analyzed_image_data_set[index]
+    store_details_key = data_item['selectedStoreKey']
+    reference_caption_for_store = st.session_state.last_caption_by_store.get(store_details_key)
+    usage_before = dict(data_item.get('tokenUsage') or token_usage.empty_usage())
+    try:
+        brain_entry = generate_caption_for_item(
+            get_text_model(), data_item, current_combined_captions,
+            st.session_state.global_selected_tone, reference_caption_for_store,
+            token_budget=caption_prompt_budget()
+        )
+    except CircuitOpenError as e:
+        st.session_state.error_message = f"🔴 {str(e)}"
+        return
+    finally:
+        record_usage_batch(f"single-{data_item['id']}", 'captions',
+                           [(store_details_key, token_usage.subtract_usage(data_item.get('tokenUsage') or {}, usage_before))])
+
+    if brain_entry:
+        # Save to caption brain for future reference
+        save_caption_to_brain(store_details_key, brain_entry)
+        st.session_state.last_caption_by_store[store_details_key] = data_item['generatedCaption']
 
 if __name__ == "__main__":
     main()
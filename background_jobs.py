@@ -0,0 +1,329 @@
+# background_jobs.py
+"""
+Process-level background executor for analysis and batch caption runs.
+
+Jobs run on worker threads shared by every Streamlit session, so a long run keeps going
+while the page reruns and a refreshed page can reattach to it by job id. Workers only
+see plain data (file handles, item copies, settings) and record per-item results on the
+job; the app merges those results into session state when it polls. Nothing in this
+module touches Streamlit.
+"""
+import copy
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import run_control
+import token_usage
+from gemini_services import CircuitOpenError
+from pipeline import (
+    new_analysis_item, analyze_into_item, flyer_into_items, deal_item_id, deal_filename,
+    generate_caption_for_item, serializable_item, caption_inputs
+)
+from response_cache import ResponseCache
+from run_control import RunControl, RunInterrupted, DEFAULT_RETRY_BACKOFF_S
+
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+JOB_TIMED_OUT = "timed out"
+
+ITEM_QUEUED = "queued"
+ITEM_RUNNING = "running"
+ITEM_DONE = "done"
+ITEM_FAILED = "failed"
+ITEM_CANCELLED = "cancelled"
+
+MAX_FINISHED_JOBS = 50  # Finished jobs kept for polling/reattaching before the oldest are dropped
+
+
+class JobContext:
+    """What a task sees of its job: per-item progress reporting and the run's control."""
+
+    def __init__(self, executor, job_id, control):
+        self._executor = executor
+        self.job_id = job_id
+        self.control = control
+
+    def start_item(self, index):
+        self.control.start_item()
+        self._executor._update_item(self.job_id, index, status=ITEM_RUNNING)
+
+    def finish_item(self, index, result, ok=True, resumed=False, status=None):
+        """resumed: the result came from a checkpoint, so none of its token usage was spent in this job."""
+        self._executor._update_item(self.job_id, index, status=status or (ITEM_DONE if ok else ITEM_FAILED),
+                                    result=result, resumed=resumed)
+
+    def stop_reason(self):
+        return "run cancelled" if self.control.cancelled else "job deadline exceeded"
+
+    def notice(self, message):
+        """Job-level message for the UI (e.g. the circuit breaker opened)."""
+        self._executor._update_job(self.job_id, notice=message)
+
+
+class JobExecutor:
+    def __init__(self, max_workers=2):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bg-job")
+        self._jobs = {}
+        self._controls = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, labels, task, job_deadline_s=None, item_deadline_s=None, **job_data):
+        """
+        Queues task(context) as a new job with one progress entry per label.
+        Deadlines (seconds, None for no limit) are enforced through the job's RunControl.
+        job_data is stored on the job as-is (e.g. what a reattaching page needs to restore).
+        Returns the job id.
+        """
+        job = dict(job_data, **{
+            'job_id': uuid.uuid4().hex,
+            'kind': kind,
+            'status': JOB_RUNNING,
+            'created_at': time.time(),
+            'finished_at': None,
+            'first_item_s': None,
+            'resumed': 0,
+            'notice': "",
+            'error': "",
+            'cancel_requested': False,
+            'items': [{'label': label, 'status': ITEM_QUEUED, 'result': None, 'merged': False} for label in labels],
+        })
+        control = RunControl(job_deadline_s=job_deadline_s, item_deadline_s=item_deadline_s)
+        with self._lock:
+            self._jobs[job['job_id']] = job
+            self._controls[job['job_id']] = control
+            self._evict_finished()
+        self._pool.submit(self._run, job['job_id'], task, control)
+        return job['job_id']
+
+    def cancel(self, job_id):
+        """Asks a running job to stop; it finishes with partial results. Returns False if unknown."""
+        with self._lock:
+            control = self._controls.get(job_id)
+            if control is None:
+                return False
+            self._jobs[job_id]['cancel_requested'] = True
+        control.cancel()
+        return True
+
+    def get(self, job_id):
+        """Snapshot of a job (safe to read without locking), or None if unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job else None
+
+    def mark_merged(self, job_id, index):
+        """Records that the app has applied an item's result (so side effects happen once)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job['items'][index]['merged'] = True
+
+    def _run(self, job_id, task, control):
+        try:
+            task(JobContext(self, job_id, control))
+        except Exception as e:
+            self._update_job(job_id, status=JOB_FAILED, error=f"Job failed: {e}", finished_at=time.time())
+        else:
+            status = JOB_DONE
+            if control.cancelled:
+                status = JOB_CANCELLED
+            elif control.stopped():
+                status = JOB_TIMED_OUT
+            self._update_job(job_id, status=status, finished_at=time.time())
+        with self._lock:
+            self._controls.pop(job_id, None)
+
+    def _update_job(self, job_id, **changes):
+        with self._lock:
+            self._jobs[job_id].update(changes)
+
+    def _update_item(self, job_id, index, status, result=None, resumed=False):
+        with self._lock:
+            job = self._jobs[job_id]
+            entry = job['items'][index]
+            entry['status'] = status
+            entry['resumed'] = resumed
+            if result is not None:
+                entry['result'] = result
+            if status in (ITEM_DONE, ITEM_FAILED) and job['first_item_s'] is None:
+                job['first_item_s'] = time.time() - job['created_at']
+            if resumed:
+                job['resumed'] += 1
+
+    def _evict_finished(self):
+        finished = sorted((j for j in self._jobs.values() if j['status'] != JOB_RUNNING), key=lambda j: j['finished_at'])
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job['job_id']]
+
+
+# --- Tasks ---
+def result_items(result):
+    """The items in an analysis job result: one item, or the list of deal items of a flyer."""
+    if not result:
+        return []
+    return result if isinstance(result, list) else [result]
+
+
+def analysis_task(vision_model, blob_store, files, combined_captions, default_store_key, prompt, checkpoints,
+                  retry_attempts=1, retry_backoff_s=DEFAULT_RETRY_BACKOFF_S, flyer_mode=False):
+    """
+    Builds a task that analyzes each file ({name, type, content_hash, blob_id,
+    thumbnail_blob_id, item_id}) into an item. Finished items are checkpointed; the
+    checkpoints are cleared once every file succeeded. An item that runs past its deadline
+    is marked and the run moves on; once the run is cancelled or past its job deadline,
+    the remaining files are marked as not analyzed. Failed analyses are tried up to
+    retry_attempts times with exponential backoff.
+    With flyer_mode, each image is a full-page flyer split into deal items in one call
+    (pipeline.flyer_into_items); its result is the list of those items.
+    """
+    def run(context):
+        run_complete = True
+        for idx, file_info in enumerate(files):
+            is_flyer = flyer_mode and 'video' not in (file_info.get('type') or '')
+            analysis_data_item = new_analysis_item(
+                file_info['item_id'], file_info['name'], file_info['thumbnail_blob_id'],
+                default_store_key, file_info['content_hash']
+            )
+            if context.control.stopped():
+                analysis_data_item['analysisError'] += f"Not analyzed: {context.stop_reason()}. "
+                analysis_data_item['failedStage'] = "analysis"
+                context.finish_item(idx, analysis_data_item, status=ITEM_CANCELLED)
+                run_complete = False
+                continue
+
+            context.start_item(idx)
+            checkpointed_item = checkpoints.get(file_info['content_hash'])
+            if checkpointed_item:
+                if isinstance(checkpointed_item, list):
+                    for deal_index, deal_item in enumerate(checkpointed_item):
+                        deal_item.update(id=deal_item_id(file_info['item_id'], deal_index),
+                                         original_filename=deal_filename(file_info['name'], deal_index))
+                else:
+                    checkpointed_item.update(id=file_info['item_id'], original_filename=file_info['name'],
+                                             preview_blob_id=file_info['thumbnail_blob_id'])
+                context.finish_item(idx, checkpointed_item, resumed=True)
+                continue
+
+            try:
+                file_bytes = blob_store.get(file_info['blob_id'])  # Loaded only for the file being analyzed
+            except KeyError:
+                analysis_data_item['analysisError'] += "Upload data is no longer available. Please re-upload this file. "
+                analysis_data_item['failedStage'] = "analysis"
+                run_complete = False
+                context.finish_item(idx, analysis_data_item, ok=False)
+                continue
+
+            deal_items = []  # A flyer's items once it has been split
+
+            def attempt():
+                # Each attempt starts from a fresh item so notes from failed attempts don't pile up;
+                # the tokens they spent are kept
+                spent = analysis_data_item['tokenUsage']
+                analysis_data_item.update(new_analysis_item(
+                    file_info['item_id'], file_info['name'], file_info['thumbnail_blob_id'],
+                    default_store_key, file_info['content_hash']
+                ), tokenUsage=spent)
+                if is_flyer:
+                    items, ok = flyer_into_items(vision_model, analysis_data_item, file_bytes, file_info.get('type', ''),
+                                                 combined_captions, put_blob=blob_store.put)
+                    deal_items[:] = items if ok else []
+                    return ok
+                return analyze_into_item(vision_model, analysis_data_item, file_bytes, file_info.get('type', ''),
+                                         combined_captions, prompt)
+
+            try:
+                with run_control.active(context.control):
+                    ok = run_control.retry(attempt, retry_attempts, retry_backoff_s)
+            except CircuitOpenError as e:
+                context.notice(str(e))
+                ok = False
+            except RunInterrupted:
+                ok = False  # Already noted in analysisError
+            if deal_items:
+                result = [serializable_item(deal_item) for deal_item in deal_items]
+            else:
+                result = serializable_item(analysis_data_item)
+            if ok:
+                checkpoints.put(file_info['content_hash'], result)
+            else:
+                run_complete = False
+            context.finish_item(idx, result, ok=ok)
+
+        # Keep checkpoints while anything failed so a re-run only redoes the failures
+        if run_complete:
+            checkpoints.clear()
+    return run
+
+
+def caption_checkpoint_key(data_item):
+    return ResponseCache.make_key(data_item.get('content_hash', ''), json.dumps(caption_inputs(data_item), sort_keys=True))
+
+
+def caption_task(text_model, items, combined_captions, tone, reference_by_store, checkpoints,
+                 retry_attempts=1, retry_backoff_s=DEFAULT_RETRY_BACKOFF_S, prompt_token_budget=None):
+    """
+    Builds a task that captions copies of the given items in order (grouped by store by the
+    caller). Each store's latest caption becomes the continuity reference for the next item
+    of that store. Results are {'id', 'generatedCaption', 'analysisError', 'failedStage',
+    'brain_entry', 'usage'}, where usage is the tokens spent on the item in this run. Items left when the run is cancelled or out of time keep their previous
+    caption. Failed captions are tried up to retry_attempts times with exponential backoff.
+    prompt_token_budget caps each caption prompt (see prompt_builder).
+    """
+    items = copy.deepcopy(items)
+    reference_by_store = dict(reference_by_store)
+
+    def run(context):
+        run_complete = True
+        for idx, data_item in enumerate(items):
+            if context.control.stopped():
+                context.finish_item(idx, {'id': data_item['id'], 'generatedCaption': data_item.get('generatedCaption', ''),
+                                          'analysisError': f"{data_item.get('analysisError', '')} Caption skipped: {context.stop_reason()}.".strip(),
+                                          'failedStage': data_item.get('failedStage') or "caption",
+                                          'brain_entry': None, 'usage': token_usage.empty_usage()}, status=ITEM_CANCELLED)
+                run_complete = False
+                continue
+
+            context.start_item(idx)
+            usage_before = dict(data_item.get('tokenUsage') or token_usage.empty_usage())
+            store_key = data_item['selectedStoreKey']
+            checkpoint_key = caption_checkpoint_key(data_item)
+            checkpointed = checkpoints.get(checkpoint_key)
+            brain_entry = None
+            if checkpointed:
+                # Finished in an earlier, interrupted run: reuse instead of re-billing
+                data_item.update(checkpointed)
+            else:
+                def attempt():
+                    return generate_caption_for_item(text_model, data_item, combined_captions, tone,
+                                                     reference_by_store.get(store_key), prompt_token_budget)
+
+                try:
+                    with run_control.active(context.control):
+                        brain_entry = run_control.retry(attempt, retry_attempts, retry_backoff_s)
+                except CircuitOpenError as e:
+                    context.notice(str(e))
+                except RunInterrupted:
+                    pass  # Already noted in analysisError
+                if data_item.get('generatedCaption'):
+                    checkpoints.put(checkpoint_key, {'generatedCaption': data_item['generatedCaption'],
+                                                     'analysisError': data_item.get('analysisError', ''),
+                                                     'failedStage': data_item.get('failedStage', '')})
+                else:
+                    run_complete = False
+            if data_item.get('generatedCaption'):
+                reference_by_store[store_key] = data_item['generatedCaption']
+            context.finish_item(idx, {'id': data_item['id'], 'generatedCaption': data_item.get('generatedCaption', ''),
+                                      'analysisError': data_item.get('analysisError', ''),
+                                      'failedStage': data_item.get('failedStage', ''), 'brain_entry': brain_entry,
+                                      'usage': token_usage.subtract_usage(data_item.get('tokenUsage') or {}, usage_before)},
+                                ok=bool(data_item.get('generatedCaption')), resumed=bool(checkpointed))
+
+        # Keep checkpoints while anything failed so a re-run only redoes the failures
+        if run_complete:
+            checkpoints.clear()
+    return run
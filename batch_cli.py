@@ -0,0 +1,265 @@
+# batch_cli.py
+"""
+Headless batch runner: analyzes a folder of ad images/videos and writes one JSON line
+per item (the app's analysis_data_item shape, including generatedCaption). With --flyer,
+each image is a full-page flyer and gets one line per deal.
+
+Usage:
+    python batch_cli.py ./flyers -o captions.jsonl --workers 4 --resume --cache-dir .cache/analysis
+    python batch_cli.py ./weekly -o deals.jsonl --flyer
+"""
+import argparse
+import json
+import mimetypes
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from constants import TONE_OPTIONS
+from gemini_services import IMAGE_ANALYSIS_PROMPT_TEMPLATE, CircuitOpenError
+from pipeline import (
+    load_custom_stores, combine_captions, new_analysis_item, analyze_into_item, flyer_into_items,
+    analyze_media, analyze_flyer, generate_caption_for_item, serializable_item, ANALYSIS_OUTPUT_FIELDS
+)
+from prompt_builder import DEFAULT_TOKEN_BUDGET, parse_prompt_budget
+from roi_crop import ROI_MODES, ROI_POLICY, configure_roi_policy
+from response_cache import ResponseCache
+import token_usage
+from run_control import retry, DEFAULT_RETRY_ATTEMPTS, DEFAULT_RETRY_BACKOFF_S
+from utils import content_hash
+
+CUSTOM_STORES_FILE = "custom_stores.json"
+SUPPORTED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".mp4", ".mov", ".avi"}
+
+
+def find_media_files(input_dir, recursive=False):
+    """Returns supported media files under input_dir, sorted for a stable item order."""
+    found = []
+    for root, dirs, files in os.walk(input_dir):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS:
+                found.append(os.path.join(root, name))
+        if not recursive:
+            break
+    return sorted(found)
+
+
+def load_completed_paths(output_path):
+    """Source paths already written to an existing output file (for --resume)."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                completed.add(json.loads(line)['source_path'])
+            except (ValueError, KeyError):
+                continue  # A truncated last line from an interrupted run is simply redone
+    return completed
+
+
+def make_cached_analyze_fn(cache, analyze=analyze_media):
+    """Wraps analyze (analyze_media or analyze_flyer) so raw analysis text is cached by content hash + prompt + model."""
+    def cached_analyze(vision_model, file_bytes, file_type, prompt):
+        key = ResponseCache.make_key(file_bytes, prompt, getattr(vision_model, 'model_name', ''), ROI_POLICY['mode'])
+        cached_text = cache.get(key)
+        if cached_text is not None:
+            return cached_text
+        analysis_text = analyze(vision_model, file_bytes, file_type, prompt)
+        cache.put(key, analysis_text)
+        return analysis_text
+    return cached_analyze
+
+
+class BatchRunner:
+    """Runs analysis + caption generation for single files; safe to call from worker threads."""
+
+    def __init__(self, vision_model, text_model, combined_captions, default_store_key, tone,
+                 generate_captions=True, analyze_fn=None, prompt_token_budget=None, flyer_mode=False):
+        self.vision_model = vision_model
+        self.text_model = text_model
+        self.combined_captions = combined_captions
+        self.default_store_key = default_store_key
+        self.tone = tone
+        self.generate_captions = generate_captions
+        self.analyze_fn = analyze_fn
+        self.prompt_token_budget = prompt_token_budget
+        self.flyer_mode = flyer_mode  # analyze_fn then wraps analyze_flyer
+        self.last_caption_by_store = {}
+        self._lock = threading.Lock()
+
+    def process_file(self, idx, path):
+        """The items for one file: one, or one per deal for an image in flyer mode."""
+        with open(path, 'rb') as f:
+            file_bytes = f.read()
+        file_type = mimetypes.guess_type(path)[0] or ''
+        if self.flyer_mode and 'video' not in file_type:
+            items = self.process_flyer_bytes(idx, os.path.basename(path), file_type, file_bytes)
+        else:
+            items = [self.process_bytes(idx, os.path.basename(path), file_type, file_bytes)]
+        for item in items:
+            item['source_path'] = path
+        return items
+
+    def process_bytes(self, idx, name, file_type, file_bytes):
+        """Analyzes (and optionally captions) one upload; returns a JSON-serializable item."""
+        item = new_analysis_item(f"file-{name}-{idx}", name, None, self.default_store_key, content_hash(file_bytes))
+        analyze_into_item(self.vision_model, item, file_bytes, file_type, self.combined_captions,
+                          IMAGE_ANALYSIS_PROMPT_TEMPLATE, analyze_fn=self.analyze_fn)
+
+        if self.generate_captions:
+            self._caption(item)
+
+        return serializable_item(item)
+
+    def process_flyer_bytes(self, idx, name, file_type, file_bytes):
+        """Splits a full-page flyer into deal items in one analysis call (and captions each); returns them."""
+        flyer_item = new_analysis_item(f"file-{name}-{idx}", name, None, self.default_store_key, content_hash(file_bytes))
+        items, _ = flyer_into_items(self.vision_model, flyer_item, file_bytes, file_type, self.combined_captions,
+                                    analyze_fn=self.analyze_fn)
+
+        if self.generate_captions:
+            for item in items:
+                if not item['failedStage']:
+                    self._caption(item)
+        return [serializable_item(item) for item in items]
+
+    def retry_item(self, item, file_type, file_bytes, attempts=DEFAULT_RETRY_ATTEMPTS, backoff_s=DEFAULT_RETRY_BACKOFF_S):
+        """
+        Redoes only the failed stage of a finished item, with backoff between attempts:
+        a failed analysis (then its caption), or just a failed caption. Returns the updated item.
+        A flyer deal never fails analysis (a failed flyer stays one item), so only its caption is
+        redone here; a failed flyer is analyzed again with process_flyer_bytes, never as one item.
+        """
+        item = dict(item, tokenUsage=dict(item.get('tokenUsage') or token_usage.empty_usage()))
+        if item.get('failedStage') == "analysis":
+            if 'dealBox' in item or (self.flyer_mode and 'video' not in (file_type or '')):
+                # A single-item analysis of the whole page would replace the deals
+                raise ValueError(f"'{item['original_filename']}' is a flyer; analyze it again with process_flyer_bytes.")
+            retried = {'tokenUsage': token_usage.empty_usage()}
+
+            def attempt():
+                retried.update(new_analysis_item(item['id'], item['original_filename'], item.get('preview_blob_id'),
+                                                 self.default_store_key, item.get('content_hash')),
+                               tokenUsage=retried['tokenUsage'])  # Failed attempts were billed too
+                return analyze_into_item(self.vision_model, retried, file_bytes, file_type, self.combined_captions,
+                                         IMAGE_ANALYSIS_PROMPT_TEMPLATE, analyze_fn=self.analyze_fn)
+
+            recovered = retry(attempt, attempts, backoff_s)
+            # Another failure only updates the notes; the other fields stay as they were
+            item.update({field: retried[field] for field in (ANALYSIS_OUTPUT_FIELDS if recovered else ['analysisError', 'failedStage'])})
+            token_usage.add_usage(item['tokenUsage'], retried['tokenUsage'])
+            if not recovered:
+                return serializable_item(item)
+
+        if self.generate_captions:
+            self._caption(item, attempts, backoff_s)
+        return serializable_item(item)
+
+    def _caption(self, item, attempts=1, backoff_s=DEFAULT_RETRY_BACKOFF_S):
+        store_key = item['selectedStoreKey']
+        with self._lock:
+            reference_caption = self.last_caption_by_store.get(store_key)
+        if retry(lambda: generate_caption_for_item(self.text_model, item, self.combined_captions, self.tone, reference_caption,
+                                                   self.prompt_token_budget),
+                 attempts, backoff_s):
+            with self._lock:
+                self.last_caption_by_store[store_key] = item['generatedCaption']
+
+
+def main(argv=None):
+    tone_values = [t['value'] for t in TONE_OPTIONS]
+    parser = argparse.ArgumentParser(description="Analyze a folder of grocery ads and write captions as JSONL.")
+    parser.add_argument("input_dir", help="Folder of images/videos")
+    parser.add_argument("-o", "--output", required=True, help="Output JSONL path")
+    parser.add_argument("--workers", type=int, default=4, help="Files processed concurrently (default: 4)")
+    parser.add_argument("--resume", action="store_true", help="Skip files already present in the output file and append")
+    parser.add_argument("--cache-dir", help="Cache raw analysis responses here, keyed by content hash")
+    parser.add_argument("--recursive", action="store_true", help="Also scan sub-folders")
+    parser.add_argument("--no-captions", action="store_true", help="Only analyze; skip caption generation")
+    parser.add_argument("--tone", default=tone_values[0] if tone_values else None, choices=tone_values)
+    parser.add_argument("--store", help="Fallback store key when the store can't be detected")
+    parser.add_argument("--custom-stores", default=CUSTOM_STORES_FILE, help="Custom store definitions JSON")
+    parser.add_argument("--roi", choices=ROI_MODES, default=ROI_POLICY['mode'],
+                        help="Send images as text-region crops: one 'composite', or a small 'overview' plus crops (default: off)")
+    parser.add_argument("--flyer", action="store_true",
+                        help="Treat images as full-page flyers: one analysis call, one output line per deal")
+    parser.add_argument("--prompt-budget", type=int, default=DEFAULT_TOKEN_BUDGET,
+                        help=f"Estimated tokens per caption prompt; style references are shortened to fit (default: {DEFAULT_TOKEN_BUDGET})")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"{args.input_dir} is not a directory")
+    try:
+        args.prompt_budget = parse_prompt_budget(args.prompt_budget)
+    except ValueError as e:
+        parser.error(str(e))
+    configure_roi_policy(mode=args.roi)
+
+    combined_captions = combine_captions(load_custom_stores(args.custom_stores))
+    default_store_key = args.store or (list(combined_captions.keys())[0] if combined_captions else None)
+    if default_store_key not in combined_captions:
+        parser.error(f"Unknown store key '{default_store_key}'. Choose from: {', '.join(combined_captions)}")
+
+    paths = find_media_files(args.input_dir, args.recursive)
+    completed = load_completed_paths(args.output) if args.resume else set()
+    pending = [(idx, path) for idx, path in enumerate(paths) if path not in completed]
+    print(f"{len(paths)} file(s) found, {len(paths) - len(pending)} already done, {len(pending)} to process.", file=sys.stderr)
+    if not pending:
+        return 0
+
+    from config import get_models
+    try:
+        vision_model, text_model = get_models()
+    except Exception as e:
+        print(f"Gemini models not available: {e}", file=sys.stderr)
+        return 2
+
+    analyze_fn = None
+    if args.cache_dir:
+        analyze_fn = make_cached_analyze_fn(ResponseCache(args.cache_dir), analyze_flyer if args.flyer else analyze_media)
+    runner = BatchRunner(vision_model, text_model, combined_captions, default_store_key, args.tone,
+                         generate_captions=not args.no_captions, analyze_fn=analyze_fn,
+                         prompt_token_budget=args.prompt_budget, flyer_mode=args.flyer)
+
+    done_count, skipped_count, written_count = 0, 0, 0
+    run_usage = token_usage.empty_usage()
+    with open(args.output, 'a' if args.resume else 'w', encoding='utf-8') as out, \
+         ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {executor.submit(runner.process_file, idx, path): path for idx, path in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                items = future.result()
+            except CircuitOpenError as e:
+                # Not written, so a --resume run picks it up once the API recovers
+                skipped_count += 1
+                print(f"SKIPPED {path}: {e}", file=sys.stderr)
+                continue
+            except Exception as e:
+                skipped_count += 1
+                print(f"FAILED {path}: {e}", file=sys.stderr)
+                continue
+            for item in items:
+                out.write(json.dumps(item, ensure_ascii=False) + "\n")
+                token_usage.add_usage(run_usage, item.get('tokenUsage'))
+            out.flush()  # Each file's lines are durable as soon as it finishes
+            done_count += 1
+            written_count += len(items)
+            notes = [item['analysisError'] for item in items if item['analysisError']]
+            status = f"note: {' | '.join(notes)}" if notes else "ok"
+            if len(items) > 1:
+                status = f"{len(items)} deals, {status}"
+            print(f"[{done_count}/{len(pending)}] {path} ({status})", file=sys.stderr)
+
+    print(f"Wrote {written_count} item(s) from {done_count} file(s) to {args.output}; {skipped_count} skipped. "
+          f"Used {token_usage.format_usage(run_usage)}.", file=sys.stderr)
+    return 1 if skipped_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
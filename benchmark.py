@@ -0,0 +1,330 @@
+# benchmark.py
+"""
+Offline benchmark for the analysis and caption pipelines, using the stub model instead of
+Gemini (no API key, no network). Each workload runs the real pipeline code (call policy,
+parsing, caption prompts) over 1..N synthetic items and reports throughput, per-item
+latency percentiles and peak traced memory.
+
+Workloads:
+    image     analyze_into_item on a synthetic flyer JPEG, once per --roi mode
+    video     analyze_into_item on a synthetic MP4 (one model call per sampled frame)
+    flyer     flyer_into_items on the flyer JPEG: one call answered with --flyer-deals deals,
+              each cropped into its own item (compare with --sizes N image items)
+    captions  generate_caption_for_item on analyzed items, with per-store continuity
+
+Usage:
+    python benchmark.py                                  # all workloads at 1, 10, 100, 1000 items
+    python benchmark.py --workloads image captions --sizes 10 100 --latency-ms 200 --latency-dist lognormal
+    python benchmark.py --error-rate 0.02 --partial-rate 0.3 --workers 8 --json bench.json
+    python benchmark.py --sizes 100 --metrics stages.prom     # per-stage timings (.prom or .json)
+    python benchmark.py --workloads image --partial-rate 0.2 --escalate   # cheap-first escalation
+    python benchmark.py --workloads image --sizes 100 --roi off composite overview   # ROI payload vs recall
+    python benchmark.py --workloads image video --no-passthrough   # PIL decode + SDK re-encode, for comparison
+    python benchmark.py --workloads image flyer --sizes 20 1 --flyer-deals 20   # 20 single ads vs one 20-deal flyer
+    python benchmark.py --workloads image --sizes 100 --workers 8 --coalesce   # identical ads share in-flight calls
+
+Every item of a workload sends identical bytes, so request coalescing (see gemini_services)
+is off unless --coalesce is given; otherwise concurrent items would share calls and the
+per-item numbers would not be comparable.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from constants import TONE_OPTIONS
+from gemini_services import IMAGE_ANALYSIS_PROMPT_TEMPLATE, configure_call_policy, get_call_stats, reset_call_state
+from model_routing import VisionRoute
+from roi_crop import ROI_MODES, configure_roi_policy, estimate_image_tokens, prepare_image
+from pipeline import (
+    load_custom_stores, combine_captions, new_analysis_item, analyze_into_item, flyer_into_items,
+    apply_analysis_text, generate_caption_for_item
+)
+from stub_model import StubModel, LATENCY_DISTRIBUTIONS, DEFAULT_ANALYSIS_TEXT, DEFAULT_FLYER_DEALS
+from utils import content_hash
+
+CUSTOM_STORES_FILE = "custom_stores.json"
+WORKLOADS = ("image", "video", "flyer", "captions")
+DEFAULT_SIZES = [1, 10, 100, 1000]
+
+
+# --- Synthetic inputs ---
+FLYER_TEXT = (  # (text, font size, position, color): product, price and dates blocks
+    ("FRESH EGGPLANT", 80, (60, 60), (20, 20, 20)),
+    ("79¢ / lb.", 120, (60, 1040), (200, 0, 0)),
+    ("3 DAYS ONLY 05/13 - 05/15", 44, (60, 1220), (0, 0, 0)),
+)
+
+
+def make_flyer(size=(1080, 1350)):
+    """
+    A flyer-like JPEG: a product photo stand-in (blurred noise) between text blocks.
+    Returns (jpeg bytes, [(x, y, w, h) of each text block]) so ROI crops can be scored.
+    """
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont
+    image = Image.new("RGB", size, (250, 250, 245))
+    photo = Image.fromarray((np.random.default_rng(7).random((680, size[0] - 80, 3)) * 255).astype(np.uint8))
+    image.paste(photo.filter(ImageFilter.GaussianBlur(12)), (40, 300))
+    draw = ImageDraw.Draw(image)
+    text_boxes = []
+    for text, font_size, position, color in FLYER_TEXT:
+        font = ImageFont.load_default(size=font_size)
+        draw.text(position, text, fill=color, font=font)
+        x0, y0, x1, y1 = draw.textbbox(position, text, font=font)
+        text_boxes.append((x0, y0, x1 - x0, y1 - y0))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue(), text_boxes
+
+
+def roi_stats(image_bytes, text_boxes, mode):
+    """
+    Estimated image tokens sent for the flyer in an ROI mode, and text recall: the share of
+    text blocks at least 90% inside the crops. The stub can't read, so recall stands
+    in for the accuracy a real model could reach (the full image has recall 1.0).
+    """
+    import numpy as np
+    from PIL import Image
+    payload = prepare_image(image_bytes, mode) if mode != "off" else None
+    if payload is None:
+        width, height = Image.open(io.BytesIO(image_bytes)).size
+        return {'image_tokens': estimate_image_tokens(width, height), 'text_recall': 1.0}
+    covered = np.zeros((max(y + h for _, y, _, h in text_boxes + payload['regions']) + 1,
+                        max(x + w for x, _, w, _ in text_boxes + payload['regions']) + 1), dtype=bool)
+    for x, y, w, h in payload['regions']:
+        covered[y:y + h, x:x + w] = True
+    found = sum(1 for x, y, w, h in text_boxes if covered[y:y + h, x:x + w].mean() >= 0.9)
+    return {'image_tokens': payload['tokens'], 'text_recall': round(found / len(text_boxes), 2)}
+
+
+def make_video_bytes(seconds=5, fps=10, size=(320, 320)):
+    """A short MP4 (one analyzed frame per second); returns None if OpenCV can't encode it."""
+    import cv2
+    import numpy as np
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_video_file:
+        video_filename = temp_video_file.name
+    try:
+        writer = cv2.VideoWriter(video_filename, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+        for n in range(seconds * fps):
+            frame = np.full((size[1], size[0], 3), (n * 5) % 255, dtype=np.uint8)
+            writer.write(frame)
+        writer.release()
+        with open(video_filename, 'rb') as f:
+            video_bytes = f.read()
+    finally:
+        os.unlink(video_filename)
+    return video_bytes or None
+
+
+def make_caption_items(count, combined_captions, default_store_key):
+    items = []
+    for idx in range(count):
+        item = new_analysis_item(f"bench-{idx}", f"bench-{idx}.jpg", None, default_store_key)
+        apply_analysis_text(item, DEFAULT_ANALYSIS_TEXT, combined_captions)
+        items.append(item)
+    return items
+
+
+# --- Measurement ---
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list (0.0 if empty)."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def run_workload(name, count, model, workers, combined_captions, default_store_key, media, tone, escalation_model=None):
+    """Runs one workload over count items; returns a result row. escalation_model is the stronger analysis model, if any."""
+    if name == "captions":
+        items = make_caption_items(count, combined_captions, default_store_key)
+        last_caption_by_store = {}
+        lock = threading.Lock()
+
+        def process(idx):
+            item = items[idx]
+            with lock:
+                reference_caption = last_caption_by_store.get(item['selectedStoreKey'])
+            if generate_caption_for_item(model, item, combined_captions, tone, reference_caption):
+                with lock:
+                    last_caption_by_store[item['selectedStoreKey']] = item['generatedCaption']
+                return True
+            return False
+    elif name == "flyer":
+        file_bytes, file_type = media["image"]
+        deal_counts = []
+
+        def process(idx):
+            item = new_analysis_item(f"bench-{idx}", f"bench-{idx}", None, default_store_key)
+            # Crops are hashed like the blob store would, without writing them to disk
+            items, ok = flyer_into_items(model, item, file_bytes, file_type, combined_captions, put_blob=content_hash)
+            deal_counts.append(len(items) if ok else 0)
+            return ok
+    else:
+        file_bytes, file_type = media[name]
+        vision_model = VisionRoute(model, escalation_model=escalation_model) if escalation_model else model
+
+        def process(idx):
+            item = new_analysis_item(f"bench-{idx}", f"bench-{idx}", None, default_store_key)
+            return analyze_into_item(vision_model, item, file_bytes, file_type, combined_captions, IMAGE_ANALYSIS_PROMPT_TEMPLATE)
+
+    def timed(idx):
+        start = time.perf_counter()
+        try:
+            ok = process(idx)
+        except Exception:
+            ok = False  # e.g. CircuitOpenError once injected errors open the breaker
+        return time.perf_counter() - start, ok
+
+    # Warm-up outside the measurement, so first-use imports (PIL, OpenCV) aren't counted
+    try:
+        process(0)
+    except Exception:
+        pass
+    if name == "captions":
+        last_caption_by_store.clear()
+    if name == "flyer":
+        deal_counts.clear()
+
+    reset_call_state()
+    calls_before = model.call_count
+    bytes_before = model.bytes_sent
+    escalations_before = escalation_model.call_count if escalation_model else 0
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        outcomes = list(executor.map(timed, range(count)))
+    wall_s = time.perf_counter() - started
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = sorted(latency for latency, _ in outcomes)
+    call_stats = get_call_stats()
+    calls = model.call_count - calls_before
+    return {
+        'workload': name,
+        'items': count,
+        'workers': workers,
+        'wall_s': round(wall_s, 3),
+        'items_per_s': round(count / wall_s, 2) if wall_s else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'peak_mem_mb': round(peak_bytes / (1024 * 1024), 2),
+        'failed_items': sum(1 for _, ok in outcomes if not ok),
+        'model_calls': calls,
+        'escalations': (escalation_model.call_count if escalation_model else 0) - escalations_before,
+        'hedges_fired': call_stats['hedges_fired'],
+        'circuit_rejections': call_stats['circuit_rejections'],
+        'coalesced': call_stats['coalesced'],
+        # Serialized image KB per model call, as the stub receives it
+        'payload_kb': round((model.bytes_sent - bytes_before) / calls / 1024, 1) if name != "captions" and calls else "",
+        'roi': "", 'image_tokens': "", 'text_recall': "",
+        'deals': sum(deal_counts) if name == "flyer" else "",
+    }
+
+
+def format_table(rows):
+    columns = ['workload', 'roi', 'items', 'items_per_s', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_mem_mb',
+               'failed_items', 'deals', 'model_calls', 'escalations', 'hedges_fired', 'coalesced', 'payload_kb', 'image_tokens',
+               'text_recall', 'wall_s']
+    widths = {c: max(len(c), *(len(str(row[c])) for row in rows)) for c in columns}
+    lines = ["  ".join(c.rjust(widths[c]) for c in columns)]
+    lines += ["  ".join(str(row[c]).rjust(widths[c]) for c in columns) for row in rows]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    tone_values = [t['value'] for t in TONE_OPTIONS]
+    parser = argparse.ArgumentParser(description="Offline benchmark of analysis and captioning with a stub model.")
+    parser.add_argument("--workloads", nargs="+", default=list(WORKLOADS), choices=WORKLOADS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="Item counts (default: 1 10 100 1000)")
+    parser.add_argument("--workers", type=int, default=4, help="Items processed concurrently (default: 4)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Typical stub model latency per call")
+    parser.add_argument("--latency-dist", default="lognormal", choices=LATENCY_DISTRIBUTIONS)
+    parser.add_argument("--latency-spread", type=float, default=0.5, help="Uniform +/- fraction or lognormal sigma")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of model calls that fail")
+    parser.add_argument("--partial-rate", type=float, default=0.0, help="Share of analyses missing fields (more video frames)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--roi", nargs="+", default=["off"], choices=ROI_MODES,
+                        help="ROI crop modes to run the image workload with (default: off)")
+    parser.add_argument("--flyer-deals", type=int, default=DEFAULT_FLYER_DEALS,
+                        help=f"Deals the stub finds on each flyer in the flyer workload (default: {DEFAULT_FLYER_DEALS})")
+    parser.add_argument("--escalate", action="store_true",
+                        help="Route incomplete analyses to a second, slower stub model (see model_routing)")
+    parser.add_argument("--escalation-latency-factor", type=float, default=3.0,
+                        help="Escalation model latency relative to --latency-ms (default: 3)")
+    parser.add_argument("--no-hedging", action="store_true", help="Disable request hedging during the run")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="Let concurrent identical requests share one model call (the app's default)")
+    parser.add_argument("--no-passthrough", action="store_true",
+                        help="Decode images with PIL and let the SDK re-encode them, instead of sending the bytes as-is")
+    parser.add_argument("--tone", default=tone_values[0] if tone_values else None, choices=tone_values)
+    parser.add_argument("--custom-stores", default=CUSTOM_STORES_FILE)
+    parser.add_argument("--json", help="Also write the result rows to this JSON file")
+    parser.add_argument("--metrics", help="Write per-stage timings of all runs here (Prometheus text for .prom, else JSON)")
+    args = parser.parse_args(argv)
+
+    if args.no_hedging:
+        configure_call_policy(hedging_enabled=False)
+    if args.no_passthrough:
+        configure_call_policy(image_passthrough=False)
+    configure_call_policy(coalescing_enabled=args.coalesce)
+    combined_captions = combine_captions(load_custom_stores(args.custom_stores))
+    default_store_key = list(combined_captions.keys())[0] if combined_captions else None
+
+    media = {}
+    if "image" in args.workloads or "flyer" in args.workloads:
+        flyer_bytes, flyer_text_boxes = make_flyer()
+        media["image"] = (flyer_bytes, "image/jpeg")
+    if "video" in args.workloads:
+        video_bytes = make_video_bytes()
+        if video_bytes is None:
+            print("Skipping the video workload: OpenCV could not encode a test video.", file=sys.stderr)
+            args.workloads = [w for w in args.workloads if w != "video"]
+        else:
+            media["video"] = (video_bytes, "video/mp4")
+
+    metrics.reset()
+    rows = []
+    runs = [(workload, roi_mode) for workload in args.workloads
+            for roi_mode in (args.roi if workload == "image" else [None])]
+    for workload, roi_mode in runs:
+        configure_roi_policy(mode=roi_mode or "off")
+        for count in args.sizes:
+            # A fresh, identically seeded model per run keeps runs comparable
+            model = StubModel(latency_s=args.latency_ms / 1000, latency_dist=args.latency_dist,
+                              latency_spread=args.latency_spread, error_rate=args.error_rate,
+                              partial_rate=args.partial_rate, seed=args.seed, flyer_deals=args.flyer_deals)
+            escalation_model = None
+            if args.escalate:
+                escalation_model = StubModel(model_name="stub-strong-model", seed=args.seed + 1,
+                                             latency_s=args.latency_ms * args.escalation_latency_factor / 1000,
+                                             latency_dist=args.latency_dist, latency_spread=args.latency_spread)
+            print(f"Running {workload} x {count}...", file=sys.stderr)
+            row = run_workload(workload, count, model, args.workers, combined_captions,
+                               default_store_key, media, args.tone, escalation_model)
+            if roi_mode:
+                row.update(roi=roi_mode, **roi_stats(flyer_bytes, flyer_text_boxes, roi_mode))
+            rows.append(row)
+    configure_roi_policy(mode="off")
+
+    print(format_table(rows))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'settings': vars(args), 'results': rows}, f, indent=2)
+    if args.metrics:
+        metrics.write_snapshot(args.metrics)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
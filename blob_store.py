@@ -0,0 +1,68 @@
+# blob_store.py
+"""
+Content-addressed blob store on local disk.
+
+Upload bytes (and generated thumbnails) are written once under their content hash and
+referenced everywhere else by that id, so session state only holds small handles and
+identical uploads from different sessions share one file. Bytes are read back on demand.
+"""
+import os
+import tempfile
+import time
+
+from utils import content_hash
+
+DEFAULT_MAX_AGE_S = 7 * 24 * 3600  # Blobs untouched for a week are pruned
+
+
+class BlobStore:
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def path(self, blob_id):
+        # Two-level fan-out keeps directories small with thousands of uploads
+        return os.path.join(self.root_dir, blob_id[:2], blob_id)
+
+    def put(self, data):
+        """Stores bytes (if not already present) and returns their blob id."""
+        blob_id = content_hash(data)
+        blob_path = self.path(blob_id)
+        if os.path.exists(blob_path):
+            os.utime(blob_path)  # Refresh so pruning keeps blobs that are still in use
+            return blob_id
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, blob_path)
+        return blob_id
+
+    def get(self, blob_id):
+        """Reads a blob's bytes. Raises KeyError if it does not exist."""
+        try:
+            with open(self.path(blob_id), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(f"Blob '{blob_id}' not found.")
+
+    def exists(self, blob_id):
+        return bool(blob_id) and os.path.exists(self.path(blob_id))
+
+    def size(self, blob_id):
+        return os.path.getsize(self.path(blob_id))
+
+    def prune(self, max_age_s=DEFAULT_MAX_AGE_S):
+        """Deletes blobs not written or re-uploaded within max_age_s. Returns the number removed."""
+        cutoff = time.time() - max_age_s
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root_dir):
+            for name in filenames:
+                blob_path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(blob_path) < cutoff:
+                        os.unlink(blob_path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+        return removed
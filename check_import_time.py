@@ -0,0 +1,78 @@
+# check_import_time.py
+"""
+Startup budget check. Imports the app in a fresh interpreter with `python -X importtime`
+and fails if the cumulative import time exceeds the budget, or if any of the heavy
+dependencies that are supposed to be loaded lazily show up at import time.
+
+Usage:
+    python check_import_time.py                 # default budget
+    python check_import_time.py --budget-ms 500 --runs 5
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+DEFAULT_BUDGET_MS = 750
+# Modules that must only be imported on first use, never at app import time.
+DEFERRED_MODULES = ["cv2", "google.generativeai", "dateutil", "PIL"]
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def measure_import(module_name):
+    """Runs one fresh import and returns (cumulative_us, set of imported module names)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing '{module_name}' failed:\n{result.stderr[-2000:]}")
+
+    cumulative_us = None
+    imported = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        name = match.group(4)
+        imported.add(name)
+        if name == module_name and len(match.group(3)) <= 1:  # Top-level entry for the module itself
+            cumulative_us = int(match.group(2))
+    if cumulative_us is None:
+        raise RuntimeError(f"No importtime entry found for '{module_name}'.")
+    return cumulative_us, imported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fail if app import time exceeds the startup budget.")
+    parser.add_argument("--module", default="app", help="Module to import (default: app)")
+    parser.add_argument("--budget-ms", type=float, default=float(os.environ.get("IMPORT_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    parser.add_argument("--runs", type=int, default=3, help="Best of N runs is compared to the budget")
+    args = parser.parse_args(argv)
+
+    timings_ms = []
+    eager_heavy = set()
+    for _ in range(max(1, args.runs)):
+        cumulative_us, imported = measure_import(args.module)
+        timings_ms.append(cumulative_us / 1000)
+        eager_heavy |= {m for m in DEFERRED_MODULES if m in imported}
+
+    best_ms = min(timings_ms)
+    print(f"import {args.module}: best {best_ms:.0f} ms over {len(timings_ms)} run(s) (budget {args.budget_ms:.0f} ms)")
+
+    failed = False
+    if eager_heavy:
+        print(f"FAIL: deferred module(s) imported eagerly: {', '.join(sorted(eager_heavy))}")
+        failed = True
+    if best_ms > args.budget_ms:
+        print(f"FAIL: import time {best_ms:.0f} ms exceeds budget of {args.budget_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+# checkpoints.py
+"""
+Per-run checkpoints for long analysis and batch caption runs.
+
+A run is identified by a hash of its inputs (content hashes of the files involved and
+the settings that affect the output), so re-running the same batch after a crash or a
+lost session finds the same checkpoint directory and skips items that already finished.
+Each item is written as soon as it completes; the directory is removed once the run
+finishes, so a deliberate re-run later starts fresh.
+"""
+import json
+import os
+import shutil
+
+from response_cache import ResponseCache
+
+
+def make_run_id(kind, content_hashes, settings):
+    """Stable id for a run: the kind ('analysis'/'captions'), its inputs and settings."""
+    return f"{kind}-{ResponseCache.make_key(*sorted(content_hashes), json.dumps(settings, sort_keys=True))}"
+
+
+class CheckpointStore:
+    def __init__(self, root_dir, run_id):
+        self.run_dir = os.path.join(root_dir, run_id)
+        self._cache = ResponseCache(self.run_dir)
+
+    def get(self, item_key):
+        text = self._cache.get(item_key)
+        if text is None:
+            return None
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None  # Treat a damaged checkpoint as missing; the item is simply redone
+
+    def put(self, item_key, data):
+        self._cache.put(item_key, json.dumps(data, ensure_ascii=False))
+
+    def count(self):
+        return sum(1 for name in os.listdir(self.run_dir) if name.endswith(".txt"))
+
+    def clear(self):
+        shutil.rmtree(self.run_dir, ignore_errors=True)
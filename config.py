@@ -1,56 +1,81 @@
 # config.py
-import streamlit as st
 import os
+import functools
+import tomllib
 from dotenv import load_dotenv
-import google.generativeai as genai
 
-def load_and_configure_api():
+from model_routing import VisionRoute, model_names_from_env, escalation_min_score_from_env
+
+# NOTE: google.generativeai is imported inside load_and_configure_api() rather than
+# at module top. The SDK is slow to import and nothing needs it before the first
+# Gemini call, so deferring it keeps it off the cold-start path.
+# Nothing here uses Streamlit, so batch_cli.py and job_server.py can load the models
+# headless; app.py shows configuration errors itself.
+
+# Where Streamlit keeps secrets: the project's folder first, then the user's
+SECRETS_FILES = [os.path.join(".streamlit", "secrets.toml"), os.path.join(os.path.expanduser("~"), ".streamlit", "secrets.toml")]
+MISSING_KEY_MESSAGE = ("GEMINI_API_KEY not found. Please set it in Streamlit secrets (for deployment) "
+                       "or in a .env file / environment variable (for local development).")
+
+def read_secret(name, secrets_files=None):
+    """The value of `name` in the first Streamlit secrets file that has it, else None."""
+    for path in secrets_files or SECRETS_FILES:
+        try:
+            with open(path, 'rb') as f:
+                value = tomllib.load(f).get(name)
+        except (OSError, tomllib.TOMLDecodeError):
+            continue
+        if value:
+            return value
+    return None
+
+def load_api_key():
     """
-    Loads API key and configures the Gemini API.
-    Prioritizes Streamlit secrets for deployment,
+    Loads the Gemini API key.
+    Prioritizes Streamlit secrets files (.streamlit/secrets.toml) for deployment,
     then .env file for local development,
     and finally direct environment variables.
+    Returns None if no key is set.
     """
-    api_key = None
-
-    # 1. Try to get the API key from Streamlit secrets (for deployed app)
-    try:
-        # Check if we are in a Streamlit Cloud environment
-        # A more robust check might involve specific environment variables set by Streamlit Cloud
-        # For now, st.secrets.get is the primary method.
-        if hasattr(st, 'secrets'): # Check if st.secrets exists
-            api_key = st.secrets.get("GEMINI_API_KEY")
-    except Exception: # Handle cases where st.secrets might not be available or configured
-        pass
-
-    # 2. If not found in Streamlit secrets, try .env file (for local development)
+    api_key = read_secret("GEMINI_API_KEY")
     if not api_key:
         load_dotenv()
-        api_key = os.getenv("GEMINI_API_KEY")
-
-    # 3. (Optional) As a final fallback, check direct environment variable
-    # This is redundant if load_dotenv worked, but good for other environments
-    if not api_key:
         api_key = os.environ.get("GEMINI_API_KEY")
+    return api_key or None
 
-
+def load_and_configure_api():
+    """
+    Loads the API key and configures the Gemini API.
+    Returns (VisionRoute, text_model) using the per-stage model names from model_routing.
+    Raises RuntimeError if the key is missing or the API cannot be configured.
+    """
+    api_key = load_api_key()
     if not api_key:
-        st.error("🔴 GEMINI_API_KEY not found. Please set it in Streamlit secrets (for deployment) or in a .env file / environment variable (for local development).")
-        st.info("For local development, create a `.env` file in the project root with `GEMINI_API_KEY='your_key_here'`.")
-        st.info("For Streamlit Cloud deployment, add it to your app's secrets in the Streamlit dashboard.")
-        st.stop()
-        return None, None
+        raise RuntimeError(MISSING_KEY_MESSAGE)
 
     try:
+        import google.generativeai as genai
         genai.configure(api_key=api_key)
-        vision_model = genai.GenerativeModel('gemini-flash-lite-latest')
-        text_model = genai.GenerativeModel('gemini-flash-lite-latest')
-        # You could add a small success message here if running locally and key is found
-        # st.sidebar.success("Gemini API configured successfully.") # Example
+        model_names = get_model_names()
+        models = {name: genai.GenerativeModel(name) for name in set(model_names.values()) if name}
+        vision_model = VisionRoute(models[model_names['image_analysis']], models[model_names['frame_scoring']],
+                                   models.get(model_names['escalation']), escalation_min_score_from_env())
+        text_model = models[model_names['caption']]
         return vision_model, text_model
     except Exception as e:
-        st.error(f"🔴 Error configuring Gemini API: {e}. Please check your API key and network connection.")
-        st.stop()
-        return None, None
+        raise RuntimeError(f"Error configuring Gemini API: {e}. Please check your API key and network connection.") from e
+
+def get_model_names():
+    """Per-stage model names (see model_routing); read from .env too, even when the key comes from secrets."""
+    load_dotenv()
+    return model_names_from_env()
 
-VISION_MODEL, TEXT_MODEL = load_and_configure_api()
+@functools.lru_cache(maxsize=1)
+def get_models():
+    """
+    Returns (vision_model, text_model), configuring the API on first use. vision_model is a
+    model_routing.VisionRoute; pipeline functions accept it wherever a vision model is expected.
+    Cached for the life of the process; a failed configuration raises RuntimeError and is
+    not cached, so the next call retries.
+    """
+    return load_and_configure_api()
@@ -1,7 +1,297 @@
 # gemini_services.py
-from PIL import Image
+import hashlib
 import io
 import re # For extract_field, if kept here, or pass structured data.
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+import run_control
+import token_usage
+from run_control import RunInterrupted
+
+# --- Call policy: request hedging & circuit breaking ---
+# Hedging: if a call runs longer than the observed latency percentile, a duplicate
+# request is fired and whichever returns first wins.
+# Circuit breaker: after enough consecutive failures, calls fail fast until the
+# cool-down expires, then a single trial call decides whether to close it again.
+# Coalescing: identical requests (same model, same prompt and image bytes) made while one
+# is in flight wait for it and share its response instead of calling the API again.
+CALL_POLICY = {
+    'hedging_enabled': True,
+    'hedge_percentile': 0.95,
+    'hedge_min_samples': 20,         # Latency samples needed before the percentile is trusted
+    'hedge_default_delay_s': 10.0,   # Hedge delay used until enough samples exist
+    'hedge_min_delay_s': 1.0,        # Never hedge earlier than this
+    'latency_window': 200,           # Number of recent latencies kept
+    'breaker_failure_threshold': 5,  # Consecutive failures that open the circuit
+    'breaker_reset_timeout_s': 30.0, # Cool-down before a trial call is allowed
+    'image_passthrough': True,       # Send encoded JPEG/PNG/WebP bytes as-is (see image_parts)
+    'coalescing_enabled': True,
+}
+
+# Image formats the API takes as inline bytes. Anything else, or anything too large, goes
+# through PIL, and the SDK re-encodes it (as lossless WebP).
+PASSTHROUGH_MIME_TYPES = ('image/jpeg', 'image/png', 'image/webp')
+MAX_INLINE_REQUEST_BYTES = 18 * 1024 * 1024  # Gemini caps inline requests at 20 MB; leaves room for the prompt
+
+CALL_STATS = {
+    'calls': 0,
+    'failures': 0,
+    'hedges_fired': 0,
+    'hedges_won': 0,
+    'circuit_rejections': 0,
+    'coalesced': 0,                  # Calls answered successfully by an identical request already in flight
+    'input_tokens': 0,
+    'output_tokens': 0,
+}
+
+_stats_lock = threading.Lock()
+_latencies = deque(maxlen=CALL_POLICY['latency_window'])
+_call_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini-call")
+_inflight = {}  # Request key -> Future of the call in flight for it
+_inflight_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Raised when the circuit breaker is open and calls are failing fast."""
+
+
+class CircuitBreaker:
+    """Minimal closed/open/half-open breaker shared by all Gemini calls in the process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            remaining = CALL_POLICY['breaker_reset_timeout_s'] - (time.monotonic() - self.opened_at)
+            if self.state == "open" and remaining <= 0:
+                self.state = "half_open"  # Let exactly one trial call through
+                return
+            _bump_stat('circuit_rejections')
+            raise CircuitOpenError(
+                f"Gemini API appears degraded ({self.consecutive_failures} consecutive failures). "
+                f"Failing fast; retry in {max(remaining, 0):.0f}s."
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def record_abandoned(self):
+        """The caller stopped waiting; an interrupted trial call lets the next call be the trial."""
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+                self.opened_at = time.monotonic() - CALL_POLICY['breaker_reset_timeout_s']
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= CALL_POLICY['breaker_failure_threshold']:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+_breaker = CircuitBreaker()
+
+
+def configure_call_policy(**overrides):
+    """Updates CALL_POLICY entries (e.g. hedging_enabled=False). Unknown keys raise ValueError."""
+    global _latencies
+    unknown = set(overrides) - set(CALL_POLICY)
+    if unknown:
+        raise ValueError(f"Unknown call policy setting(s): {', '.join(sorted(unknown))}")
+    CALL_POLICY.update(overrides)
+    if 'latency_window' in overrides:
+        with _stats_lock:
+            _latencies = deque(_latencies, maxlen=CALL_POLICY['latency_window'])
+
+
+def get_call_stats():
+    """Returns a snapshot of call counters plus the breaker state and current hedge delay."""
+    with _stats_lock:
+        stats = dict(CALL_STATS)
+    stats['circuit_state'] = _breaker.state
+    stats['hedge_delay_s'] = round(_hedge_delay(), 3)
+    return stats
+
+
+def reset_call_state():
+    """Zeroes the call counters, forgets observed latencies and closes the breaker (benchmarks, tests)."""
+    with _stats_lock:
+        for name in CALL_STATS:
+            CALL_STATS[name] = 0
+        _latencies.clear()
+    _breaker.record_success()
+
+
+def _bump_stat(name, amount=1):
+    with _stats_lock:
+        CALL_STATS[name] += amount
+
+
+def _hedge_delay():
+    """Current hedge trigger: the configured latency percentile, or the default until warmed up."""
+    with _stats_lock:
+        samples = sorted(_latencies)
+    if len(samples) < CALL_POLICY['hedge_min_samples']:
+        return CALL_POLICY['hedge_default_delay_s']
+    idx = min(len(samples) - 1, int(CALL_POLICY['hedge_percentile'] * len(samples)))
+    return max(samples[idx], CALL_POLICY['hedge_min_delay_s'])
+
+
+def _timed_generate(model, contents):
+    # Latency is recorded per attempt so hedged wins don't hide the real tail.
+    start = time.monotonic()
+    response = model.generate_content(contents)
+    with _stats_lock:
+        _latencies.append(time.monotonic() - start)
+    return response
+
+
+CANCEL_POLL_INTERVAL_S = 0.2  # How often a waiting call checks for cancellation and deadlines
+
+
+def _wait(futures, timeout=None):
+    """
+    wait(FIRST_COMPLETED) that, under an active RunControl, wakes up regularly to check it,
+    so a cancelled or expired run stops waiting on an in-flight request.
+    """
+    if run_control.current() is None:
+        return wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+    give_up_at = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        run_control.check_current()
+        slice_s = CANCEL_POLL_INTERVAL_S if give_up_at is None else min(CANCEL_POLL_INTERVAL_S, max(0.0, give_up_at - time.monotonic()))
+        done, pending = wait(futures, timeout=slice_s, return_when=FIRST_COMPLETED)
+        if done or (give_up_at is not None and time.monotonic() >= give_up_at):
+            return done, pending
+
+
+def _hedged_generate(model, contents):
+    if not CALL_POLICY['hedging_enabled']:
+        if run_control.current() is None:
+            return _timed_generate(model, contents)
+        future = _call_executor.submit(_timed_generate, model, contents)
+        _wait({future})
+        return future.result()
+
+    primary = _call_executor.submit(_timed_generate, model, contents)
+    done, _ = _wait({primary}, timeout=_hedge_delay())
+    if done:
+        return primary.result()
+
+    _bump_stat('hedges_fired')
+    hedge = _call_executor.submit(_timed_generate, model, contents)
+    pending = {primary, hedge}
+    last_error = None
+    while pending:
+        done, pending = _wait(pending)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    _bump_stat('hedges_won')
+                return future.result()
+            last_error = future.exception()
+    raise last_error
+
+
+def _request_key(model, contents):
+    """
+    Content hash of a request: the model object (models are shared process-wide, and one
+    object always has the same settings) plus every prompt and image part. None if a part
+    can't be hashed, so that request is never coalesced.
+    """
+    digest = hashlib.blake2b(str(id(model)).encode(), digest_size=16)
+    for part in (contents if isinstance(contents, (list, tuple)) else [contents]):
+        if isinstance(part, str):
+            data = part.encode('utf-8')
+        elif isinstance(part, dict) and isinstance(part.get('data'), (bytes, bytearray)):
+            data = part.get('mime_type', '').encode() + b"\x00" + part['data']
+        elif hasattr(part, 'tobytes') and hasattr(part, 'size'):  # PIL image
+            data = f"{part.mode}{part.size}".encode() + part.tobytes()
+        else:
+            return None
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def call_model(model, contents):
+    """
+    Single entry point for Gemini generate_content calls.
+    Applies request coalescing, the circuit breaker and request hedging, and updates CALL_STATS.
+    Token usage is reported to token_usage (only the winning attempt of a hedged call is known).
+    A coalesced caller gets the shared response but reports no usage: it cost nothing.
+    Raises RunInterrupted if the active run (see run_control) is cancelled or out of time.
+    """
+    run_control.check_current()
+    key = _request_key(model, contents) if CALL_POLICY['coalescing_enabled'] else None
+    if key is None:
+        return _call_model(model, contents)
+    while True:
+        with _inflight_lock:
+            flight = _inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _inflight[key] = Future()
+        if leader:
+            try:
+                response = _call_model(model, contents)
+            except BaseException as e:
+                _land(key, flight, error=e)
+                raise
+            _land(key, flight, response=response)
+            return response
+        _wait({flight})  # Our own run can still stop us while we wait
+        if isinstance(flight.exception(), RunInterrupted):
+            continue  # The leader's run stopped waiting, not ours: ask again (possibly as the leader)
+        response = flight.result()  # Raises the leader's error; only a shared answer counts as coalesced
+        _bump_stat('coalesced')
+        metrics.increment('coalesced_calls')
+        return response
+
+
+def _land(key, flight, response=None, error=None):
+    """Ends a flight: later identical requests call the API again, waiting ones get the outcome."""
+    with _inflight_lock:
+        _inflight.pop(key, None)
+    if error is not None:
+        flight.set_exception(error)
+    else:
+        flight.set_result(response)
+
+
+def _call_model(model, contents):
+    _breaker.before_call()
+    _bump_stat('calls')
+    try:
+        with metrics.span('model_call'):
+            response = _hedged_generate(model, contents)
+    except RunInterrupted:
+        _breaker.record_abandoned()  # Stopped waiting on purpose; says nothing about the API's health
+        raise
+    except Exception:
+        _bump_stat('failures')
+        _breaker.record_failure()
+        raise
+    _breaker.record_success()
+    usage = token_usage.usage_from_response(response, contents)
+    _bump_stat('input_tokens', usage['input_tokens'])
+    _bump_stat('output_tokens', usage['output_tokens'])
+    token_usage.record(usage)
+    return response
+
 
 # Moved from main app, this can be a utility within this service or a broader utils file
 def extract_field(pattern, text, default=""):
@@ -14,17 +304,47 @@ def extract_field(pattern, text, default=""):
         return val
     return default
 
-def analyze_image_with_gemini(vision_model, image_bytes, prompt_template):
+def detect_image_mime(image_bytes):
+    """MIME type of JPEG, PNG or WebP bytes from their signature; None for anything else."""
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def image_parts(images):
+    """
+    Request parts for (image bytes, mime type or None) pairs. JPEG, PNG and WebP bytes are sent
+    as-is as {'mime_type', 'data'} while the request stays under MAX_INLINE_REQUEST_BYTES;
+    other formats (or passthrough turned off) are decoded with PIL for the SDK to re-encode.
+    """
+    mime_types = [mime_type if mime_type in PASSTHROUGH_MIME_TYPES else detect_image_mime(data) for data, mime_type in images]
+    passthrough = (CALL_POLICY['image_passthrough'] and all(mime_types)
+                   and sum(len(data) for data, _ in images) <= MAX_INLINE_REQUEST_BYTES)
+    if passthrough:
+        metrics.increment('image_passthrough', len(images))
+        return [{'mime_type': mime_type, 'data': data} for (data, _), mime_type in zip(images, mime_types)]
+    from PIL import Image  # Deferred: only needed once an image is actually analyzed
+    with metrics.span('image_decode'):
+        return [Image.open(io.BytesIO(data)) for data, _ in images]
+
+def analyze_image_with_gemini(vision_model, image_bytes, prompt_template, extra_images=(), mime_type=None):
     """
     Analyzes an image using Gemini Vision model.
+    mime_type describes image_bytes (sniffed if None); extra_images are further JPEG/PNG/WebP
+    bytes sent after the first one (e.g. region crops). See image_parts for how they are sent.
     Returns the raw analysis text or raises an exception.
     """
     if not vision_model:
         raise ValueError("Vision model is not configured.")
     try:
-        pil_image = Image.open(io.BytesIO(image_bytes))
-        response = vision_model.generate_content([prompt_template, pil_image])
+        parts = image_parts([(image_bytes, mime_type)] + [(data, None) for data in extra_images])
+        response = call_model(vision_model, [prompt_template, *parts])
         return response.text
+    except (CircuitOpenError, RunInterrupted):
+        raise
     except Exception as e:
         # Log error or handle more gracefully if needed
         raise Exception(f"Gemini image analysis failed: {str(e)}")
@@ -38,8 +358,10 @@ def generate_caption_with_gemini(text_model, prompt):
     if not text_model:
         raise ValueError("Text model is not configured.")
     try:
-        response = text_model.generate_content(prompt)
+        response = call_model(text_model, prompt)
         return response.text.strip()
+    except (CircuitOpenError, RunInterrupted):
+        raise
     except Exception as e:
         # Log error or handle more gracefully
         raise Exception(f"Gemini caption generation failed: {str(e)}")
@@ -60,3 +382,47 @@ IMAGE_ANALYSIS_PROMPT_TEMPLATE = (
     "Detected Brands/Logos: [List any recognizable product brands or logos visible, e.g., Coca-Cola, Lay's. Please also incorporate the brand name in a very cohesive way. Please don't say (featuring) If none, state 'Not found'. Comma-separate if multiple.]\n"
     "If a field is not found or unclear for any specific line item above, state 'Not found' for that field and only that field."
 )
+
+# Field key -> line label in IMAGE_ANALYSIS_PROMPT_TEMPLATE
+ANALYSIS_FIELD_LABELS = {
+    'product': "Product Name",
+    'price': "Price",
+    'dates': "Sale Dates",
+    'store': "Store Name",
+    'category': "Product Category",
+    'brands': "Detected Brands/Logos",
+}
+
+
+def build_field_prompt(fields, store_names=None):
+    """
+    Short prompt asking again for only the given fields (keys of ANALYSIS_FIELD_LABELS), with
+    their instructions from IMAGE_ANALYSIS_PROMPT_TEMPLATE and the same response format.
+    store_names lists the known stores when the store is asked for.
+    """
+    labels = tuple(f"{ANALYSIS_FIELD_LABELS[field]}:" for field in fields)
+    lines = ["Look closely at this grocery sale image again; these fields were missing or unreadable. "
+             "Respond strictly in this format, each field on a new line:"]
+    lines += [line for line in IMAGE_ANALYSIS_PROMPT_TEMPLATE.split("\n") if line.startswith(labels)]
+    if 'store' in fields and store_names:
+        lines.append(f"Known stores: {', '.join(store_names)}.")
+    lines.append("If a field is still unclear, state 'Not found' for it.")
+    return "\n".join(lines)
+
+
+# Flyer mode: one call lists every deal on a full-page flyer. Deal keys match
+# ANALYSIS_FIELD_LABELS; boxes use Gemini's [ymin, xmin, ymax, xmax] on a 0-1000 scale.
+FLYER_ANALYSIS_PROMPT_TEMPLATE = (
+    "This is a full-page grocery sale flyer with several deals. List every deal on it. "
+    "Respond with JSON only, in this shape:\n"
+    '{"store": "store name for the whole flyer", "dates": "sale period for the whole flyer", '
+    '"deals": [{"product": "...", "price": "...", "dates": "...", "category": "...", "brands": "...", '
+    '"box": [ymin, xmin, ymax, xmax]}]}\n'
+    "product: the product name in the largest text (prefer English if sizes are similar). "
+    "price: including currency and unit, e.g. $1.99/lb, 2 for $5.00, 99¢ each. "
+    "dates: only if this deal has its own sale period, e.g. MM/DD-MM/DD. "
+    "category: Produce, Dairy, Meat, Bakery, Pantry, Frozen, Beverages, Snacks or Household. "
+    "brands: recognizable brands, comma-separated. "
+    "box: the deal's area (photo, name and price) scaled to 0-1000. "
+    "Use \"Not found\" for anything unclear."
+)
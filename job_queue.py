@@ -0,0 +1,173 @@
+# job_queue.py
+"""
+Durable on-disk job queue for the local job API (job_server.py).
+
+Layout under the data directory:
+    jobs/<job_id>.json   current state of each job (settings, files, per-item results)
+    uploads/             upload bytes in a content-addressed BlobStore
+    journal.jsonl        append-only event log (submitted / started / item_done / retry / finished)
+
+Job files are rewritten atomically after every state change, so a restart sees either
+the previous or the new state. On startup, queued and interrupted (running) jobs are
+re-enqueued and continue from their first unfinished item. A finished job can be reopened
+to retry only its failed items; their indices are kept on the job until each is redone.
+"""
+import datetime
+import json
+import os
+import queue
+import tempfile
+import threading
+import uuid
+
+from blob_store import BlobStore
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class JobQueue:
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.jobs_dir = os.path.join(data_dir, "jobs")
+        self.uploads = BlobStore(os.path.join(data_dir, "uploads"))
+        self.journal_path = os.path.join(data_dir, "journal.jsonl")
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self._lock = threading.RLock()  # Reentrant: reopen_failed saves and journals while holding it
+        self._pending = queue.Queue()
+        self.recover()
+
+    # --- Persistence ---
+    def _job_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _journal(self, event, job_id, **details):
+        entry = dict({'ts': _now(), 'event': event, 'job_id': job_id}, **details)
+        with self._lock, open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _save(self, job):
+        job['updated_at'] = _now()
+        with self._lock:
+            _atomic_write(self._job_path(job['job_id']), job)
+
+    def get(self, job_id):
+        try:
+            with open(self._job_path(job_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def read_upload(self, file_ref):
+        return self.uploads.get(file_ref['content_hash'])
+
+    def recover(self):
+        """Re-enqueues queued and interrupted jobs, oldest first."""
+        recovered = []
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".json"):
+                continue
+            job = self.get(name[:-len(".json")])
+            if job and job['status'] in (JOB_QUEUED, JOB_RUNNING):
+                recovered.append(job)
+        for job in sorted(recovered, key=lambda j: j['created_at']):
+            if job['status'] == JOB_RUNNING:
+                self._journal("recovered", job['job_id'], completed_items=len(job['results']))
+            self._pending.put(job['job_id'])
+        return len(recovered)
+
+    # --- Producer side ---
+    def submit(self, files, settings):
+        """
+        files: list of {'name', 'type', 'bytes'}; settings: dict passed through to the worker.
+        Returns the new job dict (status 'queued').
+        """
+        if not files:
+            raise ValueError("A job needs at least one file.")
+        file_refs = []
+        for f in files:
+            digest = self.uploads.put(f['bytes'])
+            file_refs.append({'name': f['name'], 'type': f.get('type', ''), 'content_hash': digest, 'size': len(f['bytes'])})
+
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'status': JOB_QUEUED,
+            'created_at': _now(),
+            'settings': settings or {},
+            'files': file_refs,
+            'results': [],
+            'error': "",
+        }
+        self._save(job)
+        self._journal("submitted", job['job_id'], file_count=len(file_refs))
+        self._pending.put(job['job_id'])
+        return job
+
+    # --- Consumer side ---
+    def next_job_id(self, timeout=None):
+        """Blocks until a job is available; returns None on timeout."""
+        try:
+            return self._pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def mark_running(self, job):
+        job['status'] = JOB_RUNNING
+        job.setdefault('started_at', _now())
+        self._save(job)
+        self._journal("started", job['job_id'], resume_from=len(job['results']))
+
+    def record_item(self, job, item):
+        job['results'].append(item)
+        self._save(job)
+        self._journal("item_done", job['job_id'], index=len(job['results']) - 1)
+
+    def reopen_failed(self, job_id, retry_settings=None):
+        """
+        Re-queues a finished job to redo only its failed items (and any it never reached).
+        Returns the number of items to retry, or None if the job is unknown or still
+        queued/running. The status check and the requeue happen under the queue lock, so
+        concurrent retry requests queue a job only once.
+        """
+        with self._lock:
+            job = self.get(job_id)
+            if job is None or job['status'] not in (JOB_DONE, JOB_FAILED):
+                return None
+            job['retry_indices'] = [idx for idx, item in enumerate(job['results']) if item.get('failedStage')]
+            job['retry_settings'] = retry_settings or {}
+            job['status'] = JOB_QUEUED
+            job['error'] = ""
+            self._save(job)
+            self._journal("retry", job['job_id'], indices=job['retry_indices'])
+            self._pending.put(job['job_id'])
+        return len(job['retry_indices']) + len(job['files']) - len(job['results'])
+
+    def replace_item(self, job, index, item):
+        """Stores a retried item's result and drops it from the job's retry list."""
+        job['results'][index] = item
+        job['retry_indices'] = [idx for idx in job.get('retry_indices', []) if idx != index]
+        self._save(job)
+        self._journal("item_done", job['job_id'], index=index, retry=True)
+
+    def finish(self, job, error=""):
+        job['status'] = JOB_FAILED if error else JOB_DONE
+        job['error'] = error
+        job['finished_at'] = _now()
+        self._save(job)
+        self._journal("finished", job['job_id'], status=job['status'], error=error)
+
+    def pending_count(self):
+        return self._pending.qsize()
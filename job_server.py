@@ -0,0 +1,265 @@
+# job_server.py
+"""
+Local HTTP job API around the caption pipeline.
+
+Endpoints (JSON):
+    POST /jobs                 submit {"files": [{"name", "type", "data_base64"}], "settings": {...}}
+    GET  /jobs/<job_id>        status and progress
+    GET  /jobs/<job_id>/results  per-item results (partial while running)
+    POST /jobs/<job_id>/retry  redo only the failed items of a finished job
+                               (optional {"max_attempts", "backoff_s"})
+    GET  /health               queue depth and worker count
+    GET  /metrics              per-stage timings, Prometheus text (?format=json for JSON)
+
+Settings: "tone", "store" (fallback store key), "generate_captions" (default true),
+"prompt_budget" (estimated tokens per caption prompt).
+
+Usage:
+    python job_server.py --port 8765 --workers 2 --data-dir .jobs
+    python job_server.py --stub-model --stub-latency 0.2   # offline load testing
+"""
+import argparse
+import base64
+import binascii
+import json
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+import metrics
+import token_usage
+
+from batch_cli import BatchRunner, CUSTOM_STORES_FILE
+from constants import TONE_OPTIONS
+from gemini_services import CircuitOpenError
+from job_queue import JobQueue, JOB_QUEUED
+from pipeline import load_custom_stores, combine_captions
+from prompt_builder import parse_prompt_budget
+from run_control import DEFAULT_RETRY_ATTEMPTS, DEFAULT_RETRY_BACKOFF_S
+
+MAX_REQUEST_BYTES = 200 * 1024 * 1024
+JOB_PATH = re.compile(r"^/jobs/([0-9a-f]{32})(/results)?/?$")
+RETRY_PATH = re.compile(r"^/jobs/([0-9a-f]{32})/retry/?$")
+
+
+# --- Workers ---
+def run_job(job_queue, job, vision_model, text_model, custom_stores_path):
+    """Processes the remaining items of one job, persisting each result as it completes."""
+    settings = job['settings']
+    # Setup runs inside the try too: a bad custom stores file fails the job, not the worker
+    try:
+        combined_captions = combine_captions(load_custom_stores(custom_stores_path))
+        default_store_key = settings.get('store') or (list(combined_captions.keys())[0] if combined_captions else None)
+        runner = BatchRunner(vision_model, text_model, combined_captions, default_store_key,
+                             settings.get('tone') or TONE_OPTIONS[0]['value'],
+                             generate_captions=settings.get('generate_captions', True),
+                             prompt_token_budget=settings.get('prompt_budget'))
+        # Continuity references carry over from items finished before a restart
+        for done_item in job['results']:
+            if done_item.get('generatedCaption'):
+                runner.last_caption_by_store[done_item['selectedStoreKey']] = done_item['generatedCaption']
+
+        job_queue.mark_running(job)
+        for idx in range(len(job['results']), len(job['files'])):
+            file_ref = job['files'][idx]
+            item = runner.process_bytes(idx, file_ref['name'], file_ref['type'], job_queue.read_upload(file_ref))
+            job_queue.record_item(job, item)
+        # Items reopened by POST /jobs/<id>/retry; only their failed stage is redone
+        retry_settings = job.get('retry_settings') or {}
+        for idx in list(job.get('retry_indices', [])):
+            file_ref = job['files'][idx]
+            item = runner.retry_item(job['results'][idx], file_ref['type'], job_queue.read_upload(file_ref),
+                                     attempts=retry_settings.get('max_attempts', DEFAULT_RETRY_ATTEMPTS),
+                                     backoff_s=retry_settings.get('backoff_s', DEFAULT_RETRY_BACKOFF_S))
+            job_queue.replace_item(job, idx, item)
+    except CircuitOpenError as e:
+        job_queue.finish(job, error=str(e))
+        return
+    except Exception as e:
+        job_queue.finish(job, error=f"Job failed: {e}")
+        return
+    job_queue.finish(job)
+
+
+def worker_loop(job_queue, vision_model, text_model, custom_stores_path, stop_event):
+    while not stop_event.is_set():
+        job_id = job_queue.next_job_id(timeout=0.5)
+        if job_id is None:
+            continue
+        job = job_queue.get(job_id)
+        if not job:
+            continue
+        try:
+            run_job(job_queue, job, vision_model, text_model, custom_stores_path)
+        except Exception as e:  # e.g. the job file can't be saved; keep the worker for the next job
+            print(f"[job_server] job {job_id} aborted: {e}", file=sys.stderr)
+
+
+def start_workers(job_queue, worker_count, vision_model, text_model, custom_stores_path=CUSTOM_STORES_FILE):
+    """Starts the worker pool; returns (threads, stop_event)."""
+    stop_event = threading.Event()
+    threads = []
+    for n in range(max(1, worker_count)):
+        t = threading.Thread(target=worker_loop, name=f"job-worker-{n}", daemon=True,
+                             args=(job_queue, vision_model, text_model, custom_stores_path, stop_event))
+        t.start()
+        threads.append(t)
+    return threads, stop_event
+
+
+# --- HTTP ---
+def job_summary(job):
+    return {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'created_at': job['created_at'],
+        'updated_at': job.get('updated_at'),
+        'total_items': len(job['files']),
+        'completed_items': len(job['results']),
+        'failed_items': sum(1 for item in job['results'] if item.get('failedStage')),
+        'token_usage': {field: sum(item.get('tokenUsage', {}).get(field, 0) for item in job['results'])
+                        for field in token_usage.USAGE_FIELDS},
+        'error': job.get('error', ""),
+    }
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    job_queue = None   # Set by make_server
+    worker_count = 0
+    custom_stores_path = CUSTOM_STORES_FILE
+
+    def _send_json(self, status, payload):
+        self._send_text(status, json.dumps(payload, ensure_ascii=False), "application/json; charset=utf-8")
+
+    def log_message(self, format, *args):
+        sys.stderr.write(f"[job_server] {self.address_string()} {format % args}\n")
+
+    def _send_text(self, status, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip('/') == "/metrics":
+            if parse_qs(url.query).get('format') == ["json"]:
+                self._send_text(200, metrics.to_json(), "application/json; charset=utf-8")
+            else:
+                self._send_text(200, metrics.to_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            return
+        if self.path.rstrip('/') == "/health":
+            self._send_json(200, {'status': "ok", 'queued': self.job_queue.pending_count(), 'workers': self.worker_count})
+            return
+        match = JOB_PATH.match(self.path)
+        job = self.job_queue.get(match.group(1)) if match else None
+        if not job:
+            self._send_json(404, {'error': "Job not found."})
+        elif match.group(2):
+            self._send_json(200, {'job_id': job['job_id'], 'status': job['status'], 'results': job['results']})
+        else:
+            self._send_json(200, job_summary(job))
+
+    def do_POST(self):
+        retry_match = RETRY_PATH.match(self.path)
+        if retry_match:
+            self._retry_job(retry_match.group(1))
+            return
+        if self.path.rstrip('/') != "/jobs":
+            self._send_json(404, {'error': "Not found."})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0 or length > MAX_REQUEST_BYTES:
+            self._send_json(413 if length else 400, {'error': f"Body must be 1..{MAX_REQUEST_BYTES} bytes."})
+            return
+        try:
+            payload = json.loads(self.rfile.read(length))
+            files = [{'name': f['name'], 'type': f.get('type', ''), 'bytes': base64.b64decode(f['data_base64'], validate=True)}
+                     for f in payload['files']]
+            settings = payload.get('settings') or {}
+            if settings.get('tone') and settings['tone'] not in [t['value'] for t in TONE_OPTIONS]:
+                raise ValueError(f"Unknown tone '{settings['tone']}'.")
+            if settings.get('store'):
+                combined_captions = combine_captions(load_custom_stores(self.custom_stores_path))
+                if settings['store'] not in combined_captions:
+                    raise ValueError(f"Unknown store key '{settings['store']}'. Choose from: {', '.join(combined_captions)}")
+            if settings.get('prompt_budget') is not None:
+                settings['prompt_budget'] = parse_prompt_budget(settings['prompt_budget'])
+            job = self.job_queue.submit(files, settings)
+        except (ValueError, KeyError, TypeError, binascii.Error) as e:
+            self._send_json(400, {'error': f"Invalid job request: {e}"})
+            return
+        self._send_json(202, {'job_id': job['job_id'], 'status': JOB_QUEUED})
+
+    def _retry_job(self, job_id):
+        job = self.job_queue.get(job_id)
+        if not job:
+            self._send_json(404, {'error': "Job not found."})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            payload = json.loads(self.rfile.read(length)) if 0 < length <= MAX_REQUEST_BYTES else {}
+            retry_settings = {'max_attempts': int(payload.get('max_attempts', DEFAULT_RETRY_ATTEMPTS)),
+                              'backoff_s': float(payload.get('backoff_s', DEFAULT_RETRY_BACKOFF_S))}
+            if retry_settings['max_attempts'] < 1 or retry_settings['backoff_s'] < 0:
+                raise ValueError("max_attempts must be >= 1 and backoff_s >= 0.")
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json(400, {'error': f"Invalid retry request: {e}"})
+            return
+        retry_count = self.job_queue.reopen_failed(job_id, retry_settings)
+        if retry_count is None:
+            status = (self.job_queue.get(job_id) or job)['status']
+            self._send_json(409, {'error': f"Job is {status}; only finished jobs can be retried."})
+        else:
+            self._send_json(202, {'job_id': job_id, 'status': JOB_QUEUED, 'retry_items': retry_count})
+
+
+def make_server(host, port, job_queue, worker_count, custom_stores_path=CUSTOM_STORES_FILE):
+    handler = type("BoundJobRequestHandler", (JobRequestHandler,), {'job_queue': job_queue, 'worker_count': worker_count,
+                                                                   'custom_stores_path': custom_stores_path})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP job API for ad analysis and captioning.")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address (default: localhost only)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2, help="Jobs processed concurrently")
+    parser.add_argument("--data-dir", default=".jobs", help="Queue, uploads and journal location")
+    parser.add_argument("--custom-stores", default=CUSTOM_STORES_FILE)
+    parser.add_argument("--stub-model", action="store_true", help="Use the offline stub model (no API key needed)")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="Seconds per stub model call")
+    args = parser.parse_args(argv)
+
+    if args.stub_model:
+        from stub_model import StubModel
+        vision_model = text_model = StubModel(latency_s=args.stub_latency)
+    else:
+        from config import get_models
+        try:
+            vision_model, text_model = get_models()
+        except Exception as e:
+            print(f"Gemini models not available: {e}", file=sys.stderr)
+            return 2
+
+    job_queue = JobQueue(args.data_dir)
+    threads, stop_event = start_workers(job_queue, args.workers, vision_model, text_model, args.custom_stores)
+    server = make_server(args.host, args.port, job_queue, len(threads), args.custom_stores)
+    print(f"Job API listening on http://{args.host}:{args.port} with {len(threads)} worker(s); "
+          f"{job_queue.pending_count()} job(s) queued.", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+# metrics.py
+"""
+Lightweight per-stage timing for the analysis and caption pipelines.
+
+Wrap a stage in `with span("stage_name"):` and its duration lands in a process-wide
+histogram for that stage; a span that raises also counts as an error. Stages that fail
+without raising report through observe(stage, seconds, ok=False). Discrete events use
+increment(). Everything is kept in memory and can be exported as a JSON snapshot or
+Prometheus text exposition, e.g. by the app's Diagnostics panel, the job server's
+/metrics endpoint or `benchmark.py --metrics`.
+"""
+import contextlib
+import json
+import threading
+import time
+from collections import deque
+
+METRIC_PREFIX = "caption_gen"
+# Histogram bucket upper bounds in seconds (Prometheus 'le'); +Inf is implied
+BUCKETS_S = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RECENT_SAMPLES = 500  # Recent durations per stage kept for the p50/p95/p99 shown in the panel
+
+STAGE_DESCRIPTIONS = {
+    'analyze_item': "Whole analysis of one upload",
+    'image_decode': "Opening image bytes before the vision call",
+    'roi_crop': "Finding and cropping text regions (ROI mode only)",
+    'deal_crop': "Cropping each deal out of a flyer (flyer mode only)",
+    'video_temp_write': "Writing a video to a temp file for OpenCV",
+    'video_frame_read': "Reading (decoding) one video frame",
+    'jpeg_encode': "JPEG-encoding a sampled video frame",
+    'model_call': "Gemini generate_content, including hedging",
+    'analysis_parse': "Regex parsing of the analysis text into item fields",
+    'date_parse': "Parsing the sale dates",
+    'thumbnail_extract': "First-frame thumbnail of a video upload",
+    'caption_item': "Whole caption generation for one item",
+    'caption_prompt': "Building the caption prompt",
+    'brain_save': "Writing the caption brain file",
+}
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS_S)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, seconds, ok=True):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        if not ok:
+            self.errors += 1
+        self.recent.append(seconds)
+        for idx, bound in enumerate(BUCKETS_S):
+            if seconds <= bound:
+                self.bucket_counts[idx] += 1
+                break
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+def observe(stage, seconds, ok=True):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.observe(seconds, ok)
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Times the block into the stage's histogram; an exception counts as an error and propagates."""
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        observe(stage, time.perf_counter() - start, ok)
+
+
+def increment(event, amount=1):
+    with _lock:
+        _counters[event] = _counters.get(event, 0) + amount
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def snapshot():
+    """
+    {'stages': {stage: {count, errors, sum_s, max_s, p50_s, p95_s, p99_s, buckets}}, 'counters': {...}}.
+    Percentiles cover the most recent RECENT_SAMPLES durations; buckets are cumulative totals.
+    """
+    with _lock:
+        stages = {}
+        for stage, histogram in _histograms.items():
+            recent = sorted(histogram.recent)
+            cumulative, buckets = 0, {}
+            for bound, bucket_count in zip(BUCKETS_S, histogram.bucket_counts):
+                cumulative += bucket_count
+                buckets[f"{bound:g}"] = cumulative
+            buckets["+Inf"] = histogram.count
+            stages[stage] = {
+                'count': histogram.count,
+                'errors': histogram.errors,
+                'sum_s': round(histogram.sum, 6),
+                'max_s': round(histogram.max, 6),
+                'p50_s': round(_percentile(recent, 0.50), 6),
+                'p95_s': round(_percentile(recent, 0.95), 6),
+                'p99_s': round(_percentile(recent, 0.99), 6),
+                'buckets': buckets,
+            }
+        counters = dict(_counters)
+    return {'generated_at': time.time(), 'stages': stages, 'counters': counters}
+
+
+def to_json(indent=2):
+    return json.dumps(snapshot(), indent=indent)
+
+
+def to_prometheus():
+    """Prometheus text exposition format (version 0.0.4)."""
+    data = snapshot()
+    name = f"{METRIC_PREFIX}_stage_duration_seconds"
+    lines = [f"# HELP {name} Duration of pipeline stages.", f"# TYPE {name} histogram"]
+    for stage, stats in sorted(data['stages'].items()):
+        for bound, cumulative in stats['buckets'].items():
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {stats["sum_s"]}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+    errors_name = f"{METRIC_PREFIX}_stage_errors_total"
+    lines += [f"# HELP {errors_name} Pipeline stage runs that failed.", f"# TYPE {errors_name} counter"]
+    lines += [f'{errors_name}{{stage="{stage}"}} {stats["errors"]}' for stage, stats in sorted(data['stages'].items())]
+    events_name = f"{METRIC_PREFIX}_events_total"
+    lines += [f"# HELP {events_name} Pipeline events.", f"# TYPE {events_name} counter"]
+    lines += [f'{events_name}{{event="{event}"}} {count}' for event, count in sorted(data['counters'].items())]
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(path):
+    """Writes the metrics to path: Prometheus text for .prom/.txt, JSON otherwise."""
+    text = to_prometheus() if path.endswith((".prom", ".txt")) else to_json()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
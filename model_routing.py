@@ -0,0 +1,78 @@
+# model_routing.py
+"""
+Per-stage model routing for Gemini calls.
+
+Each stage can use its own model: still-image analysis, scoring sampled video frames and
+caption generation. Analysis can also escalate: when the cheap model's answer scores
+below a field-completeness threshold (pipeline.score_analysis_text), the same image is
+analyzed once more with a stronger model and the more complete answer is kept. Most ads
+are fully read by the cheap model, so only the hard ones pay for the stronger one.
+
+Model names come from environment variables (or .env), falling back to the defaults below:
+    GEMINI_MODEL_IMAGE_ANALYSIS, GEMINI_MODEL_FRAME_SCORING, GEMINI_MODEL_CAPTION,
+    GEMINI_MODEL_ESCALATION ("none" disables escalation), GEMINI_ESCALATION_MIN_SCORE
+"""
+import os
+
+DEFAULT_MODEL = "gemini-flash-lite-latest"
+DEFAULT_ESCALATION_MODEL = "gemini-flash-latest"
+# Product name and price are worth 2 points each (see score_analysis_text), so anything
+# below 4 is missing at least one of them.
+DEFAULT_ESCALATION_MIN_SCORE = 4
+
+STAGE_ENV_VARS = {
+    'image_analysis': "GEMINI_MODEL_IMAGE_ANALYSIS",
+    'frame_scoring': "GEMINI_MODEL_FRAME_SCORING",
+    'caption': "GEMINI_MODEL_CAPTION",
+    'escalation': "GEMINI_MODEL_ESCALATION",
+}
+
+
+def model_names_from_env():
+    """{stage: model name} for every stage in STAGE_ENV_VARS; escalation is "" when disabled."""
+    names = {stage: os.getenv(env_var, "").strip() or DEFAULT_MODEL
+             for stage, env_var in STAGE_ENV_VARS.items() if stage != 'escalation'}
+    escalation_name = os.getenv(STAGE_ENV_VARS['escalation'], DEFAULT_ESCALATION_MODEL).strip()
+    names['escalation'] = "" if escalation_name.lower() in ("", "none", "off") else escalation_name
+    return names
+
+
+def escalation_min_score_from_env():
+    try:
+        return int(os.getenv("GEMINI_ESCALATION_MIN_SCORE", DEFAULT_ESCALATION_MIN_SCORE))
+    except ValueError:
+        return DEFAULT_ESCALATION_MIN_SCORE
+
+
+class VisionRoute:
+    """
+    The vision models used by analysis. Passed wherever a vision model is expected;
+    pipeline code resolves the model for each stage with for_stage().
+    """
+
+    def __init__(self, image_model, frame_model=None, escalation_model=None,
+                 escalation_min_score=DEFAULT_ESCALATION_MIN_SCORE):
+        self.image_model = image_model
+        self.frame_model = frame_model or image_model
+        self.escalation_model = escalation_model
+        self.escalation_min_score = escalation_min_score
+
+    @property
+    def model_name(self):
+        """All routed model names, e.g. for cache keys: 'image|frames|escalation@4'."""
+        names = [getattr(model, 'model_name', '') for model in (self.image_model, self.frame_model, self.escalation_model)]
+        return f"{'|'.join(names)}@{self.escalation_min_score}"
+
+
+def for_stage(vision_model, stage):
+    """The model for 'image_analysis' or 'frame_scoring'; a plain model serves every stage."""
+    if isinstance(vision_model, VisionRoute):
+        return vision_model.frame_model if stage == 'frame_scoring' else vision_model.image_model
+    return vision_model
+
+
+def escalation(vision_model):
+    """(escalation model, min score), or (None, 0) when the model has no escalation configured."""
+    if isinstance(vision_model, VisionRoute) and vision_model.escalation_model is not None:
+        return vision_model.escalation_model, vision_model.escalation_min_score
+    return None, 0
@@ -0,0 +1,884 @@
+# pipeline.py
+"""
+Streamlit-free analysis and caption pipeline.
+
+Everything here works on plain dicts (the `analysis_data_item` shape used by app.py)
+so the same logic can run inside the Streamlit app, the headless batch CLI, or any
+other caller. Session state, widgets and the caption brain stay in app.py.
+"""
+import copy
+import datetime
+import json
+import os
+import re
+import tempfile
+import time
+
+from constants import INITIAL_BASE_CAPTIONS, PREDEFINED_PRICES
+from utils import (
+    get_current_day_for_teds, get_holiday_context, format_dates_for_caption_context,
+    get_final_price_string, find_store_key_by_name, try_parse_date_from_image_text
+)
+from gemini_services import (
+    analyze_image_with_gemini, generate_caption_with_gemini, extract_field, build_field_prompt,
+    IMAGE_ANALYSIS_PROMPT_TEMPLATE, FLYER_ANALYSIS_PROMPT_TEMPLATE, ANALYSIS_FIELD_LABELS, CircuitOpenError
+)
+import metrics
+import model_routing
+import roi_crop
+import token_usage
+from prompt_builder import PromptBuilder, compact_reference
+from run_control import RunInterrupted, check_current
+
+# --- Store Definitions ---
+def load_custom_stores(path):
+    """Loads custom store definitions from a JSON file. Raises ValueError if the file is not a dict."""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} does not contain a valid dictionary.")
+    return data
+
+def combine_captions(custom_captions):
+    """Combine built-in stores with custom store definitions."""
+    combined = copy.deepcopy(INITIAL_BASE_CAPTIONS)
+    if isinstance(custom_captions, dict):
+        for store_key, store_sale_types in custom_captions.items():
+            if store_key not in combined:
+                combined[store_key] = {}
+            if isinstance(store_sale_types, dict):
+                combined[store_key].update(store_sale_types)
+    return combined
+
+
+# --- Video Helpers ---
+def extract_video_thumbnail(video_bytes):
+    """Extracts the first frame of a video and returns it as JPG bytes (None if no frame could be read)."""
+    import cv2
+    with metrics.span('thumbnail_extract'):
+        # OpenCV needs a file path to read from, so we use a temporary file
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_video_file:
+            temp_video_file.write(video_bytes)
+            video_filename = temp_video_file.name
+
+        cap = cv2.VideoCapture(video_filename)
+        success, frame = cap.read()
+        cap.release()
+        os.unlink(video_filename)  # Clean up the temporary file
+
+        if success:
+            is_success, buffer = cv2.imencode(".jpg", frame)
+            if is_success:
+                return buffer.tobytes()
+        return None
+
+def score_analysis_text(analysis_text):
+    """Scores an analysis by how many key fields were filled (max 6)."""
+    score = 0
+    if extract_field(r"^Product Name: (.*)$", analysis_text, default="Not found") != "Not found": score += 2 # Prioritize product name
+    if extract_field(r"^Price: (.*)$", analysis_text, default="Not found") != "Not found": score += 2 # and price
+    if extract_field(r"^Sale Dates: (.*)$", analysis_text, default="Not found") != "Not found": score += 1
+    if extract_field(r"^Store Name: (.*)$", analysis_text, default="Not found") != "Not found": score += 1
+    return score
+
+MAX_ANALYSIS_SCORE = 6
+
+def escalate_analysis(vision_model, image_bytes, prompt, analysis_text, mime_type=None):
+    """
+    Redoes an analysis that scores below the route's escalation threshold with its stronger
+    model (see model_routing) and returns the more complete of the two answers. A failed
+    escalation keeps the original answer. mime_type describes image_bytes (sniffed if None).
+    """
+    escalation_model, min_score = model_routing.escalation(vision_model)
+    score = score_analysis_text(analysis_text)
+    if escalation_model is None or score >= min_score:
+        return analysis_text
+    metrics.increment('analysis_escalations')
+    try:
+        escalated_text = analyze_image_with_gemini(escalation_model, image_bytes, prompt, mime_type=mime_type)
+    except (CircuitOpenError, RunInterrupted):
+        raise
+    except Exception:
+        metrics.increment('analysis_escalation_failures')
+        return analysis_text
+    return escalated_text if score_analysis_text(escalated_text) >= score else analysis_text
+
+def analyze_video_frames(vision_model, video_bytes, prompt):
+    """
+    Analyzes frames from a video using Gemini, scores each analysis,
+    and returns the analysis text from the frame with the best score.
+    Frames are scored with the route's frame model; if even the best frame is incomplete,
+    that frame is escalated like a still image.
+    """
+    import cv2
+    frame_model = model_routing.for_stage(vision_model, 'frame_scoring')
+    # Use a temporary file for OpenCV
+    with metrics.span('video_temp_write'), tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as temp_video_file:
+        temp_video_file.write(video_bytes)
+        video_filename = temp_video_file.name
+
+    cap = cv2.VideoCapture(video_filename)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    if not fps or fps <= 0:
+        fps = 30  # Assume a default FPS if it's not available
+
+    # Sample one frame per second
+    frame_interval = int(fps)
+
+    best_analysis_text = ""
+    best_frame_bytes = None
+    max_score = -1
+
+    frame_count = 0
+    try:
+        while cap.isOpened():
+            check_current()  # A cancelled or expired run stops between frames
+            with metrics.span('video_frame_read'):
+                ret, frame = cap.read()
+            if not ret:
+                break
+
+            # Process frame if it's at the desired interval
+            if frame_count % frame_interval == 0:
+                with metrics.span('jpeg_encode'):
+                    is_success, buffer = cv2.imencode(".jpg", frame)
+                if is_success:
+                    frame_bytes = buffer.tobytes()
+                    try:
+                        analysis_text = analyze_image_with_gemini(frame_model, frame_bytes, prompt, mime_type="image/jpeg")
+                        score = score_analysis_text(analysis_text)
+                        if score > max_score:
+                            max_score = score
+                            best_analysis_text = analysis_text
+                            best_frame_bytes = frame_bytes
+                            # Early exit if we get a "perfect" score (all fields found)
+                            if max_score >= MAX_ANALYSIS_SCORE:
+                                break
+                    except (CircuitOpenError, RunInterrupted):
+                        # The API is degraded or the run was stopped; the remaining frames would fail too
+                        raise
+                    except Exception:
+                        # Skip frames that fail analysis to not interrupt the batch; counted in the metrics
+                        metrics.increment('video_frame_failures')
+
+            frame_count += 1
+    finally:
+        cap.release()
+        os.unlink(video_filename)
+
+    if not best_analysis_text:
+        # Provide a more generic error if no frame yielded good results
+        raise Exception("Video analysis failed. No valid information could be extracted from the video frames.")
+
+    return escalate_analysis(vision_model, best_frame_bytes, prompt, best_analysis_text, mime_type="image/jpeg")
+
+
+# --- Analysis ---
+def default_price_format():
+    return PREDEFINED_PRICES[1]['value'] if PREDEFINED_PRICES and len(PREDEFINED_PRICES) > 1 else (PREDEFINED_PRICES[0]['value'] if PREDEFINED_PRICES else "CUSTOM")
+
+def new_analysis_item(item_id, filename, preview_blob_id, default_store_key, content_hash=""):
+    """Returns a fresh analysis_data_item with default (un-analyzed) field values."""
+    return {
+        "id": item_id,
+        "original_filename": filename,
+        "content_hash": content_hash,
+        "preview_blob_id": preview_blob_id,
+        "itemProduct": "", "itemCategory": "N/A",
+        "detectedBrands": "N/A", "selectedStoreKey": default_store_key,
+        "selectedPriceFormat": default_price_format(),
+        "itemPriceValue": "", "customItemPrice": "",
+        "dateRange": {"start": datetime.date.today().strftime("%Y-%m-%d"), "end": (datetime.date.today() + datetime.timedelta(days=6)).strftime("%Y-%m-%d")},
+        "generatedCaption": "", "analysisError": "", "batch_selected": False,
+        "failedStage": "",  # "analysis" or "caption" when that step's last attempt failed
+        "fieldConfidence": {},  # CONFIDENCE_FIELDS -> confidence level, set by the analysis
+        "tokenUsage": token_usage.empty_usage()  # All model calls made for this item (analysis and captions)
+    }
+
+def serializable_item(analysis_data_item):
+    """Copy of an item without any raw bytes, safe to write as JSON."""
+    return {k: v for k, v in analysis_data_item.items() if not isinstance(v, (bytes, bytearray))}
+
+CAPTION_INPUT_FIELDS = ['itemProduct', 'itemCategory', 'detectedBrands', 'selectedStoreKey',
+                        'selectedPriceFormat', 'itemPriceValue', 'customItemPrice', 'dateRange']
+
+def caption_inputs(analysis_data_item):
+    """The item fields that determine its caption (used to key caption checkpoints)."""
+    return {field: analysis_data_item.get(field) for field in CAPTION_INPUT_FIELDS}
+
+# Fields a successful analysis writes; a retried analysis replaces only these
+ANALYSIS_OUTPUT_FIELDS = ['itemProduct', 'itemCategory', 'detectedBrands', 'selectedStoreKey', 'selectedPriceFormat',
+                          'itemPriceValue', 'customItemPrice', 'dateRange', 'analysisError', 'failedStage', 'fieldConfidence']
+
+def failed_items(items, stage):
+    """Items whose last attempt at `stage` ('analysis' or 'caption') failed."""
+    return [item for item in items if item.get('failedStage') == stage]
+
+# --- Tabular Editing ---
+# Table column -> item field for the bulk-edit table; dates are handled separately because
+# they live in item['dateRange'] as strings and the table edits them as date objects.
+TABLE_FIELDS = {
+    'Product': 'itemProduct', 'Category': 'itemCategory', 'Brands': 'detectedBrands',
+    'Store': 'selectedStoreKey', 'Price Format': 'selectedPriceFormat', 'Price': 'itemPriceValue',
+    'Custom Price': 'customItemPrice', 'Selected': 'batch_selected',
+}
+
+def _table_date(date_str):
+    try:
+        return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return None
+
+def items_to_columns(items):
+    """Columnar view of items (one list per column, one row per item) for the bulk-edit table."""
+    columns = {'id': [item['id'] for item in items],
+               'File': [item.get('original_filename', item['id']) for item in items]}
+    for column, field in TABLE_FIELDS.items():
+        columns[column] = [item.get(field) for item in items]
+    columns['Start'] = [_table_date(item['dateRange']['start']) for item in items]
+    columns['End'] = [_table_date(item['dateRange']['end']) for item in items]
+    return columns
+
+def apply_column_edits(items, columns):
+    """
+    Writes an edited columnar table back into the items with matching ids. Date edits that
+    would end a sale before it starts are not applied.
+    Returns (ids of items that changed, ids whose date edit was rejected).
+    """
+    items_by_id = {item['id']: item for item in items}
+    changed_ids, rejected_date_ids = [], []
+    for row, item_id in enumerate(columns['id']):
+        item = items_by_id.get(item_id)
+        if item is None:
+            continue
+        updates = {}
+        for column, field in TABLE_FIELDS.items():
+            value = columns[column][row]
+            value = bool(value) if field == 'batch_selected' else ("" if value is None else value)
+            if value != item.get(field):
+                updates[field] = value
+        date_range = dict(item['dateRange'])
+        for column, bound in (('Start', 'start'), ('End', 'end')):
+            if columns[column][row] is not None:
+                date_range[bound] = columns[column][row].strftime("%Y-%m-%d")
+        if date_range != item['dateRange']:
+            if date_range['end'] < date_range['start']:
+                rejected_date_ids.append(item_id)
+            else:
+                updates['dateRange'] = date_range
+        if updates:
+            item.update(updates)
+            for field in updates:
+                mark_reviewed(item, field)
+            changed_ids.append(item_id)
+    return changed_ids, rejected_date_ids
+
+def set_store_date_range(items, store_key, start_date, end_date):
+    """Sets the sale dates of every item for store_key in one operation. Returns the number changed."""
+    date_range = {'start': start_date.strftime("%Y-%m-%d"), 'end': end_date.strftime("%Y-%m-%d")}
+    changed = 0
+    for item in items:
+        if item.get('selectedStoreKey') == store_key and item['dateRange'] != date_range:
+            item['dateRange'] = dict(date_range)
+            mark_reviewed(item, 'dateRange')
+            changed += 1
+    return changed
+
+def analyze_media(vision_model, file_bytes, file_type, prompt=IMAGE_ANALYSIS_PROMPT_TEMPLATE):
+    """
+    Returns the raw analysis text for an image or video upload.
+    vision_model is a model or a model_routing.VisionRoute (per-stage models plus escalation).
+    """
+    if 'video' in (file_type or ''):
+        return analyze_video_frames(vision_model, file_bytes, prompt)
+    image_model = model_routing.for_stage(vision_model, 'image_analysis')
+    payload = prepare_roi_payload(file_bytes)
+    if payload:
+        analysis_text = analyze_image_with_gemini(image_model, payload['images'][0], f"{payload['note']}\n{prompt}",
+                                                  payload['images'][1:], mime_type="image/jpeg")
+    else:
+        analysis_text = analyze_image_with_gemini(image_model, file_bytes, prompt)
+    # Escalation gets the full upload: a region the crops missed may be what's lacking
+    return escalate_analysis(vision_model, file_bytes, prompt, analysis_text)
+
+def prepare_roi_payload(image_bytes):
+    """roi_crop.prepare_image under the current ROI_POLICY; None (send the upload) if cropping fails."""
+    try:
+        return roi_crop.prepare_image(image_bytes)
+    except Exception:
+        metrics.increment('roi_crop_failures')
+        return None
+
+# --- Field Confidence ---
+# Each key field of an analysis gets a confidence level from the validators that apply it:
+# the price maps onto a predefined format, the dates parse into a plausible range, the store
+# matches the registry. Low-confidence fields are asked for again with a short prompt.
+CONFIDENCE_LOW, CONFIDENCE_MEDIUM, CONFIDENCE_HIGH = "low", "medium", "high"
+CONFIDENCE_REVIEWED = "reviewed"  # Set by the UI once a person has edited the field
+CONFIDENCE_FIELDS = ('product', 'price', 'dates', 'store')
+SALE_DATE_WINDOW_DAYS = 120  # A sale starting further from today than this is suspicious
+MAX_SALE_DAYS = 45  # ... as is one running longer than this
+
+# Item field -> the confidence field it belongs to
+CONFIDENCE_FIELD_SOURCES = {
+    'itemProduct': 'product', 'selectedPriceFormat': 'price', 'itemPriceValue': 'price',
+    'customItemPrice': 'price', 'dateRange': 'dates', 'selectedStoreKey': 'store',
+}
+
+def low_confidence_fields(field_confidence):
+    return [field for field in CONFIDENCE_FIELDS if field_confidence.get(field) == CONFIDENCE_LOW]
+
+def mark_reviewed(analysis_data_item, item_field):
+    """Records that a person edited item_field, so its confidence no longer reflects the model."""
+    field = CONFIDENCE_FIELD_SOURCES.get(item_field)
+    if field and analysis_data_item.get('fieldConfidence'):
+        analysis_data_item['fieldConfidence'][field] = CONFIDENCE_REVIEWED
+
+def apply_price_text(analysis_data_item, extracted_price_str):
+    """
+    Maps a raw price string onto selectedPriceFormat / itemPriceValue / customItemPrice.
+    Returns CONFIDENCE_HIGH if it matched a predefined format, MEDIUM for other text with a number.
+    """
+    if extracted_price_str and extracted_price_str.lower() not in ["not found", "n/a"]:
+        found_format = False
+        for p_format in PREDEFINED_PRICES:
+            if p_format['value'] == "CUSTOM": continue
+            unit_part_match_condition = False
+            if p_format['value'] == "X for $Y":
+                if "for" in extracted_price_str.lower() and ("$" in extracted_price_str or "¢" in extracted_price_str):
+                    unit_part_match_condition = True
+            elif " " in p_format['value']:
+                if p_format['value'].split(" ", 1)[1].lower() in extracted_price_str.lower():
+                    unit_part_match_condition = True
+            else:
+                if p_format['value'].lower() in extracted_price_str.lower():
+                    unit_part_match_condition = True
+            if unit_part_match_condition:
+                analysis_data_item['selectedPriceFormat'] = p_format['value']
+                if p_format['value'] == "X for $Y":
+                    analysis_data_item['itemPriceValue'] = extracted_price_str
+                else:
+                    price_val_match = re.search(r"([\d\.]+)", extracted_price_str)
+                    if price_val_match:
+                        analysis_data_item['itemPriceValue'] = price_val_match.group(1)
+                    else:
+                        analysis_data_item['selectedPriceFormat'] = "CUSTOM"
+                        analysis_data_item['customItemPrice'] = extracted_price_str
+                found_format = True; break
+        if not found_format:
+            analysis_data_item['selectedPriceFormat'] = "CUSTOM"
+            analysis_data_item['customItemPrice'] = extracted_price_str
+    else:
+        analysis_data_item['selectedPriceFormat'] = "CUSTOM"
+        analysis_data_item['customItemPrice'] = "N/A"
+    if analysis_data_item['selectedPriceFormat'] != "CUSTOM":
+        return CONFIDENCE_HIGH
+    return CONFIDENCE_MEDIUM if re.search(r"\d", analysis_data_item['customItemPrice']) else CONFIDENCE_LOW
+
+def apply_store_text(analysis_data_item, detected_store_name, combined_captions):
+    """Selects the registry store matching the detected name. Returns CONFIDENCE_HIGH on a match, else LOW."""
+    if detected_store_name and detected_store_name.lower() not in ["n/a", "not found"]:
+        matched_key = find_store_key_by_name(detected_store_name, combined_captions)
+        if matched_key:
+            analysis_data_item['selectedStoreKey'] = matched_key
+            return CONFIDENCE_HIGH
+        else:
+            analysis_data_item['analysisError'] += f"Store '{detected_store_name}' not in predefined list. Defaulting. "
+    return CONFIDENCE_LOW
+
+def apply_dates_text(analysis_data_item, dates_str):
+    """
+    Parses a raw 'Sale Dates' string into analysis_data_item['dateRange'], noting any fix-ups.
+    Returns the confidence in the result: CONFIDENCE_HIGH only for a cleanly parsed range within
+    SALE_DATE_WINDOW_DAYS of today and at most MAX_SALE_DAYS long.
+    """
+    with metrics.span('date_parse'):
+        confidence = _apply_dates_text(analysis_data_item, dates_str)
+    if confidence == CONFIDENCE_HIGH and not _sale_dates_in_range(analysis_data_item['dateRange']):
+        confidence = CONFIDENCE_MEDIUM
+    return confidence
+
+def _sale_dates_in_range(date_range):
+    start = datetime.datetime.strptime(date_range['start'], "%Y-%m-%d").date()
+    end = datetime.datetime.strptime(date_range['end'], "%Y-%m-%d").date()
+    return (abs((start - datetime.date.today()).days) <= SALE_DATE_WINDOW_DAYS
+            and (end - start).days <= MAX_SALE_DAYS)
+
+def _apply_dates_text(analysis_data_item, dates_str):
+    if dates_str and dates_str.lower() not in ["n/a", "not found"]:
+        date_parts = re.split(r'\s+to\s+|\s*-\s*|\s*–\s*', dates_str)
+        parsed_start, parsed_end = None, None
+        if len(date_parts) >= 1:
+            parsed_start = try_parse_date_from_image_text(date_parts[0])
+        if len(date_parts) >= 2:
+            end_part_text = date_parts[1]
+            if re.fullmatch(r"\d{1,2}", end_part_text.strip()) and parsed_start:
+                try:
+                    start_dt_obj = datetime.datetime.strptime(parsed_start, "%Y-%m-%d").date()
+                    end_day_num = int(end_part_text.strip())
+                    month_to_use, year_to_use = start_dt_obj.month, start_dt_obj.year
+                    if start_dt_obj.day > end_day_num:
+                        month_to_use = (start_dt_obj.month % 12) + 1
+                        if month_to_use == 1 and start_dt_obj.month == 12:
+                            year_to_use += 1
+                    end_part_text_for_parse = f"{month_to_use}/{end_day_num}"
+                    if year_to_use != datetime.date.today().year:
+                         end_part_text_for_parse += f"/{year_to_use % 100}"
+                    parsed_end = try_parse_date_from_image_text(end_part_text_for_parse)
+                except ValueError:
+                    parsed_end = try_parse_date_from_image_text(end_part_text)
+            else:
+                parsed_end = try_parse_date_from_image_text(end_part_text)
+        if parsed_start:
+            analysis_data_item['dateRange']['start'] = parsed_start
+        if parsed_end:
+            analysis_data_item['dateRange']['end'] = parsed_end
+        s_dt_str = analysis_data_item['dateRange']['start']
+        e_dt_str = analysis_data_item['dateRange']['end']
+        try:
+            s_dt = datetime.datetime.strptime(s_dt_str, "%Y-%m-%d").date()
+            e_dt = datetime.datetime.strptime(e_dt_str, "%Y-%m-%d").date()
+            confidence = CONFIDENCE_HIGH if parsed_start else CONFIDENCE_LOW
+            if s_dt > e_dt:
+                analysis_data_item['dateRange']['start'], analysis_data_item['dateRange']['end'] = e_dt_str, s_dt_str
+                analysis_data_item['analysisError'] += "Start/End dates reordered. "
+                confidence = CONFIDENCE_MEDIUM
+            if parsed_start and not parsed_end:
+                analysis_data_item['dateRange']['end'] = (s_dt + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+                analysis_data_item['analysisError'] += "End date inferred (1 day after start). Review. "
+                confidence = CONFIDENCE_MEDIUM
+            elif not parsed_start and parsed_end:
+                analysis_data_item['analysisError'] += "Start date not found. Using today. Review. "
+                confidence = CONFIDENCE_MEDIUM
+            return confidence
+        except ValueError:
+            analysis_data_item['analysisError'] += "Date parsing error. Defaults used. "
+            analysis_data_item['dateRange']['start'] = datetime.date.today().strftime("%Y-%m-%d")
+            analysis_data_item['dateRange']['end'] = (datetime.date.today() + datetime.timedelta(days=6)).strftime("%Y-%m-%d")
+            return CONFIDENCE_LOW
+    else:
+        analysis_data_item['analysisError'] += "Sale dates not found. Defaults used. "
+        return CONFIDENCE_LOW
+
+def parse_analysis_fields(analysis_text):
+    """Raw field strings (keys of ANALYSIS_FIELD_LABELS) from text in the IMAGE_ANALYSIS_PROMPT_TEMPLATE format; "" if not found."""
+    return {field: extract_field(rf"^{re.escape(label)}: (.*)$", analysis_text) for field, label in ANALYSIS_FIELD_LABELS.items()}
+
+def apply_analysis_fields(analysis_data_item, fields, combined_captions):
+    """Fills an analysis_data_item from parsed fields; sets and returns its fieldConfidence."""
+    with metrics.span('analysis_parse'):
+        analysis_data_item['itemProduct'] = (fields.get('product') or "Unknown Product").title()
+        analysis_data_item['itemCategory'] = fields.get('category') or "General Grocery"
+        analysis_data_item['detectedBrands'] = fields.get('brands') or "N/A"
+        price_confidence = apply_price_text(analysis_data_item, fields.get('price', ""))
+        store_confidence = apply_store_text(analysis_data_item, fields.get('store', ""), combined_captions)
+    field_confidence = {
+        'product': CONFIDENCE_HIGH if fields.get('product') else CONFIDENCE_LOW,
+        'price': price_confidence,
+        'dates': apply_dates_text(analysis_data_item, fields.get('dates', "")),
+        'store': store_confidence,
+    }
+    analysis_data_item['fieldConfidence'] = field_confidence
+    return field_confidence
+
+def apply_analysis_text(analysis_data_item, analysis_text, combined_captions):
+    """Fills an analysis_data_item from raw analysis text in the IMAGE_ANALYSIS_PROMPT_TEMPLATE format."""
+    return apply_analysis_fields(analysis_data_item, parse_analysis_fields(analysis_text), combined_captions)
+
+def _store_names(combined_captions):
+    return [variants[list(variants.keys())[0]]['name'].split('(')[0].strip() for variants in combined_captions.values() if variants]
+
+def _reported(value):
+    return bool(value) and value.lower() not in ["n/a", "not found"]
+
+def plausible_reextractions(low_fields, fields, combined_captions):
+    """
+    The low-confidence fields a second look could fill: dates only if the model read some
+    (an ad without printed dates stays without them), and the store only if a registry store
+    name appears in the analysis (a store outside the registry never matches).
+    """
+    text = " ".join(value for value in fields.values() if value).lower()
+    names = [name.lower() for name in _store_names(combined_captions) if name]
+    plausible = []
+    for field in low_fields:
+        if field == 'dates' and not _reported(fields.get('dates', "")):
+            continue
+        if field == 'store' and not any(name in text for name in names):
+            continue
+        plausible.append(field)
+    return plausible
+
+def reextract_low_confidence_fields(vision_model, analysis_data_item, fields, image_bytes, combined_captions, notes_before):
+    """
+    Asks the image model again for just the item's low-confidence fields with a short prompt
+    (build_field_prompt) and re-applies the analysis with every answer that raised a field
+    above CONFIDENCE_LOW; notes_before is the item's analysisError before the first apply.
+    Only fields plausible_reextractions keeps are asked for, so an unfillable field costs no call.
+    Returns the recovered field keys. A failed re-extraction keeps the item as it was.
+    """
+    all_low = low_confidence_fields(analysis_data_item.get('fieldConfidence', {}))
+    low_fields = plausible_reextractions(all_low, fields, combined_captions)
+    if len(all_low) > len(low_fields):
+        metrics.increment('field_reextractions_skipped', len(all_low) - len(low_fields))
+    if not low_fields:
+        return []
+    metrics.increment('field_reextractions')
+    try:
+        retried = parse_analysis_fields(analyze_image_with_gemini(
+            model_routing.for_stage(vision_model, 'image_analysis'), image_bytes,
+            build_field_prompt(low_fields, _store_names(combined_captions))))
+    except RunInterrupted:
+        raise
+    except Exception:  # Including an open circuit: the full analysis already succeeded
+        metrics.increment('field_reextraction_failures')
+        return []
+    trial = copy.deepcopy(analysis_data_item)
+    trial['analysisError'] = notes_before
+    trial_confidence = apply_analysis_fields(trial, dict(fields, **{f: retried[f] for f in low_fields}), combined_captions)
+    recovered = [field for field in low_fields if retried[field] and trial_confidence[field] != CONFIDENCE_LOW]
+    if recovered:
+        # Re-apply from the original notes so fix-up notes only describe the values kept
+        analysis_data_item['analysisError'] = notes_before
+        apply_analysis_fields(analysis_data_item, dict(fields, **{f: retried[f] for f in recovered}), combined_captions)
+        metrics.increment('fields_recovered', len(recovered))
+    return recovered
+
+def analyze_into_item(vision_model, analysis_data_item, file_bytes, file_type, combined_captions,
+                      prompt=IMAGE_ANALYSIS_PROMPT_TEMPLATE, analyze_fn=None, reextract=True):
+    """
+    Runs analysis for one upload and fills analysis_data_item in place.
+    Returns True on success; failures are recorded in analysisError and return False.
+    CircuitOpenError and RunInterrupted are recorded and re-raised so callers can surface
+    the degraded-API state or stop the run. `analyze_fn` overrides analyze_media (e.g. to add caching) and takes the same arguments.
+    With reextract, low-confidence fields of an image are asked for again with a targeted prompt
+    (videos already keep the most complete of several frames).
+    """
+    analyze_fn = analyze_fn or analyze_media
+    analysis_data_item['failedStage'] = "analysis"  # Cleared below once the analysis succeeded
+    started = time.perf_counter()
+    spent = token_usage.empty_usage()
+    try:
+        with token_usage.track() as spent:
+            analysis_text = analyze_fn(vision_model, file_bytes, file_type, prompt)
+            notes_before = analysis_data_item['analysisError']
+            fields = parse_analysis_fields(analysis_text)
+            apply_analysis_fields(analysis_data_item, fields, combined_captions)
+            if reextract and 'video' not in (file_type or ''):
+                reextract_low_confidence_fields(vision_model, analysis_data_item, fields, file_bytes,
+                                                combined_captions, notes_before)
+    except CircuitOpenError as e:
+        analysis_data_item['analysisError'] += f"Analysis skipped: {str(e)} "
+        raise
+    except RunInterrupted as e:
+        analysis_data_item['analysisError'] += f"Analysis stopped: {str(e)} "
+        raise
+    except Exception as e:
+        analysis_data_item['analysisError'] += f"Analysis exception: {str(e)}. Review manually. "
+        return False
+    else:
+        analysis_data_item['failedStage'] = ""
+        return True
+    finally:
+        token_usage.add_usage(analysis_data_item.setdefault('tokenUsage', token_usage.empty_usage()), spent)
+        metrics.observe('analyze_item', time.perf_counter() - started, ok=not analysis_data_item['failedStage'])
+
+
+# --- Flyer Mode ---
+# A full-page weekly flyer carries many deals. In flyer mode one vision call lists them all
+# (FLYER_ANALYSIS_PROMPT_TEMPLATE, JSON) and each deal becomes its own item, previewed by
+# a crop of the flyer around the box the model reported for it.
+MAX_FLYER_DEALS = 40
+DEAL_CROP_PADDING = 0.02  # Share of the flyer's size added around each deal box
+
+def deal_item_id(item_id, deal_index):
+    return f"{item_id}-deal-{deal_index + 1}"
+
+def deal_filename(filename, deal_index):
+    return f"{filename} (deal {deal_index + 1})"
+
+def analyze_flyer(vision_model, file_bytes, file_type=None, prompt=FLYER_ANALYSIS_PROMPT_TEMPLATE):
+    """Returns the raw flyer analysis text (JSON) for a full-page flyer image, in one model call."""
+    return analyze_image_with_gemini(model_routing.for_stage(vision_model, 'image_analysis'), file_bytes, prompt)
+
+def _flyer_value(value):
+    if isinstance(value, list):
+        value = ", ".join(str(v) for v in value)
+    value = str(value or "").strip()
+    return "" if value.lower() in ("not found", "n/a", "none", "null") else value
+
+def _deal_box(box):
+    """(ymin, xmin, ymax, xmax) clipped to 0-1000, or None if box isn't a usable box."""
+    try:
+        ymin, xmin, ymax, xmax = (min(1000, max(0, int(v))) for v in box)
+    except (TypeError, ValueError):
+        return None
+    return (ymin, xmin, ymax, xmax) if ymax > ymin and xmax > xmin else None
+
+def parse_flyer_deals(flyer_text):
+    """
+    Deals from a FLYER_ANALYSIS_PROMPT_TEMPLATE response as (fields, box) pairs: fields use the
+    keys of ANALYSIS_FIELD_LABELS (the flyer's store and dates fill in for the deal's own),
+    box is a 0-1000 (ymin, xmin, ymax, xmax) or None. Deals without a product are skipped.
+    Raises an exception if the response holds no readable JSON.
+    """
+    start, end = flyer_text.find("{"), flyer_text.rfind("}")  # Tolerates ```json fences
+    try:
+        data = json.loads(flyer_text[start:end + 1]) if 0 <= start < end else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('deals'), list):
+        raise Exception("Flyer analysis did not return a JSON deal list.")
+    flyer_fields = {'store': _flyer_value(data.get('store')), 'dates': _flyer_value(data.get('dates'))}
+    deals = []
+    for deal in data['deals'][:MAX_FLYER_DEALS]:
+        if not isinstance(deal, dict):
+            continue
+        fields = {field: _flyer_value(deal.get(field)) for field in ANALYSIS_FIELD_LABELS}
+        if not fields['product']:
+            continue
+        for field, value in flyer_fields.items():
+            fields[field] = fields[field] or value
+        deals.append((fields, _deal_box(deal.get('box'))))
+    return deals
+
+def flyer_into_items(vision_model, flyer_item, file_bytes, file_type, combined_captions, put_blob=None, analyze_fn=None):
+    """
+    Analyzes a full-page flyer in one call and splits it into one item per deal. flyer_item is
+    the fresh new_analysis_item for the upload; each deal item is a copy of it with id
+    deal_item_id(...), its own fields, 'dealBox' and, when put_blob (bytes -> blob id) is given,
+    a crop of its box as preview. The call's token usage is split over the deals (tokens
+    flyer_item already carries, e.g. from failed attempts, stay with the first deal).
+    Returns (items, ok). On failure flyer_item records the error and ([flyer_item], False) is
+    returned; CircuitOpenError and RunInterrupted are recorded on it and re-raised.
+    `analyze_fn` overrides analyze_flyer (e.g. to add caching) and takes analyze_media's arguments.
+    """
+    analyze_fn = analyze_fn or analyze_flyer
+    flyer_item['failedStage'] = "analysis"
+    started = time.perf_counter()
+    spent = token_usage.empty_usage()
+    items = [flyer_item]
+    try:
+        with token_usage.track() as spent:
+            deals = parse_flyer_deals(analyze_fn(vision_model, file_bytes, file_type, FLYER_ANALYSIS_PROMPT_TEMPLATE))
+        if not deals:
+            raise Exception("No deals were found on the flyer.")
+        crops = roi_crop.crop_boxes(file_bytes, [box for _, box in deals], DEAL_CROP_PADDING) if put_blob else [None] * len(deals)
+        items = []
+        for index, ((fields, box), crop) in enumerate(zip(deals, crops)):
+            deal_item = copy.deepcopy(flyer_item)
+            deal_item.update(id=deal_item_id(flyer_item['id'], index), failedStage="",
+                             original_filename=deal_filename(flyer_item['original_filename'], index),
+                             dealBox=list(box) if box else None)
+            if index:
+                deal_item['tokenUsage'] = token_usage.empty_usage()
+            if crop:
+                deal_item['preview_blob_id'] = put_blob(crop)
+            apply_analysis_fields(deal_item, fields, combined_captions)
+            items.append(deal_item)
+        metrics.increment('flyer_deals', len(items))
+    except CircuitOpenError as e:
+        flyer_item['analysisError'] += f"Analysis skipped: {str(e)} "
+        raise
+    except RunInterrupted as e:
+        flyer_item['analysisError'] += f"Analysis stopped: {str(e)} "
+        raise
+    except Exception as e:
+        flyer_item['analysisError'] += f"Flyer analysis exception: {str(e)}. Review manually. "
+        items = [flyer_item]
+        return items, False
+    else:
+        return items, True
+    finally:
+        for item, share in zip(items, token_usage.split_usage(spent, len(items))):
+            token_usage.add_usage(item.setdefault('tokenUsage', token_usage.empty_usage()), share)
+        metrics.observe('analyze_item', time.perf_counter() - started, ok=not items[0]['failedStage'])
+
+
+# --- Caption Generation ---
+# Notes a failed caption attempt appends; they are dropped when the caption is generated again
+CAPTION_FAILURE_NOTES = re.compile(r"\s*(Caption API error|Caption stopped|Caption skipped): .*$", re.DOTALL)
+
+def _set_caption_failed(data_item, failed):
+    # An analysis failure is the more useful flag to keep: retrying it also unblocks the caption
+    if failed and data_item.get('failedStage') != "analysis":
+        data_item['failedStage'] = "caption"
+    elif not failed and data_item.get('failedStage') == "caption":
+        data_item['failedStage'] = ""
+
+def select_caption_structure(store_key, combined_captions):
+    """Returns (sale_detail_sub_key, caption_structure) for a store, or (None, None) if unknown."""
+    store_info_set = combined_captions.get(store_key)
+    if not store_info_set:
+        return None, None
+    sale_detail_sub_key = list(store_info_set.keys())[0]
+    if store_key == 'TEDS_FRESH_MARKET':
+        day_for_teds = get_current_day_for_teds()
+        if day_for_teds == 2 and 'THREE_DAY' in store_info_set: sale_detail_sub_key = 'THREE_DAY'
+        elif day_for_teds == 5 and 'FOUR_DAY' in store_info_set: sale_detail_sub_key = 'FOUR_DAY'
+        elif sale_detail_sub_key not in store_info_set: sale_detail_sub_key = list(store_info_set.keys())[0]
+    return sale_detail_sub_key, store_info_set.get(sale_detail_sub_key)
+
+def build_caption_prompt(data_item, caption_structure, tone, reference_caption=None, token_budget=None):
+    """
+    Builds the caption prompt for one item within token_budget (see prompt_builder).
+    Returns (prompt, context, error) where context holds the values the caption brain records.
+    """
+    current_error = ""
+    is_sale_based_post = caption_structure.get('dateFormat') != ""
+
+    product_display_text = data_item.get('itemProduct', 'Unknown Product')
+    if not product_display_text.strip() or product_display_text == "Unknown Product":
+        current_error += " Product name missing/unknown."
+
+    final_price = get_final_price_string(data_item['selectedPriceFormat'], data_item['itemPriceValue'], data_item['customItemPrice'])
+    if is_sale_based_post and (not final_price or "[Price Value]" in final_price or "[Custom Price]" in final_price or "[X for $Y Price]" in final_price or "N/A" in final_price):
+        current_error += " Invalid/missing price."
+
+
+    display_dates = ""
+    if is_sale_based_post:
+        display_dates = format_dates_for_caption_context(data_item['dateRange']['start'], data_item['dateRange']['end'], caption_structure['dateFormat'], caption_structure['language'])
+        if "MISSING" in display_dates or "INVALID" in display_dates:
+            if "Invalid date range for caption." not in current_error:
+                current_error += " Invalid date range for caption."
+
+
+    holiday_ctx = get_holiday_context(data_item['dateRange']['start'], data_item['dateRange']['end']) if is_sale_based_post else ""
+    dates_ok = is_sale_based_post and "MISSING" not in display_dates and "INVALID" not in display_dates
+
+    detected_brands = data_item.get('detectedBrands', 'N/A')
+    has_brands = detected_brands.lower() not in ['n/a', 'not found', '']
+    temp_product_display_text = product_display_text
+    if has_brands: temp_product_display_text += f" (featuring {detected_brands})"
+
+    builder = PromptBuilder(token_budget)
+    builder.add("Generate a social media caption for a grocery store promotion.")
+    builder.add(f"Store & Sale Type: {caption_structure['name']}")
+    builder.add(f"Product to feature: {temp_product_display_text}")
+    if is_sale_based_post:
+        builder.add(f"Price: {final_price}")
+        if dates_ok:
+            builder.add(f"Sale Dates (for display in caption): {display_dates}. (Actual period: {data_item['dateRange']['start']} to {data_item['dateRange']['end']}).")
+    if holiday_ctx: builder.add(f"Relevant Holiday Context: {holiday_ctx}.")
+    builder.add(f"Store Location: {caption_structure['location']}. Language for caption: {caption_structure['language']}. Desired Tone: {tone}.")
+    if holiday_ctx and tone == "Seasonal / Festive":
+        builder.add(f"Strongly emphasize the {holiday_ctx} theme and use relevant emojis.", priority=3, label="holiday emphasis")
+
+    # Style references: the store's last caption is the stronger signal, so the original
+    # example is trimmed first. Hashtag lines are left out (the hashtag requirement covers them).
+    reference_text = compact_reference(reference_caption) if reference_caption else ""
+    if reference_text:
+        builder.add(reference_text, priority=2, min_tokens=40, label="reference caption",
+                    heading="STYLE REFERENCE (this store's previous caption; follow its structure, tone and line layout, but write a fresh caption for this item):")
+    example_text = compact_reference(caption_structure['original_example'])
+    if example_text:
+        builder.add(example_text, priority=1, min_tokens=25, label="original example",
+                    heading="Original example for this store (adapt, don't copy):")
+
+    builder.add_requirement("Unique, engaging, ready for social media; good formatting with line breaks.")
+    if is_sale_based_post:
+        brand_hint = f" (with the brand '{detected_brands}' if relevant)" if has_brands else ""
+        builder.add_requirement(f"State the product name{brand_hint} right next to its price, e.g. '{temp_product_display_text} is now {final_price}!', and include the store location.")
+        if dates_ok:
+            builder.add_requirement(f"Clearly include the sale dates ({display_dates}).")
+    else:
+        builder.add_requirement(f"Describe the product appealingly, e.g. 'Come try our delicious {temp_product_display_text} today!'. Do not mention price or sale dates.")
+
+    builder.add_requirement(f"Use relevant emojis for the product and tone{f' and {holiday_ctx}' if holiday_ctx else ''}.")
+
+    item_category_for_prompt = data_item.get('itemCategory', 'N/A'); base_hashtags = caption_structure['baseHashtags']; hashtag_details = [f"product '{product_display_text}'"]
+    if item_category_for_prompt.lower() not in ['n/a', 'not found', '', 'general grocery']:
+        hashtag_details.append(f"category '{item_category_for_prompt}'")
+    builder.add_requirement(f"End with these base hashtags: {base_hashtags}, plus 2-3 creative ones and 1-2 for each of: {', '.join(hashtag_details)}.")
+
+    builder.add_requirement(f"Make the store's main name ({caption_structure['name'].split('(')[0].strip()}) prominent if the location \"{caption_structure['location']}\" is just a city/area.")
+
+    # Include website if specified
+    if caption_structure.get('website'):
+        website_text = caption_structure['website']
+        if caption_structure['language'] == 'spanish':
+            builder.add_requirement(f"IMPORTANT: Always include the website with a line like 'Descubre todas las ofertas en 👉 {website_text}' (in Spanish).")
+        else:
+            builder.add_requirement(f"IMPORTANT: Always include the website with a line like 'Discover all offers at 👉 {website_text}'.")
+
+    if dates_ok and caption_structure.get('durationTextPattern'):
+        builder.add_requirement(f"Naturally integrate the promotional phrase \"{caption_structure['durationTextPattern']}\" with the sale dates if it makes sense.")
+
+    prompt = builder.build()
+    if builder.stats['trimmed'] or builder.stats['dropped']:
+        metrics.increment('caption_prompts_trimmed')
+
+    context = {
+        'product': product_display_text,
+        'price': final_price if is_sale_based_post else 'N/A',
+        'dateRange': data_item['dateRange'] if is_sale_based_post else {},
+        'tone': tone,
+        'category': data_item.get('itemCategory', 'N/A'),
+    }
+    context['prompt_tokens'] = builder.stats['tokens']
+    return prompt, context, current_error
+
+def generate_caption_for_item(text_model, data_item, combined_captions, tone, reference_caption=None, token_budget=None):
+    """
+    Generates a caption for one item, updating generatedCaption and analysisError in place.
+    token_budget caps the estimated prompt size (prompt_builder.DEFAULT_TOKEN_BUDGET if None).
+    Returns the caption brain entry on success, otherwise None.
+    CircuitOpenError and RunInterrupted are recorded in analysisError and re-raised.
+    """
+    started = time.perf_counter()
+    brain_entry = None
+    try:
+        with token_usage.track() as spent:
+            brain_entry = _generate_caption_for_item(text_model, data_item, combined_captions, tone, reference_caption, token_budget)
+    finally:
+        token_usage.add_usage(data_item.setdefault('tokenUsage', token_usage.empty_usage()), spent)
+        metrics.observe('caption_item', time.perf_counter() - started, ok=brain_entry is not None)
+    if brain_entry is not None:
+        brain_entry['tokens'] = spent
+    return brain_entry
+
+def _generate_caption_for_item(text_model, data_item, combined_captions, tone, reference_caption, token_budget):
+    # Clear the existing caption to ensure fresh generation
+    data_item['generatedCaption'] = ""
+    store_details_key = data_item['selectedStoreKey']
+    current_error = CAPTION_FAILURE_NOTES.sub("", data_item.get('analysisError', ""))
+    brain_entry = None
+
+    sale_detail_sub_key, caption_structure = select_caption_structure(store_details_key, combined_captions)
+    if sale_detail_sub_key is None:
+        current_error += f" Store details for '{store_details_key}' not found."
+    elif not caption_structure:
+        current_error += f" Caption structure for '{sale_detail_sub_key}' under '{store_details_key}' not found."
+    else:
+        with metrics.span('caption_prompt'):
+            final_prompt_for_caption, context, prompt_error = build_caption_prompt(data_item, caption_structure, tone, reference_caption, token_budget)
+        current_error += prompt_error
+        try:
+            generated_text = generate_caption_with_gemini(text_model, final_prompt_for_caption)
+            cleaned_text = generated_text.replace('*', '')
+
+            # Add timestamp for debugging
+            timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+            cleaned_text = f"[Generated at {timestamp}] {cleaned_text}"
+
+            data_item['generatedCaption'] = cleaned_text
+            brain_entry = dict(context, caption=cleaned_text, timestamp=timestamp)
+        except CircuitOpenError as e:
+            current_error += f" Caption API error: {str(e)}"
+            data_item['analysisError'] = current_error.strip()
+            _set_caption_failed(data_item, True)
+            raise
+        except RunInterrupted as e:
+            current_error += f" Caption stopped: {str(e)}"
+            data_item['analysisError'] = current_error.strip()
+            _set_caption_failed(data_item, True)
+            raise
+        except Exception as e:
+            current_error += f" Caption API error: {str(e)}"
+
+    data_item['analysisError'] = current_error.strip()
+    _set_caption_failed(data_item, brain_entry is None)
+    return brain_entry
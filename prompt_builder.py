@@ -0,0 +1,132 @@
+# prompt_builder.py
+"""
+Token-budgeted prompt assembly for caption generation.
+
+A prompt is a list of sections plus a list of requirement bullets. Required sections
+(item facts, store, language, tone) and requirements are always kept. Optional sections
+(the continuity reference, the store's original example, extra style hints) carry a
+priority: when the estimated size exceeds the budget, the lowest-priority sections are
+trimmed first (down to their min_tokens), then dropped. Duplicate lines and requirements
+are skipped, and reference material is cleaned of debug prefixes and hashtag lines
+before it is added.
+"""
+import re
+
+DEFAULT_TOKEN_BUDGET = 450  # Estimated prompt tokens per caption request
+CHARS_PER_TOKEN = 4  # Rough size estimate; good enough for budgeting, no tokenizer needed
+
+# Debug prefix added to generated captions, e.g. "[Generated at 14:03:12] "
+DEBUG_PREFIX = re.compile(r"^\s*\[Generated at [^\]]*\]\s*")
+HASHTAG_LINE = re.compile(r"^\s*(#\w+\s*)+$", re.UNICODE)
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def parse_prompt_budget(value):
+    """The prompt_budget setting as a positive int; accepts whole numbers and digit strings, raises ValueError otherwise."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"prompt_budget must be a positive whole number of tokens, not {value!r}.")
+    return value
+
+
+def strip_debug_prefix(caption):
+    return DEBUG_PREFIX.sub("", caption or "")
+
+
+def compact_reference(text):
+    """Reference material without debug prefixes, hashtag-only lines or runs of blank lines."""
+    lines = [line.rstrip() for line in strip_debug_prefix(text).splitlines()]
+    lines = [line for line in lines if not HASHTAG_LINE.match(line)]
+    return re.sub(r"\n{2,}", "\n", "\n".join(lines)).strip()
+
+
+def trim_to_tokens(text, max_tokens):
+    """Keeps whole lines from the start while they fit; cuts the first line at a word if none does."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    kept, used = [], 0
+    for line in text.splitlines():
+        if used + len(line) + 1 > max_chars:
+            break
+        kept.append(line)
+        used += len(line) + 1
+    if kept:
+        return "\n".join(kept) + "\n…"
+    return text[:max_chars].rsplit(" ", 1)[0] + " …"
+
+
+def _normalized(text):
+    return re.sub(r"\W+", " ", text.lower()).strip()
+
+
+class PromptBuilder:
+    def __init__(self, token_budget=DEFAULT_TOKEN_BUDGET):
+        self.token_budget = token_budget or DEFAULT_TOKEN_BUDGET
+        self._sections = []
+        self._requirements = []
+        self._seen = set()
+        self.stats = {}
+
+    def add(self, text, priority=None, min_tokens=0, label="", heading=""):
+        """
+        Adds a section. priority None means required; otherwise lower priorities are trimmed
+        or dropped first. min_tokens > 0 lets the section be trimmed down to that size
+        before it is dropped. With a heading, text is quoted below it and only text is trimmed.
+        Empty and already-added sections are skipped.
+        """
+        key = _normalized(text)
+        if not key or key in self._seen:
+            return
+        self._seen.add(key)
+        self._sections.append({'text': text, 'heading': heading, 'priority': priority,
+                               'min_tokens': min_tokens, 'label': label or key[:30]})
+
+    def add_requirement(self, text):
+        key = _normalized(text)
+        if key and key not in self._seen:
+            self._seen.add(key)
+            self._requirements.append(text)
+
+    @staticmethod
+    def _section_text(section):
+        if not section['text'] or not section['heading']:
+            return section['text']
+        return f'{section["heading"]}\n"""\n{section["text"]}\n"""'
+
+    def _render(self):
+        parts = [self._section_text(section) for section in self._sections if section['text']]
+        if self._requirements:
+            parts.append("Caption Requirements:\n" + "\n".join(f"- {req}" for req in self._requirements))
+        return "\n".join(parts)
+
+    def build(self):
+        """Returns the prompt; self.stats records its estimated tokens and what was trimmed or dropped."""
+        trimmed, dropped = [], []
+        optional = sorted((s for s in self._sections if s['priority'] is not None), key=lambda s: s['priority'])
+        over = estimate_tokens(self._render()) - self.token_budget
+        # First shorten trimmable sections, then drop whole sections, lowest priority first
+        for section in optional:
+            if over <= 0:
+                break
+            tokens = estimate_tokens(section['text'])
+            if section['min_tokens'] and tokens > section['min_tokens']:
+                section['text'] = trim_to_tokens(section['text'], max(section['min_tokens'], tokens - over))
+                trimmed.append(section['label'])
+                over = estimate_tokens(self._render()) - self.token_budget
+        for section in optional:
+            if over <= 0:
+                break
+            section['text'] = ""
+            dropped.append(section['label'])
+            over = estimate_tokens(self._render()) - self.token_budget
+        prompt = self._render()
+        self.stats = {'tokens': estimate_tokens(prompt), 'budget': self.token_budget,
+                      'trimmed': [label for label in trimmed if label not in dropped], 'dropped': dropped}
+        return prompt
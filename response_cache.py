@@ -0,0 +1,38 @@
+# response_cache.py
+"""
+Tiny on-disk cache for raw Gemini responses, keyed by a hash of everything that
+determines the response (content hash, prompt, model settings). One file per entry,
+written atomically so concurrent workers and interrupted runs never see partial data.
+"""
+import os
+import tempfile
+
+from utils import content_hash
+
+
+class ResponseCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """Builds a cache key from str/bytes parts (bytes are hashed first)."""
+        hashed = [content_hash(p) if isinstance(p, (bytes, bytearray)) else str(p) for p in parts]
+        return content_hash("\x1f".join(hashed))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, text):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, self._path(key))
@@ -0,0 +1,218 @@
+# roi_crop.py
+"""
+Optional region-of-interest preprocessing for still-image analysis.
+
+Sale ads carry the product, price and dates in a few large text blocks; the rest is product
+photography that costs upload bytes and image tokens. This stage finds dense text regions
+with OpenCV (morphological gradient, Otsu threshold, horizontal closing, contour boxes) and
+sends the model less image:
+
+    off        the image as uploaded (default)
+    composite  one image stacking the detected regions at full resolution
+    overview   the whole ad downscaled to overview_max_side, plus full-resolution region crops
+
+The upload is sent unchanged when no usable regions are found, when they cover most of the
+image, or when the crops would not be cheaper (more estimated image tokens, or as many and
+more bytes). Set the mode with the ROI_CROP_MODE environment variable or
+configure_roi_policy(mode=...).
+
+crop_boxes cuts the deals of a full-page flyer out by the boxes the model reported
+(flyer mode, see pipeline.flyer_into_items).
+"""
+import math
+import os
+
+import metrics
+
+ROI_MODES = ("off", "composite", "overview")
+
+ROI_POLICY = {
+    'mode': os.getenv("ROI_CROP_MODE", "off").strip().lower() or "off",
+    'max_regions': 6,             # Largest text regions kept
+    'min_area_fraction': 0.002,   # Ignore regions smaller than this share of the image
+    'min_edge_density': 0.12,     # Share of edge pixels a region needs to count as text
+    'padding_px': 12,             # Margin added around each region
+    'max_coverage': 0.8,          # Send the full image if regions cover more than this share
+    'overview_max_side': 512,     # Long side of the downscaled full image in 'overview' mode
+    'detect_max_side': 1200,      # Detection runs on a copy no larger than this
+    'jpeg_quality': 90,
+}
+
+# Gemini bills an image of up to 384x384 px as 258 tokens, larger ones per 768x768 tile
+SMALL_IMAGE_MAX_SIDE = 384
+TILE_SIDE = 768
+TOKENS_PER_TILE = 258
+
+COMPOSITE_NOTE = ("The image below stacks the text regions cropped from one grocery sale ad "
+                  "(product photos left out). Read them as one ad.")
+OVERVIEW_NOTE = ("The first image is the whole grocery sale ad at reduced resolution; the images after it "
+                 "are full-resolution crops of its text regions. Read them as one ad.")
+
+
+def configure_roi_policy(**overrides):
+    """Updates ROI_POLICY entries (e.g. mode="overview"). Unknown keys or modes raise ValueError."""
+    unknown = set(overrides) - set(ROI_POLICY)
+    if unknown:
+        raise ValueError(f"Unknown ROI setting(s): {', '.join(sorted(unknown))}")
+    if overrides.get('mode', ROI_POLICY['mode']) not in ROI_MODES:
+        raise ValueError(f"Unknown ROI mode '{overrides['mode']}'. Choose from: {', '.join(ROI_MODES)}")
+    ROI_POLICY.update(overrides)
+
+
+def estimate_image_tokens(width, height):
+    if width <= SMALL_IMAGE_MAX_SIDE and height <= SMALL_IMAGE_MAX_SIDE:
+        return TOKENS_PER_TILE
+    return TOKENS_PER_TILE * math.ceil(width / TILE_SIDE) * math.ceil(height / TILE_SIDE)
+
+
+def detect_text_regions(image, policy=None):
+    """
+    Boxes (x, y, w, h) of dense text regions in a BGR image, largest first, at most
+    policy['max_regions'] of them, padded and clipped to the image.
+    """
+    import cv2
+    policy = policy or ROI_POLICY
+    height, width = image.shape[:2]
+    scale = min(1.0, policy['detect_max_side'] / max(height, width))
+    small = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_LINEAR) if scale < 1 else image
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    # Character strokes give strong local gradients; closing with a wide kernel joins the
+    # characters of a line (and nearby lines) into one blob.
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, edges = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    small_h, small_w = edges.shape
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(9, small_w // 40), max(3, small_h // 150)))
+    joined = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(joined, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    min_area = policy['min_area_fraction'] * small_w * small_h
+    candidates = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w * h < min_area or w < h * 0.8:  # Text lines are wider than tall
+            continue
+        density = cv2.countNonZero(edges[y:y + h, x:x + w]) / float(w * h)
+        if density >= policy['min_edge_density']:
+            candidates.append((x, y, w, h))
+    candidates = sorted(_merge_lines(candidates, max_gap=small_w // 20), key=lambda box: box[2] * box[3], reverse=True)
+
+    pad = policy['padding_px']
+    boxes = []
+    for x, y, w, h in candidates[:policy['max_regions']]:
+        x0, y0 = max(0, int(x / scale) - pad), max(0, int(y / scale) - pad)
+        x1, y1 = min(width, int((x + w) / scale) + pad), min(height, int((y + h) / scale) + pad)
+        boxes.append((x0, y0, x1 - x0, y1 - y0))
+    return boxes
+
+
+def _merge_lines(boxes, max_gap):
+    """Joins boxes that sit on the same line less than max_gap apart (words of one text line)."""
+    boxes = sorted(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i, (x, y, w, h) in enumerate(boxes):
+            for j in range(i + 1, len(boxes)):
+                ox, oy, ow, oh = boxes[j]
+                vertical_overlap = min(y + h, oy + oh) - max(y, oy)
+                if vertical_overlap > 0.5 * min(h, oh) and ox - (x + w) <= max_gap:
+                    x0, y0 = min(x, ox), min(y, oy)
+                    boxes[i] = (x0, y0, max(x + w, ox + ow) - x0, max(y + h, oy + oh) - y0)
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def _encode_jpeg(image, quality):
+    import cv2
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buffer.tobytes()
+
+
+def _covered_area(boxes):
+    # Boxes can overlap after padding; count each pixel once via a coarse grid
+    return len({(gx, gy) for x, y, w, h in boxes
+                for gx in range(x // 8, (x + w) // 8 + 1) for gy in range(y // 8, (y + h) // 8 + 1)}) * 64
+
+
+def crop_boxes(image_bytes, boxes, padding=0.02, quality=None):
+    """
+    JPEG crops of an image for boxes (ymin, xmin, ymax, xmax) on a 0-1000 scale, each grown by
+    padding (a share of the image size) and clipped to the image; None for a None box.
+    Returns None for every box if the image can't be decoded.
+    """
+    import cv2
+    import numpy as np
+    with metrics.span('deal_crop'):
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return [None] * len(boxes)
+        height, width = image.shape[:2]
+        pad_y, pad_x = int(padding * height), int(padding * width)
+        crops = []
+        for box in boxes:
+            if box is None:
+                crops.append(None)
+                continue
+            ymin, xmin, ymax, xmax = box
+            y0, x0 = max(0, int(ymin * height / 1000) - pad_y), max(0, int(xmin * width / 1000) - pad_x)
+            y1, x1 = min(height, int(ymax * height / 1000) + pad_y), min(width, int(xmax * width / 1000) + pad_x)
+            crops.append(_encode_jpeg(image[y0:y1, x0:x1], quality or ROI_POLICY['jpeg_quality']) if y1 > y0 and x1 > x0 else None)
+    return crops
+
+
+def prepare_image(image_bytes, mode=None, policy=None):
+    """
+    The payload to analyze for an uploaded image under the ROI policy, or None to send the
+    upload unchanged. Returns {'images': [JPEG bytes, ...], 'note', 'regions', 'bytes', 'tokens'}
+    where note explains the layout to the model and tokens is the estimated image token count.
+    """
+    policy = policy or ROI_POLICY
+    mode = mode or policy['mode']
+    if mode == "off":
+        return None
+    import cv2
+    import numpy as np
+    with metrics.span('roi_crop'):
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return None
+        height, width = image.shape[:2]
+        regions = detect_text_regions(image, policy)
+        if not regions or _covered_area(regions) > policy['max_coverage'] * width * height:
+            metrics.increment('roi_crop_skipped')
+            return None
+        # Reading order: top to bottom, then left to right
+        regions.sort(key=lambda box: (box[1], box[0]))
+        crops = [image[y:y + h, x:x + w] for x, y, w, h in regions]
+
+        if mode == "composite":
+            gap = 8
+            canvas_w = max(crop.shape[1] for crop in crops)
+            canvas_h = sum(crop.shape[0] for crop in crops) + gap * (len(crops) - 1)
+            canvas = np.full((canvas_h, canvas_w, 3), 255, dtype=np.uint8)
+            top = 0
+            for crop in crops:
+                canvas[top:top + crop.shape[0], :crop.shape[1]] = crop
+                top += crop.shape[0] + gap
+            parts, note = [canvas], COMPOSITE_NOTE
+        else:
+            scale = min(1.0, policy['overview_max_side'] / max(width, height))
+            overview = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+            parts, note = [overview] + crops, OVERVIEW_NOTE
+
+        images = [_encode_jpeg(part, policy['jpeg_quality']) for part in parts]
+        tokens = sum(estimate_image_tokens(part.shape[1], part.shape[0]) for part in parts)
+        original_tokens = estimate_image_tokens(width, height)
+        if tokens > original_tokens or (tokens == original_tokens and sum(len(data) for data in images) >= len(image_bytes)):
+            metrics.increment('roi_crop_skipped')
+            return None
+    metrics.increment('roi_crops')
+    return {'images': images, 'note': note, 'regions': regions,
+            'bytes': sum(len(data) for data in images), 'tokens': tokens}
@@ -0,0 +1,132 @@
+# run_control.py
+"""
+Cancellation and deadlines for long analysis and caption runs.
+
+A RunControl belongs to one run (e.g. a background job). While a worker processes an item
+it activates the control for its thread; model calls and the video frame loop then call
+check_current() and stop with RunInterrupted once the run is cancelled or a deadline
+passes. In-flight API requests cannot be aborted, but the caller stops waiting for them.
+Retry runs wait between attempts with sleep(), which wakes early when the run is cancelled.
+"""
+import contextlib
+import contextvars
+import threading
+import time
+
+
+class RunInterrupted(Exception):
+    """The current run was stopped before this step finished."""
+
+
+class RunCancelled(RunInterrupted):
+    pass
+
+
+class DeadlineExceeded(RunInterrupted):
+    def __init__(self, message, scope):
+        super().__init__(message)
+        self.scope = scope  # 'item' or 'job'
+
+
+class RunControl:
+    def __init__(self, job_deadline_s=None, item_deadline_s=None):
+        self.job_deadline_s = job_deadline_s or None
+        self.item_deadline_s = item_deadline_s or None
+        self._job_deadline = time.monotonic() + self.job_deadline_s if self.job_deadline_s else None
+        self._item_deadline = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def start_item(self):
+        """Starts the per-item deadline clock for the next item."""
+        self._item_deadline = time.monotonic() + self.item_deadline_s if self.item_deadline_s else None
+
+    def stopped(self):
+        """True once the whole run should stop (cancelled or past the job deadline)."""
+        return self.cancelled or (self._job_deadline is not None and time.monotonic() >= self._job_deadline)
+
+    def check(self):
+        """Raises RunCancelled or DeadlineExceeded if the run or the current item must stop."""
+        if self.cancelled:
+            raise RunCancelled("Run cancelled.")
+        now = time.monotonic()
+        if self._job_deadline is not None and now >= self._job_deadline:
+            raise DeadlineExceeded(f"Job deadline of {self.job_deadline_s:g}s exceeded.", 'job')
+        if self._item_deadline is not None and now >= self._item_deadline:
+            raise DeadlineExceeded(f"Item deadline of {self.item_deadline_s:g}s exceeded.", 'item')
+
+    def sleep(self, seconds):
+        """Waits up to seconds (less if a deadline comes first), then check()s."""
+        now = time.monotonic()
+        for deadline in (self._job_deadline, self._item_deadline):
+            if deadline is not None:
+                seconds = min(seconds, deadline - now)
+        self._cancelled.wait(max(seconds, 0))
+        self.check()
+
+
+_current_control = contextvars.ContextVar('run_control', default=None)
+
+
+@contextlib.contextmanager
+def active(control):
+    """Makes control the one check_current() consults in this thread."""
+    token = _current_control.set(control)
+    try:
+        yield control
+    finally:
+        _current_control.reset(token)
+
+
+def current():
+    return _current_control.get()
+
+
+def check_current():
+    control = _current_control.get()
+    if control is not None:
+        control.check()
+
+
+def sleep(seconds):
+    """Interruptible sleep under the active control; a plain sleep outside of one."""
+    control = _current_control.get()
+    if control is None:
+        time.sleep(seconds)
+    else:
+        control.sleep(seconds)
+
+
+# --- Retry backoff ---
+DEFAULT_RETRY_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF_S = 2.0
+MAX_RETRY_BACKOFF_S = 30.0
+
+
+def backoff_delay(attempt, backoff_s=DEFAULT_RETRY_BACKOFF_S, max_backoff_s=MAX_RETRY_BACKOFF_S):
+    """Seconds to wait before retry number attempt (1-based): backoff_s doubling per attempt, capped."""
+    return min(backoff_s * (2 ** max(attempt - 1, 0)), max_backoff_s)
+
+
+def retry(attempt, attempts=1, backoff_s=DEFAULT_RETRY_BACKOFF_S):
+    """
+    Calls attempt() until it returns something truthy or attempts are used up, backing off
+    between calls. Returns the last result. A stop during the backoff ends the retries
+    early; exceptions from attempt() propagate.
+    """
+    result = None
+    for n in range(1, max(attempts, 1) + 1):
+        result = attempt()
+        if result or n >= attempts:
+            break
+        try:
+            sleep(backoff_delay(n, backoff_s))
+        except RunInterrupted:
+            break  # Keep the last failure; the run notices the stop itself
+    return result
@@ -0,0 +1,153 @@
+# stub_model.py
+"""
+Offline stand-in for genai.GenerativeModel, for load tests, benchmarks and local runs
+without an API key. Multimodal calls (a list of prompt + image) get a canned analysis in
+the IMAGE_ANALYSIS_PROMPT_TEMPLATE format, or a JSON list of flyer_deals deals when the
+prompt asks for one (FLYER_ANALYSIS_PROMPT_TEMPLATE); plain text prompts get a canned caption.
+
+Image parts are serialized the way the SDK does before a request (PIL images re-encoded as
+lossless WebP, {'mime_type', 'data'} parts sent as-is), so benchmarks see that cost; the
+bytes sent are counted in bytes_sent.
+
+Latency can be fixed or drawn from a distribution, and a share of calls can fail or return
+a partial analysis. Random draws come from a seeded generator, so a run with the same
+seed and call order (e.g. one worker) sees the same latencies, errors and responses.
+"""
+import io
+import json
+import math
+import random
+import threading
+import time
+
+DEFAULT_ANALYSIS_TEXT = (
+    "Product Name: Fresh Eggplant\n"
+    "Price: 79¢ / lb.\n"
+    "Sale Dates: 05/13-05/15\n"
+    "Store Name: Ted's Fresh Market\n"
+    "Promotional Text: 3 Days Only\n"
+    "Product Category: Produce\n"
+    "Detected Brands/Logos: Not found"
+)
+# Scores below the maximum, so video analysis keeps sampling frames
+PARTIAL_ANALYSIS_TEXT = (
+    "Product Name: Fresh Eggplant\n"
+    "Price: Not found\n"
+    "Sale Dates: Not found\n"
+    "Store Name: Ted's Fresh Market\n"
+    "Promotional Text: Not found\n"
+    "Product Category: Produce\n"
+    "Detected Brands/Logos: Not found"
+)
+DEFAULT_CAPTION_TEXT = "Fresh Eggplant is now 79¢ / lb.! 🍆\n3 DAYS ONLY 05/13-05/15\n2840 W. Devon Ave.\n#Sale #Fresh"
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+DEFAULT_FLYER_DEALS = 20
+FLYER_PROMPT_MARKER = '"deals"'  # Only the flyer prompt spells out this JSON key
+
+
+def make_flyer_text(deal_count=DEFAULT_FLYER_DEALS, columns=4):
+    """Flyer analysis JSON with deal_count deals laid out on a grid of boxes."""
+    rows = max(1, math.ceil(deal_count / columns))
+    deals = [{'product': f"Fresh Item {n + 1}", 'price': f"${n % 9 + 1}.99 / lb.", 'dates': "Not found",
+              'category': "Produce", 'brands': "Not found",
+              'box': [1000 * (n // columns) // rows, 1000 * (n % columns) // columns,
+                      1000 * (n // columns + 1) // rows, 1000 * (n % columns + 1) // columns]}
+             for n in range(deal_count)]
+    return json.dumps({'store': "Ted's Fresh Market", 'dates': "05/13-05/15", 'deals': deals})
+
+
+class StubModelError(Exception):
+    """Injected failure, shaped like a transient API error."""
+
+
+class StubUsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)  # Roughly 4 characters per token
+
+
+class StubResponse:
+    def __init__(self, text, prompt_token_count=0):
+        self.text = text
+        self.usage_metadata = StubUsageMetadata(prompt_token_count, estimate_tokens(text))
+
+
+def serialize_image_part(part):
+    """Request bytes for an image part, as the google-generativeai SDK builds them."""
+    if isinstance(part, dict):
+        return part['data']
+    buffer = io.BytesIO()
+    part.save(buffer, format="webp", lossless=True)
+    return buffer.getvalue()
+
+
+class StubModel:
+    def __init__(self, model_name="stub-model", latency_s=0.0,
+                 analysis_text=DEFAULT_ANALYSIS_TEXT, caption_text=DEFAULT_CAPTION_TEXT,
+                 latency_dist="fixed", latency_spread=0.5, error_rate=0.0,
+                 partial_rate=0.0, partial_analysis_text=PARTIAL_ANALYSIS_TEXT, seed=None,
+                 flyer_deals=DEFAULT_FLYER_DEALS):
+        """
+        latency_s is the typical (median for lognormal, mean otherwise) seconds per call.
+        latency_spread: +/- fraction for 'uniform', sigma for 'lognormal'; unused otherwise.
+        error_rate: share of calls raising StubModelError.
+        partial_rate: share of analysis calls answered with partial_analysis_text.
+        flyer_deals: number of deals in the answer to a flyer prompt.
+        """
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{latency_dist}'. Choose from: {', '.join(LATENCY_DISTRIBUTIONS)}")
+        self.model_name = model_name
+        self.latency_s = latency_s
+        self.analysis_text = analysis_text
+        self.caption_text = caption_text
+        self.latency_dist = latency_dist
+        self.latency_spread = latency_spread
+        self.error_rate = error_rate
+        self.partial_rate = partial_rate
+        self.partial_analysis_text = partial_analysis_text
+        self.flyer_text = make_flyer_text(flyer_deals)
+        self.call_count = 0
+        self.bytes_sent = 0  # Serialized image bytes received over all calls
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self):
+        """Seconds the next call takes."""
+        if not self.latency_s:
+            return 0.0
+        with self._lock:
+            if self.latency_dist == "uniform":
+                return self.latency_s * self._rng.uniform(1 - self.latency_spread, 1 + self.latency_spread)
+            if self.latency_dist == "exponential":
+                return self._rng.expovariate(1 / self.latency_s)
+            if self.latency_dist == "lognormal":
+                return self._rng.lognormvariate(math.log(self.latency_s), self.latency_spread)
+            return self.latency_s
+
+    def generate_content(self, contents):
+        if isinstance(contents, (list, tuple)):
+            sent = sum(len(serialize_image_part(part)) for part in contents if not isinstance(part, str))
+            with self._lock:
+                self.bytes_sent += sent
+        latency = self.sample_latency()
+        with self._lock:
+            self.call_count += 1
+            failed = self.error_rate and self._rng.random() < self.error_rate
+            partial = self.partial_rate and self._rng.random() < self.partial_rate
+        if latency:
+            time.sleep(latency)
+        if failed:
+            raise StubModelError("503 Service Unavailable (stub)")
+        if isinstance(contents, (list, tuple)):
+            # Prompt text plus a fixed 258 tokens per image, like Gemini's small-image rate
+            prompt_tokens = sum(estimate_tokens(part) if isinstance(part, str) else 258 for part in contents)
+            if any(isinstance(part, str) and FLYER_PROMPT_MARKER in part for part in contents):
+                return StubResponse(self.flyer_text, prompt_tokens)
+            return StubResponse(self.partial_analysis_text if partial else self.analysis_text, prompt_tokens)
+        return StubResponse(self.caption_text, estimate_tokens(contents))
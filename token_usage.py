@@ -0,0 +1,155 @@
+# token_usage.py
+"""
+Token accounting for Gemini calls.
+
+call_model() reports the usage metadata of every successful response to record(). The
+totals go to whichever track() blocks are active in the calling thread. The pipeline wraps
+each item's analysis and caption in one, so every item carries its own `tokenUsage`.
+UsageLedger rolls item usage up per store and per batch in a JSON file kept next to the
+caption brain, so spend can be compared across runs.
+"""
+import contextlib
+import contextvars
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+USAGE_FIELDS = ('calls', 'input_tokens', 'output_tokens', 'image_tokens')
+# Gemini bills an image of up to 384x384 px (or each 768x768 tile of a larger one) as 258
+# tokens. Used only when a response doesn't break prompt tokens down by modality.
+IMAGE_TOKENS_PER_IMAGE = 258
+# USD per 1M tokens, for the cost estimates shown in the UI (Gemini Flash-Lite list prices)
+TOKEN_PRICING_USD_PER_1M = {'input': 0.10, 'output': 0.40}
+MAX_LEDGER_BATCHES = 200  # Most recent batches kept in the ledger file
+
+
+def empty_usage():
+    return {field: 0 for field in USAGE_FIELDS}
+
+
+def add_usage(total, usage):
+    """Adds usage into total in place; returns total."""
+    for field in USAGE_FIELDS:
+        total[field] = total.get(field, 0) + (usage or {}).get(field, 0)
+    return total
+
+
+def split_usage(usage, parts):
+    """usage divided into `parts` whole-number shares that add up to it; remainders go to the first shares."""
+    shares = [empty_usage() for _ in range(parts)]
+    for field in USAGE_FIELDS:
+        quotient, remainder = divmod((usage or {}).get(field, 0), parts)
+        for index, share in enumerate(shares):
+            share[field] = quotient + (1 if index < remainder else 0)
+    return shares
+
+
+def subtract_usage(after, before):
+    return {field: after.get(field, 0) - (before or {}).get(field, 0) for field in USAGE_FIELDS}
+
+
+def total_tokens(usage):
+    return usage.get('input_tokens', 0) + usage.get('output_tokens', 0)
+
+
+def estimate_cost_usd(usage, pricing=None):
+    pricing = pricing or TOKEN_PRICING_USD_PER_1M
+    return (usage.get('input_tokens', 0) * pricing['input'] + usage.get('output_tokens', 0) * pricing['output']) / 1_000_000
+
+
+def format_usage(usage):
+    """One-line summary, e.g. '1,234 in (258 image) / 56 out tokens · 2 call(s) · ~$0.0002'."""
+    return (f"{usage.get('input_tokens', 0):,} in ({usage.get('image_tokens', 0):,} image) / "
+            f"{usage.get('output_tokens', 0):,} out tokens · {usage.get('calls', 0)} call(s) · "
+            f"~${estimate_cost_usd(usage):.4f}")
+
+
+def usage_from_response(response, contents=None):
+    """Token counts from a response's usage_metadata (zeros if the response has none)."""
+    usage = empty_usage()
+    usage['calls'] = 1
+    metadata = getattr(response, 'usage_metadata', None)
+    if metadata is None:
+        return usage
+    usage['input_tokens'] = getattr(metadata, 'prompt_token_count', 0) or 0
+    usage['output_tokens'] = getattr(metadata, 'candidates_token_count', 0) or 0
+    details = getattr(metadata, 'prompt_tokens_details', None)
+    if details:
+        usage['image_tokens'] = sum(getattr(d, 'token_count', 0) or 0 for d in details
+                                    if 'IMAGE' in str(getattr(d, 'modality', '')).upper())
+    elif isinstance(contents, (list, tuple)):
+        image_count = sum(1 for part in contents if not isinstance(part, str))
+        usage['image_tokens'] = min(image_count * IMAGE_TOKENS_PER_IMAGE, usage['input_tokens'])
+    return usage
+
+
+# --- Per-thread tracking ---
+_active_totals = contextvars.ContextVar('token_usage_totals', default=())
+
+
+@contextlib.contextmanager
+def track():
+    """Collects the usage of calls made in this block (and in enclosing track() blocks)."""
+    totals = empty_usage()
+    token = _active_totals.set(_active_totals.get() + (totals,))
+    try:
+        yield totals
+    finally:
+        _active_totals.reset(token)
+
+
+def record(usage):
+    for totals in _active_totals.get():
+        add_usage(totals, usage)
+
+
+# --- Ledger ---
+class UsageLedger:
+    """
+    JSON file with token totals overall, per store and per batch:
+        {'totals': usage, 'stores': {store_key: usage}, 'batches': [{'id', 'kind', 'at', 'items', 'usage', 'by_store'}]}
+    Written atomically after every recorded batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
+        except (FileNotFoundError, ValueError):
+            pass
+        return {'totals': empty_usage(), 'stores': {}, 'batches': []}
+
+    def record_batch(self, batch_id, kind, item_usages):
+        """item_usages: list of (store_key, usage) for the batch. Returns the batch entry (None if nothing was spent)."""
+        by_store = {}
+        batch_usage = empty_usage()
+        for store_key, usage in item_usages:
+            add_usage(by_store.setdefault(store_key or "UNKNOWN", empty_usage()), usage)
+            add_usage(batch_usage, usage)
+        if not batch_usage['calls']:
+            return None
+        entry = {'id': batch_id, 'kind': kind, 'at': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                 'items': len(item_usages), 'usage': batch_usage, 'by_store': by_store}
+        with self._lock:
+            data = self.load()
+            add_usage(data.setdefault('totals', empty_usage()), batch_usage)
+            for store_key, usage in by_store.items():
+                add_usage(data.setdefault('stores', {}).setdefault(store_key, empty_usage()), usage)
+            data['batches'] = (data.get('batches', []) + [entry])[-MAX_LEDGER_BATCHES:]
+            self._write(data)
+        return entry
+
+    def _write(self, data):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
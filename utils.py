@@ -1,9 +1,16 @@
 # utils.py
 import datetime
-from dateutil.parser import parse as dateutil_parse
+import hashlib
+# dateutil is imported inside try_parse_date_from_image_text to keep it off the startup path.
 # from dateutil.relativedelta import relativedelta # Not used in the provided helper functions
 import re
 
+def content_hash(data):
+    """Fast, stable fingerprint for upload bytes (or text), used for cache and dedup keys."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
 def get_current_day_for_teds():
     py_weekday = datetime.date.today().weekday() # Monday is 0 and Sunday is 6
     # Convert to a system where Sunday=0, Monday=1, ..., Saturday=6 if that was the original JS logic.
@@ -155,6 +162,7 @@ def find_store_key_by_name(name_from_image, base_captions_data):
 
 def try_parse_date_from_image_text(text_from_image):
     if not text_from_image or not isinstance(text_from_image, str): return None
+    from dateutil.parser import parse as dateutil_parse
     text_from_image = text_from_image.strip()
     current_year = datetime.date.today().year
     